@@ -1,8 +1,17 @@
+import importlib
 import streamlit as st
-from sales_leads import show_sales_leads
-from client_stage_progression import show_client_stage_progression
-from low_sales_progression import show_low_sales_progression
 from streamlit_autorefresh import st_autorefresh
+from instrumentation import run_scope, timed
+
+# Report modules are imported only when their page is selected, so a run
+# never loads another page's dependencies (matplotlib, query definitions)
+PAGES = {
+    "Sales Leads Monitoring": ("sales_leads", "show_sales_leads"),
+    "Client Stage Progression Report": ("client_stage_progression", "show_client_stage_progression"),
+    "Low Sales Progression": ("low_sales_progression", "show_low_sales_progression"),
+    "Stage Funnel Report": ("stage_funnel", "show_stage_funnel"),
+    "Client Explorer": ("client_explorer", "show_client_explorer"),
+}
 
 favicon = "2.png"
 st.set_page_config(page_title='Homeeasy Sales Dashboard', page_icon=favicon, layout='wide', initial_sidebar_state='auto')
@@ -16,10 +25,12 @@ st.sidebar.write("The page will refresh automatically every hour.")
 # Set the refresh interval to 1 hour 
 st_autorefresh(interval=3600 * 1000, key="autoRefresh", debounce=False)
 st.sidebar.title("Homeeasy Sales Leads Monitoring System")
-page = st.sidebar.selectbox("Choose a report", ["Sales Leads Monitoring", "Client Stage Progression Report", "Low Sales Progression"])
-if page == "Sales Leads Monitoring":
-    show_sales_leads()
-elif page == "Client Stage Progression Report":
-    show_client_stage_progression()
-else:
-    show_low_sales_progression()
+page = st.sidebar.selectbox("Choose a report", list(PAGES))
+module_name, function_name = PAGES[page]
+with run_scope() as run_id:
+    with timed(f"page.{module_name}", kind="page"):
+        getattr(importlib.import_module(module_name), function_name)()
+
+if st.sidebar.checkbox("Show diagnostics", key="show_diagnostics"):
+    from diagnostics import show_diagnostics
+    show_diagnostics(run_id)
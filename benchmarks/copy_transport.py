@@ -0,0 +1,57 @@
+# Compares the regular fetchall transport with COPY TO STDOUT on the large
+# report queries. Run from the repository root, e.g.
+#   DATABASE_URL=postgresql://localhost/homeeasy python -m benchmarks.copy_transport --repeat 5
+import argparse
+import json
+import statistics
+import time
+
+import db
+import replica
+import stage_history
+
+QUERIES = {
+    'stage_history': stage_history.STAGE_HISTORY_QUERY,
+    'all_stage_rows': replica.ALL_STAGE_ROWS_QUERY,
+}
+
+
+def time_transport(query, transport, repeat):
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        frame = db.run_query(query, transport=transport)
+        timings.append(time.perf_counter() - started)
+    return {
+        'rows': len(frame),
+        'median_seconds': statistics.median(timings),
+        'min_seconds': min(timings),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare the fetchall and COPY transports on the large report queries")
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--query', action='append', default=[], help='extra SQL to benchmark')
+    parser.add_argument('--output', help='write results as JSON to this file')
+    args = parser.parse_args()
+
+    queries = dict(QUERIES)
+    queries.update({f'custom_{i}': query for i, query in enumerate(args.query, 1)})
+
+    results = {}
+    for name, query in queries.items():
+        fetch = time_transport(query, 'fetch', args.repeat)
+        copy = time_transport(query, 'copy', args.repeat)
+        results[name] = {'fetch': fetch, 'copy': copy}
+        speedup = fetch['median_seconds'] / copy['median_seconds'] if copy['median_seconds'] else float('inf')
+        print(f"{name:<20} rows={fetch['rows']:<10} fetch={fetch['median_seconds']:.3f}s "
+              f"copy={copy['median_seconds']:.3f}s speedup={speedup:.2f}x")
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
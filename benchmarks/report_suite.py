@@ -0,0 +1,193 @@
+# Times every report query and every in-Python transformation/render step
+# against synthetic data at several sizes, and writes the results as JSON so
+# two runs can be compared. Point it at a scratch database; each size
+# replaces the three report tables there, e.g.
+#   DATABASE_URL=postgresql://localhost/homeeasy_bench python -m benchmarks.report_suite --reset --output after.json --baseline before.json
+import argparse
+import json
+import platform
+import statistics
+import subprocess
+import time
+
+import pandas as pd
+
+import classification
+import client_stage_progression
+import db
+import funnel
+import low_sales_progression
+import queries
+import sales_leads
+import stage_history
+from benchmarks import synthetic_data
+from charts import rasterize
+
+DEFAULT_SIZES = [10000, 100000, 1000000]
+
+
+def report_queries():
+    # {name: (query, bind params)}; parameterized report queries run as
+    # prepared statements, like the dashboard runs them
+    window = queries.window_bounds()
+    return {
+        'stage_history': (stage_history.STAGE_HISTORY_QUERY, None),
+        'sales_leads.stage_history': (sales_leads.FETCH_STAGE_HISTORY_QUERY, None),
+        'sales_leads.latest_stage': (sales_leads.FETCH_LATEST_STAGE_QUERY, None),
+        'sales_leads.employee_stage': (sales_leads.FETCH_EMPLOYEE_STAGE_QUERY, None),
+        'client_stage_progression.leads_stage_4_and_beyond': (
+            client_stage_progression.FETCH_LEADS_STAGE_4_AND_BEYOND_QUERY, window
+        ),
+        'client_stage_progression.sales_reps_count': (client_stage_progression.FETCH_SALES_REPS_COUNT_QUERY, window),
+        'low_sales_progression.low_progression_clients': (
+            low_sales_progression.FETCH_LOW_PROGRESSION_CLIENTS_QUERY,
+            {**window, 'employee_ids': low_sales_progression.LOW_PROGRESSION_EMPLOYEE_IDS},
+        ),
+    }
+
+
+def run_report_query(query, params, transport):
+    if isinstance(query, queries.ReportQuery):
+        return queries.run_report_query(query, params)
+    return db.run_query(query, params, transport=transport)
+
+
+def python_steps(history):
+    # Each step takes the stage history frame; steps that need the output of
+    # another recompute it up front so only the step itself is timed
+    since = stage_history.window_start(history)
+    leads = stage_history.clients_in_window(history, since, min_stage=4)
+    durations = classification.client_durations(history)
+    latest = stage_history.latest_stage_data(history)
+    employee_stage = stage_history.employee_stage_data(history)
+
+    def latest_stage_chart():
+        summary = latest.groupby('latest_stage_name', observed=True).size().reset_index(name='Number of Clients')
+        return rasterize(summary, sales_leads.draw_latest_stage_summary)
+
+    def employee_stage_chart():
+        summary = employee_stage.groupby(['employee_name', 'current_stage_name'], observed=True).size().unstack().fillna(0)
+        return rasterize(summary, sales_leads.draw_employee_stage_summary, figsize=(14, 8))
+
+    return {
+        'pivot_stage_history': lambda: stage_history.pivot_stage_history(history),
+        'latest_stage_data': lambda: stage_history.latest_stage_data(history),
+        'employee_stage_data': lambda: stage_history.employee_stage_data(history),
+        'client_durations': lambda: classification.client_durations(history),
+        'classify_clients.mean': lambda: classification.classify(durations, 'mean', False),
+        'classify_clients.p75_per_employee': lambda: classification.classify(durations, 'p75', True),
+        'funnel_analytics': lambda: funnel.funnel_analytics(history),
+        'clients_in_window.stage_4_and_beyond': lambda: stage_history.clients_in_window(history, since, min_stage=4),
+        'leads_moved_per_employee': lambda: stage_history.leads_moved_per_employee(leads),
+        'clients_in_window.low_progression': lambda: stage_history.clients_in_window(
+            history, since, max_stage=3, employee_ids=low_sales_progression.LOW_PROGRESSION_EMPLOYEE_IDS
+        ),
+        'render.latest_stage_chart': latest_stage_chart,
+        'render.employee_stage_chart': employee_stage_chart,
+    }
+
+
+def time_call(func, repeat):
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = func()
+        timings.append(time.perf_counter() - started)
+    timing = {'median_seconds': statistics.median(timings), 'min_seconds': min(timings)}
+    if isinstance(result, pd.DataFrame):
+        timing['rows'] = len(result)
+    return timing
+
+
+def run_size(rows, args, reset):
+    frames = synthetic_data.generate(rows, **synthetic_data.generator_options(args))
+    started = time.perf_counter()
+    synthetic_data.load(frames, reset=reset)
+    load_seconds = time.perf_counter() - started
+
+    sql = {name: time_call(lambda: run_report_query(query, params, args.transport), args.repeat)
+           for name, (query, params) in report_queries().items()}
+
+    history = db.run_query(stage_history.STAGE_HISTORY_QUERY, transport=args.transport)
+    python = {name: time_call(step, args.repeat) for name, step in python_steps(history).items()}
+
+    return {
+        'stage_rows': len(frames[2]),
+        'clients': len(frames[1]),
+        'employees': len(frames[0]),
+        'load_seconds': load_seconds,
+        'sql': sql,
+        'python': python,
+    }
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'],
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline):
+    # Prints current/baseline median ratios for every step both runs timed
+    for size, current in results['sizes'].items():
+        previous = baseline['sizes'].get(size)
+        if previous is None:
+            continue
+        print(f"\n{size} rows vs baseline ({baseline['meta'].get('revision')})")
+        for group in ('sql', 'python'):
+            for name, timing in current[group].items():
+                before = previous[group].get(name)
+                if before is None or not before['median_seconds']:
+                    continue
+                ratio = timing['median_seconds'] / before['median_seconds']
+                flag = '  REGRESSION' if ratio > 1 + results['meta']['tolerance'] else ''
+                print(f"  {group}:{name:<52} {before['median_seconds']:.4f}s -> "
+                      f"{timing['median_seconds']:.4f}s ({ratio:.2f}x){flag}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark report queries and transformations")
+    parser.add_argument('--sizes', type=lambda value: [int(size) for size in value.split(',')],
+                        default=DEFAULT_SIZES, help='comma-separated stage row counts')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--transport', choices=['fetch', 'copy'], default='fetch')
+    parser.add_argument('--output', help='write results as JSON to this file')
+    parser.add_argument('--baseline', help='JSON results of an earlier run to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.1,
+                        help='slowdown ratio above which a step is flagged as a regression')
+    synthetic_data.add_generator_arguments(parser)
+    args = parser.parse_args()
+
+    results = {
+        'meta': {
+            'revision': git_revision(),
+            'started_at': pd.Timestamp.now().isoformat(),
+            'python': platform.python_version(),
+            'pandas': pd.__version__,
+            'repeat': args.repeat,
+            'transport': args.transport,
+            'tolerance': args.tolerance,
+            'generator': synthetic_data.generator_options(args),
+        },
+        'sizes': {},
+    }
+    for i, rows in enumerate(args.sizes):
+        # Later sizes replace the tables this run loaded itself
+        results['sizes'][str(rows)] = size_results = run_size(rows, args, reset=args.reset or i > 0)
+        print(f"{rows} rows: loaded {size_results['stage_rows']} stage rows in {size_results['load_seconds']:.1f}s")
+        for group in ('sql', 'python'):
+            for name, timing in size_results[group].items():
+                print(f"  {group}:{name:<52} {timing['median_seconds']:.4f}s")
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            compare(results, json.load(f))
+
+
+if __name__ == '__main__':
+    main()
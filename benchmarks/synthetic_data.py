@@ -0,0 +1,181 @@
+# Synthetic stage history with the same shape as production:
+# client_stage_progression (client_id, current_stage, stage_name, created_on),
+# client (id, fullname, assigned_employee) and employee (id, fullname).
+# Load it into a scratch database only, e.g.
+#   DATABASE_URL=postgresql://localhost/homeeasy_bench python -m benchmarks.synthetic_data --rows 100000 --reset
+import argparse
+import io
+from contextlib import closing
+
+import numpy as np
+import pandas as pd
+import psycopg2
+
+import db
+from low_sales_progression import LOW_PROGRESSION_EMPLOYEE_IDS
+from stages import STAGE_NAMES
+
+# Share of clients whose furthest stage is 1..9. Roughly what production
+# looks like: most leads stall early, a few reach commission.
+DEFAULT_STAGE_WEIGHTS = [0.10, 0.25, 0.20, 0.15, 0.10, 0.07, 0.05, 0.05, 0.03]
+
+SCHEMA = """
+    CREATE TABLE public.employee (
+        id integer PRIMARY KEY,
+        fullname text
+    );
+    CREATE TABLE public.client (
+        id integer PRIMARY KEY,
+        fullname text,
+        assigned_employee integer REFERENCES public.employee (id)
+    );
+    CREATE TABLE public.client_stage_progression (
+        client_id integer REFERENCES public.client (id),
+        current_stage integer,
+        stage_name text,
+        created_on timestamp
+    );
+"""
+
+TABLES = ['client_stage_progression', 'client', 'employee']
+
+
+def generate(rows, mean_history=5.0, employees=50, stage_weights=None, days=30,
+             recent_share=0.2, seed=0, now=None):
+    # Returns (employees, clients, stage_rows) frames with about `rows` stage
+    # rows. History lengths are 1 + Poisson(mean_history - 1); each client
+    # climbs from stage 1 towards a final stage drawn from stage_weights, with
+    # exponential gaps between changes. recent_share of the clients changed
+    # stage in the last 24 hours so the windowed reports have data.
+    rng = np.random.default_rng(seed)
+    now = pd.Timestamp.now().floor('s') if now is None else pd.Timestamp(now)
+    weights = np.asarray(stage_weights or DEFAULT_STAGE_WEIGHTS, dtype=float)
+    weights /= weights.sum()
+
+    client_count = max(1, int(round(rows / mean_history)))
+    lengths = 1 + rng.poisson(max(mean_history - 1, 0), client_count)
+    client_ids = np.arange(1, client_count + 1)
+    final_stage = rng.choice(np.arange(1, len(weights) + 1), size=client_count, p=weights)
+
+    employee_ids = np.union1d(np.arange(1, employees + 1), LOW_PROGRESSION_EMPLOYEE_IDS)
+    employee_frame = pd.DataFrame({
+        'id': employee_ids,
+        'fullname': [f'Employee {i}' for i in employee_ids],
+    })
+    client_frame = pd.DataFrame({
+        'id': client_ids,
+        'fullname': [f'Client {i}' for i in client_ids],
+        'assigned_employee': rng.choice(employee_ids, client_count),
+    })
+
+    # One row per stage change; stages are non-decreasing within a client
+    # and its last row is the client's final stage
+    row_client = np.repeat(np.arange(client_count), lengths)
+    stage = 1 + (rng.random(len(row_client)) * final_stage[row_client]).astype(np.int64)
+    order = np.lexsort((stage, row_client))
+    stage = stage[order]
+    last_row = np.cumsum(lengths) - 1
+    stage[last_row] = final_stage
+
+    # Hours before the client's last change, counted back with exponential gaps
+    gaps = rng.exponential(days * 24 / (2 * mean_history), len(row_client))
+    gaps[last_row] = 0
+    reverse_cumsum = np.cumsum(gaps[::-1])[::-1]
+    client_end = np.concatenate([reverse_cumsum[1:], [0.0]])[last_row]
+    hours_before_last = reverse_cumsum - client_end[row_client]
+    recent = rng.random(client_count) < recent_share
+    last_change_age = np.where(recent, rng.uniform(0, 23, client_count), rng.uniform(24, days * 24, client_count))
+    age_hours = last_change_age[row_client] + hours_before_last
+
+    stage_frame = pd.DataFrame({
+        'client_id': client_ids[row_client],
+        'current_stage': stage,
+        'stage_name': pd.Series(stage).map(STAGE_NAMES).values,
+        'created_on': (now - pd.to_timedelta(age_hours, unit='h')).round('us'),
+    })
+    return employee_frame, client_frame, stage_frame
+
+
+def copy_frame(cursor, table, frame):
+    buffer = io.StringIO()
+    frame.to_csv(buffer, index=False, header=False)
+    buffer.seek(0)
+    cursor.copy_expert(f"COPY public.{table} ({', '.join(frame.columns)}) FROM STDIN WITH (FORMAT csv)", buffer)
+
+
+def existing_tables(cursor):
+    cursor.execute("SELECT to_regclass(%s), to_regclass(%s), to_regclass(%s)",
+                   [f'public.{table}' for table in TABLES])
+    return [name for name in cursor.fetchone() if name]
+
+
+def load(frames, reset=False):
+    # Replaces the three tables with the generated frames. Without reset it
+    # refuses to touch a database that already has any of them, so it can't
+    # wipe a real one by accident.
+    employee_frame, client_frame, stage_frame = frames
+
+    def handler(cursor):
+        found = existing_tables(cursor)
+        if found and not reset:
+            raise RuntimeError(f"{', '.join(found)} already exist; pass --reset to replace them")
+        cursor.execute(f"DROP TABLE IF EXISTS {', '.join(f'public.{table}' for table in TABLES)}")
+        cursor.execute(SCHEMA)
+        copy_frame(cursor, 'employee', employee_frame)
+        copy_frame(cursor, 'client', client_frame)
+        copy_frame(cursor, 'client_stage_progression', stage_frame)
+        cursor.connection.commit()
+
+    db.with_cursor(handler)
+
+    # ANALYZE can't run inside the pool's transaction
+    with closing(psycopg2.connect(**db.get_db_params())) as connection:
+        connection.autocommit = True
+        with connection.cursor() as cursor:
+            for table in TABLES:
+                cursor.execute(f"ANALYZE public.{table}")
+
+
+def stage_weights_arg(value):
+    weights = [float(weight) for weight in value.split(',')]
+    if len(weights) != len(STAGE_NAMES):
+        raise argparse.ArgumentTypeError(f"expected {len(STAGE_NAMES)} comma-separated weights")
+    return weights
+
+
+def add_generator_arguments(parser):
+    parser.add_argument('--mean-history', type=float, default=5.0, help='average stage rows per client')
+    parser.add_argument('--employees', type=int, default=50)
+    parser.add_argument('--stage-weights', type=stage_weights_arg,
+                        help='share of clients ending in stages 1..9, comma-separated')
+    parser.add_argument('--days', type=int, default=30, help='how far back the history goes')
+    parser.add_argument('--recent-share', type=float, default=0.2,
+                        help='share of clients with a stage change in the last 24 hours')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--reset', action='store_true', help='drop existing tables first')
+
+
+def generator_options(args):
+    return {
+        'mean_history': args.mean_history,
+        'employees': args.employees,
+        'stage_weights': args.stage_weights,
+        'days': args.days,
+        'recent_share': args.recent_share,
+        'seed': args.seed,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load synthetic stage history into Postgres")
+    parser.add_argument('--rows', type=int, default=100000, help='approximate stage rows')
+    add_generator_arguments(parser)
+    args = parser.parse_args()
+
+    frames = generate(args.rows, **generator_options(args))
+    load(frames, reset=args.reset)
+    print(f"Loaded {len(frames[0])} employees, {len(frames[1])} clients, {len(frames[2])} stage rows")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,115 @@
+import hashlib
+import io
+import sys
+import threading
+from collections import OrderedDict
+
+import pandas as pd
+import streamlit as st
+
+from config import get_setting
+from instrumentation import timed
+
+# Same savefig defaults st.pyplot uses
+SAVEFIG_OPTIONS = {'bbox_inches': 'tight', 'dpi': 200}
+
+
+class ChartCache:
+    # Rendered chart images keyed by chart name and a hash of the input data,
+    # so identical data is never rasterized twice. Bounded LRU by entry count.
+    def __init__(self, max_entries=64):
+        self.max_entries = max_entries
+        self._images = OrderedDict()
+        self._lock = threading.Lock()
+        self.renders = 0
+        self.hits = 0
+
+    def get(self, key):
+        with self._lock:
+            image = self._images.get(key)
+            if image is not None:
+                self._images.move_to_end(key)
+                self.hits += 1
+            return image
+
+    def put(self, key, image):
+        with self._lock:
+            self.renders += 1
+            self._images[key] = image
+            self._images.move_to_end(key)
+            while len(self._images) > self.max_entries:
+                self._images.popitem(last=False)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'entries': len(self._images),
+                'bytes': sum(len(image) for image in self._images.values()),
+                'renders': self.renders,
+                'hits': self.hits,
+            }
+
+
+@st.cache_resource(show_spinner=False)
+def get_chart_cache():
+    return ChartCache(max_entries=int(get_setting("CHART_CACHE_SIZE", 64)))
+
+
+def data_fingerprint(data):
+    digest = hashlib.sha1()
+    digest.update(repr(list(data.columns) if isinstance(data, pd.DataFrame) else data.name).encode())
+    digest.update(repr(list(data.index.names)).encode())
+    digest.update(pd.util.hash_pandas_object(data, index=True).values.tobytes())
+    return digest.hexdigest()
+
+
+def open_figure_count():
+    # Figures still registered with pyplot (pandas imports it for plotting).
+    # Charts drawn through render_chart never register, so this should stay 0.
+    pyplot = sys.modules.get('matplotlib.pyplot')
+    return len(pyplot.get_fignums()) if pyplot else 0
+
+
+def chart_metrics():
+    return {'open_figures': open_figure_count(), **get_chart_cache().stats()}
+
+
+def rotate_xticklabels(ax, rotation=45, fontsize=None):
+    for label in ax.get_xticklabels():
+        label.set_rotation(rotation)
+        label.set_horizontalalignment('right')
+        if fontsize:
+            label.set_fontsize(fontsize)
+
+
+def rasterize(data, draw, figsize=None, image_format="png"):
+    # draw(ax, data) fills in a fresh Axes. The figure is created outside
+    # pyplot's global registry and cleared as soon as it is rasterized, so
+    # reruns cannot leak figures. matplotlib is imported on the first chart
+    # drawn, not with the report modules (the snapshot build imports them all).
+    import matplotlib
+    matplotlib.use("Agg")  # charts are only rendered to images; skip GUI backend detection
+    from matplotlib.figure import Figure
+
+    fig = Figure(figsize=figsize)
+    try:
+        draw(fig.subplots(), data)
+        buffer = io.BytesIO()
+        fig.savefig(buffer, format=image_format, **SAVEFIG_OPTIONS)
+        return buffer.getvalue()
+    finally:
+        fig.clear()
+
+
+def render_chart(name, data, draw, figsize=None):
+    image_format = get_setting("CHART_FORMAT", "png")
+    with timed(f"chart.{name}", kind="chart") as event:
+        key = (name, data_fingerprint(data), figsize, image_format)
+        cache = get_chart_cache()
+        image = cache.get(key)
+        event['cached'] = image is not None
+        if image is None:
+            image = rasterize(data, draw, figsize, image_format)
+            cache.put(key, image)
+        event['bytes'] = len(image)
+        st.image(image.decode() if image_format == 'svg' else image, width="stretch")
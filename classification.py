@@ -0,0 +1,81 @@
+import numpy as np
+import pandas as pd
+
+import stage_history
+from config import get_setting
+from stages import FINAL_STAGE
+
+NORMAL = 'NORMAL CLIENT'
+NOT_NORMAL = 'NOT NORMAL CLIENT'
+
+# Statistic over the durations of clients that reached the final stage
+THRESHOLD_STATISTICS = ('mean', 'median', 'p75')
+
+
+def client_durations(history, clients=None):
+    # One row per client: stage of its last row and first-to-last duration
+    # over its full history, in a single pass over the rows. history needs
+    # client_id, current_stage and time_entered_stage (plus the optional
+    # stage_number); names come from clients when history lacks them.
+    history = stage_history.client_ordered(history)
+    ids = history['client_id'].to_numpy()
+    starts, ends = stage_history.client_bounds(ids)
+    times = history['time_entered_stage']
+    first = times.iloc[starts].reset_index(drop=True)
+    last = times.iloc[ends].reset_index(drop=True)
+    durations = pd.DataFrame({
+        'client_id': ids[starts],
+        'current_stage': history['current_stage'].to_numpy()[ends],
+        'first_stage_time': first,
+        'last_stage_time': last,
+        'time_diff_hours': (last - first).dt.total_seconds() / 3600,
+    })
+
+    if clients is None:
+        for column in ('client_name', 'employee_name'):
+            durations[column] = history[column].iloc[ends].reset_index(drop=True)
+    else:
+        names = clients.drop_duplicates('client_id', keep='last').set_index('client_id')
+        for column in ('client_name', 'employee_name'):
+            durations[column] = durations['client_id'].map(names[column])
+    return durations
+
+
+def aggregate(values, statistic):
+    # values is a Series or a SeriesGroupBy
+    if statistic == 'p75':
+        return values.quantile(0.75)
+    return getattr(values, statistic)()
+
+
+def thresholds(durations, statistic='mean', per_employee=False):
+    # Threshold hours for each client: the statistic over finished clients,
+    # either overall or per employee (falling back to the overall value for
+    # employees without a finished client)
+    if statistic not in THRESHOLD_STATISTICS:
+        raise ValueError(f"unknown threshold statistic {statistic!r}; expected one of {THRESHOLD_STATISTICS}")
+    finished = durations.loc[durations['current_stage'] == FINAL_STAGE, ['employee_name', 'time_diff_hours']]
+    overall = aggregate(finished['time_diff_hours'], statistic) if len(finished) else np.nan
+    if not per_employee:
+        return pd.Series(overall, index=durations.index, dtype='float64')
+    by_employee = aggregate(finished.groupby('employee_name', observed=True)['time_diff_hours'], statistic)
+    return durations['employee_name'].map(by_employee).astype('float64').fillna(overall)
+
+
+def classify(durations, statistic=None, per_employee=None):
+    # NORMAL: finished (final stage) no slower than the threshold. All
+    # clients come back in one frame, with the numbers behind the decision.
+    if statistic is None:
+        statistic = get_setting("CLASSIFICATION_THRESHOLD", "mean")
+    if per_employee is None:
+        per_employee = get_setting("CLASSIFICATION_PER_EMPLOYEE", False)
+    threshold = thresholds(durations, statistic, per_employee)
+    normal = (durations['current_stage'] == FINAL_STAGE).to_numpy() & (durations['time_diff_hours'] <= threshold).to_numpy()
+    return pd.DataFrame({
+        'client_id': durations['client_id'],
+        'client_name': durations['client_name'],
+        'employee_name': durations['employee_name'],
+        'client_status': np.where(normal, NORMAL, NOT_NORMAL),
+        'time_diff_hours': durations['time_diff_hours'],
+        'threshold_hours': threshold,
+    })
@@ -0,0 +1,49 @@
+import streamlit as st
+import stage_history
+from filters import filter_sidebar, get_index_cache
+from instrumentation import timed
+from pagination import paged_dataframe
+from schema import with_fub_links
+from stages import STAGE_NAMES, stage_name
+
+
+def latest_matching_rows(rows):
+    # Each client's last stage change among the filtered rows
+    rows = stage_history.client_ordered(rows)
+    _, ends = stage_history.client_bounds(rows['client_id'].to_numpy())
+    return rows.iloc[ends].reset_index(drop=True)
+
+
+def show_client_explorer():
+    st.title("Client Explorer")
+    st.markdown("Stage changes matching the sidebar filters, from the already loaded stage history")
+
+    with timed('client_explorer.load'):
+        history = stage_history.load_stage_history()
+    if history is None:
+        return
+
+    # Indexes are built once per loaded history; every widget change after
+    # that only slices them
+    index = get_index_cache().get(history)
+    filters = filter_sidebar(index, 'explorer')
+    with timed('client_explorer.filter', kind='transform') as event:
+        rows = index.filter(filters)
+        clients = latest_matching_rows(rows)
+        event['rows'] = len(rows)
+
+    st.write(f"{len(rows)} stage changes by {len(clients)} clients")
+    if clients.empty:
+        return
+
+    with timed('client_explorer.render.clients'):
+        st.subheader("Clients (latest matching stage change)")
+        table = clients[['client_id', 'client_name', 'employee_name', 'current_stage', 'time_entered_stage']]
+        paged_dataframe(table, 'explorer_clients',
+                        display=lambda rows: with_fub_links(rows.assign(current_stage=stage_name(rows['current_stage']))))
+
+    with timed('client_explorer.render.employee_stage_table'):
+        st.subheader("Clients per Employee and Stage")
+        counts = clients.pivot_table(index='employee_name', columns='current_stage', aggfunc='size',
+                                     fill_value=0, observed=True)
+        st.dataframe(counts.rename(columns=STAGE_NAMES))
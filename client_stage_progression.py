@@ -1,44 +1,43 @@
 import streamlit as st
-import psycopg2
-import pandas as pd
-import matplotlib.pyplot as plt
 from datetime import datetime
+import stage_history
+from charts import render_chart, rotate_xticklabels
+from exports import export_buttons
+from instrumentation import timed
+from live_updates import live_section, register_view
+from pagination import paged_dataframe
+from queries import (DEFAULT_WINDOW, REPORT_WINDOWS, WINDOW_LABELS, cached_report_query, register_query,
+                     select_window, window_bounds)
+from query_graph import QueryTask, run_query_graph
+from schema import with_fub_links
+from snapshots import report_datasets
+from stages import STAGE_NAMES, stage_name
 
-def show_client_stage_progression():
-    st.title("Client Stage Progression Report")
+# Window bounds are bind parameters (see queries.py); a NULL window_end is open-ended
+FETCH_LEADS_STAGE_4_AND_BEYOND_QUERY = register_query('client_stage_progression.leads_stage_4_and_beyond', """
+    SELECT 
+        csp.client_id,
+        c.fullname AS client_name,
+        e.fullname AS employee_name,
+        MAX(csp.current_stage) AS current_stage,
+        MAX(csp.created_on) AS time_entered_stage
+    FROM 
+        public.client_stage_progression csp
+    JOIN 
+        public.client c ON csp.client_id = c.id
+    JOIN 
+        public.employee e ON c.assigned_employee = e.id
+    WHERE 
+        csp.current_stage >= 4
+        AND csp.created_on >= %(window_start)s
+        AND csp.created_on < COALESCE(%(window_end)s, 'infinity')
+    GROUP BY 
+        csp.client_id, c.fullname, e.fullname
+    ORDER BY 
+        csp.client_id;
+""", window_start='timestamptz', window_end='timestamptz')
 
-    db_params = {
-        'dbname': st.secrets["database"]["DB_NAME"],
-        'user': st.secrets["database"]["DB_USER"],
-        'password': st.secrets["database"]["DB_PASSWORD"],
-        'host': st.secrets["database"]["DB_HOST"],
-        'port': st.secrets["database"]["DB_PORT"]
-    }
-    
-    fetch_leads_stage_4_and_beyond_query = """
-        SELECT 
-            csp.client_id,
-            c.fullname AS client_name,
-            e.fullname AS employee_name,
-            MAX(csp.current_stage) AS current_stage,
-            MAX(csp.created_on) AS time_entered_stage,
-            CONCAT('https://services.followupboss.com/2/people/view/', csp.client_id) AS followup_boss_link
-        FROM 
-            public.client_stage_progression csp
-        JOIN 
-            public.client c ON csp.client_id = c.id
-        JOIN 
-            public.employee e ON c.assigned_employee = e.id
-        WHERE 
-            csp.current_stage >= 4
-            AND csp.created_on >= NOW() - INTERVAL '24 hours'
-        GROUP BY 
-            csp.client_id, c.fullname, e.fullname
-        ORDER BY 
-            csp.client_id;
-    """
-
-    fetch_sales_reps_count_query = """
+FETCH_SALES_REPS_COUNT_QUERY = register_query('client_stage_progression.sales_reps_count', """
     WITH latest_stage_progression AS (
     SELECT 
         csp.client_id,
@@ -52,7 +51,8 @@ def show_client_stage_progression():
         public.employee e ON c.assigned_employee = e.id
     WHERE 
         csp.current_stage >= 4
-        AND csp.created_on >= NOW() - INTERVAL '24 hours'
+        AND csp.created_on >= %(window_start)s
+        AND csp.created_on < COALESCE(%(window_end)s, 'infinity')
     GROUP BY 
         csp.client_id, e.fullname
     )
@@ -66,97 +66,121 @@ def show_client_stage_progression():
         employee_name, date_moved
     ORDER BY 
         date_moved DESC, count_of_leads DESC;
-    """
-
-    def fetch_data(query):
-        connection = None
-        cursor = None
-        try:
-            connection = psycopg2.connect(**db_params)
-            cursor = connection.cursor()
-            cursor.execute(query)
-            records = cursor.fetchall()
-            column_names = [desc[0] for desc in cursor.description]
-            df = pd.DataFrame(records, columns=column_names)
-            
-            return df
-            
-        except Exception as error:
-            st.error(f"Error fetching records: {error}")
-        finally:
-            if cursor:
-                cursor.close()
-            if connection:
-                connection.close()
+""", window_start='timestamptz', window_end='timestamptz')
+
+
+def leads_in_window(history, window=DEFAULT_WINDOW):
+    # Clients in Property Touring and beyond, over the window's stage rows
+    since = stage_history.window_start(history, window=REPORT_WINDOWS[window])
+    return stage_history.clients_in_window(history, since, min_stage=4)
+
+
+# Kept current in live mode from the default window's stage rows
+register_view('client_stage_progression.leads_data', 'recent', leads_in_window)
+register_view('client_stage_progression.sales_reps_data', 'recent',
+              lambda recent: stage_history.leads_moved_per_employee(leads_in_window(recent)))
+
+
+def load_client_stage_progression_data(window=DEFAULT_WINDOW):
+    if stage_history.use_replica():
+        # Same aggregations, computed from the local replica's stage history
+        history = stage_history.load_stage_history()
+        if history is None:
+            return {'leads_data': None, 'sales_reps_data': None}
+        with timed('client_stage_progression.transform.clients_in_window', kind='transform'):
+            leads_data = leads_in_window(history, window)
+        with timed('client_stage_progression.transform.leads_moved_per_employee', kind='transform'):
+            sales_reps_data = stage_history.leads_moved_per_employee(leads_data)
+        return {'leads_data': leads_data, 'sales_reps_data': sales_reps_data}
+
+    # The two queries are independent and run side by side
+    params = window_bounds(window)
+    return run_query_graph({
+        'leads_data': QueryTask(lambda: cached_report_query(FETCH_LEADS_STAGE_4_AND_BEYOND_QUERY, params)),
+        'sales_reps_data': QueryTask(lambda: cached_report_query(FETCH_SALES_REPS_COUNT_QUERY, params)),
+    })
+
+
+def show_client_stage_progression():
+    st.title("Client Stage Progression Report")
 
     def plot_leads_stage_4_and_beyond(df):
         st.subheader("Bar Chart of Clients in Property Touring and Beyond")
-        fig, ax = plt.subplots(figsize=(14, 8)) 
 
         # Check if the DataFrame is empty
         if df.empty:
             st.write("No data available for the selected period.")
             return
 
-        # Map stage numbers to names
-        stage_mapping = {
-            4: 'Stage 4: Property Touring',
-            5: 'Stage 5: Property Tour and Feedback',
-            6: 'Stage 6: Application and Approval',
-            7: 'Stage 7: Post-Approval and Follow-Up',
-            8: 'Stage 8: Commission Collection'
-        }
-        
-        df['stage_name'] = df['current_stage'].map(stage_mapping)
-
-        # Group by stage_name and count the number of clients in each stage
-        stage_counts = df['stage_name'].value_counts().sort_index()
+        # Group by stage name and count the number of clients in each stage
+        stage_counts = stage_name(df['current_stage']).rename('stage_name').value_counts().sort_index()
 
         # Plot the bar chart
-        stage_counts.plot(kind='bar', ax=ax)
-        ax.set_xlabel('Stage', fontsize=12)
-        ax.set_ylabel('Number of Clients', fontsize=12)
-        ax.set_title('Clients in Property Touring and Beyond', fontsize=16)
-        ax.set_xticklabels(ax.get_xticklabels(), rotation=45, ha='right', fontsize=10)
-        st.pyplot(fig)
+        def draw(ax, stage_counts):
+            stage_counts.plot(kind='bar', ax=ax)
+            ax.set_xlabel('Stage', fontsize=12)
+            ax.set_ylabel('Number of Clients', fontsize=12)
+            ax.set_title('Clients in Property Touring and Beyond', fontsize=16)
+            rotate_xticklabels(ax, fontsize=10)
+
+        render_chart('leads_stage_4_and_beyond', stage_counts, draw, figsize=(14, 8))
     
     def plot_sales_reps_moving_leads(df):
         st.subheader("Graph: Sales Reps Moving Leads to Property Touring and Beyond")
-        fig, ax = plt.subplots(figsize=(14, 8)) 
         pivot_data = df.pivot(index='date_moved', columns='employee_name', values='count_of_leads').fillna(0)
-        pivot_data.plot(kind='bar', stacked=True, ax=ax)
-        ax.set_xlabel('Date', fontsize=12)
-        ax.set_ylabel('Number of Leads', fontsize=12)
-        ax.set_title('Sales Reps Moving Leads to Property Touring and Beyond', fontsize=16)
-        plt.xticks(rotation=45, ha='right', fontsize=10)
-        plt.yticks(fontsize=10)
-        ax.legend(loc='center left', bbox_to_anchor=(1.0, 0.5), fontsize=10) 
-        st.pyplot(fig)
+
+        def draw(ax, pivot_data):
+            pivot_data.plot(kind='bar', stacked=True, ax=ax)
+            ax.set_xlabel('Date', fontsize=12)
+            ax.set_ylabel('Number of Leads', fontsize=12)
+            ax.set_title('Sales Reps Moving Leads to Property Touring and Beyond', fontsize=16)
+            rotate_xticklabels(ax, fontsize=10)
+            ax.tick_params(axis='y', labelsize=10)
+            ax.legend(loc='center left', bbox_to_anchor=(1.0, 0.5), fontsize=10)
+
+        render_chart('sales_reps_moving_leads', pivot_data, draw, figsize=(14, 8))
     
     def create_employee_stage_table(df):
         st.subheader("Number of Clients in Each Stage per Employee")
-        pivot_df = df.pivot_table(index='employee_name', columns='current_stage', aggfunc='size', fill_value=0)
-        pivot_df = pivot_df.rename(columns={4: 'Stage 4: Property Touring', 5: 'Stage 5: Property Tour and Feedback', 6: 'Stage 6: Application and Approval', 7: 'Stage 7: Post-Approval and Follow-Up', 8: 'Stage 8: Commission Collection'})
+        pivot_df = df.pivot_table(index='employee_name', columns='current_stage', aggfunc='size', fill_value=0, observed=True)
+        pivot_df = pivot_df.rename(columns=STAGE_NAMES)
         st.dataframe(pivot_df)
 
     # The "Show Data / Refresh Data" button is not needed since the page refreshes automatically
+    window = select_window()
     today = datetime.today().strftime('%Y-%m-%d')
-    st.markdown(f"**DATE: {today}** (This report contains data from the last 24 hours)")
+    st.markdown(f"**DATE: {today}** (This report contains data from the {WINDOW_LABELS[window]})")
 
-    leads_data = fetch_data(fetch_leads_stage_4_and_beyond_query)
+    with timed('client_stage_progression.load'):
+        datasets = report_datasets('client_stage_progression', load_client_stage_progression_data, window=window)
+    leads_data = datasets.get('leads_data')
+    sales_reps_data = datasets.get('sales_reps_data')
 
-    if leads_data is not None:
-        st.subheader("Leads in Property Touring and Beyond")
-        st.dataframe(leads_data)
-        st.write(f"Total leads in Property Touring and beyond: {len(leads_data)}")
-        
-        plot_leads_stage_4_and_beyond(leads_data)
-        create_employee_stage_table(leads_data)
+    def show_leads(leads_data):
+        with timed('client_stage_progression.render.leads_table'):
+            st.subheader("Leads in Property Touring and Beyond")
+            paged_dataframe(leads_data, 'csp_leads', display=with_fub_links)
+            st.write(f"Total leads in Property Touring and beyond: {len(leads_data)}")
+            export_buttons(leads_data, 'leads', transform=with_fub_links)
+
+        with timed('client_stage_progression.render.leads_chart'):
+            plot_leads_stage_4_and_beyond(leads_data)
+        with timed('client_stage_progression.render.employee_stage_table'):
+            create_employee_stage_table(leads_data)
 
-    sales_reps_data = fetch_data(fetch_sales_reps_count_query)
+    def show_sales_reps(sales_reps_data):
+        with timed('client_stage_progression.render.sales_reps_table'):
+            st.subheader("Sales Reps Moving Leads to Property Touring and Beyond")
+            st.dataframe(sales_reps_data)
+            st.write(f"Total entries: {len(sales_reps_data)}")
+            export_buttons(sales_reps_data, 'sales_reps')
+        with timed('client_stage_progression.render.sales_reps_chart'):
+            plot_sales_reps_moving_leads(sales_reps_data)
+
+    # In live mode the default window's sections follow new stage rows
+    live = window == DEFAULT_WINDOW
+    if leads_data is not None:
+        live_section('client_stage_progression.leads_data', leads_data, show_leads, enabled=live)
 
     if sales_reps_data is not None:
-        st.subheader("Sales Reps Moving Leads to Property Touring and Beyond")
-        st.dataframe(sales_reps_data)
-        st.write(f"Total entries: {len(sales_reps_data)}")
-        plot_sales_reps_moving_leads(sales_reps_data)
\ No newline at end of file
+        live_section('client_stage_progression.sales_reps_data', sales_reps_data, show_sales_reps, enabled=live)
\ No newline at end of file
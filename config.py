@@ -0,0 +1,11 @@
+import streamlit as st
+
+
+def get_setting(name, default=None):
+    # Optional tuning knobs live in the [dashboard] section of secrets.toml,
+    # next to the [database] credentials. Missing keys fall back to the default.
+    try:
+        section = st.secrets.get("dashboard", {})
+    except FileNotFoundError:
+        return default
+    return section.get(name, default)
@@ -0,0 +1,383 @@
+import io
+import os
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+import pandas as pd
+import psycopg2
+import streamlit as st
+from psycopg2 import extensions, pool
+
+from config import get_setting
+from instrumentation import frame_size, query_label, timed
+from query_cache import QueryCache
+from schema import ingest, ingest_chunks
+
+# Cheap change detector for the result cache: the stage table is append-only
+# in practice, so a new max(created_on) or row count means new data
+CHANGE_PROBE_QUERY = """
+    SELECT MAX(created_on), COUNT(*)
+    FROM public.client_stage_progression;
+"""
+
+
+class QueryTooLarge(Exception):
+    pass
+
+
+class CopyNotSupported(Exception):
+    pass
+
+
+def get_db_params():
+    # DATABASE_URL lets command-line tools (benchmarks, maintenance jobs)
+    # point the same code at another database without a secrets.toml
+    if os.environ.get("DATABASE_URL"):
+        return {'dsn': os.environ["DATABASE_URL"]}
+    return {
+        'dbname': st.secrets["database"]["DB_NAME"],
+        'user': st.secrets["database"]["DB_USER"],
+        'password': st.secrets["database"]["DB_PASSWORD"],
+        'host': st.secrets["database"]["DB_HOST"],
+        'port': st.secrets["database"]["DB_PORT"]
+    }
+
+
+class ConnectionPool:
+    # Up to max_connections connections, opened on demand and kept open
+    # between checkouts. Only broken connections are closed, plus those left
+    # idle longer than idle_timeout beyond the first min_connections.
+    def __init__(self, db_params, min_connections=1, max_connections=5,
+                 health_check_after=30.0, acquire_timeout=30.0, idle_timeout=600.0):
+        self._db_params = db_params
+        # Idle connections, most recently returned last
+        self._idle = []
+        self._lock = threading.Lock()
+        # Extra callers wait for a free slot instead of failing
+        self._slots = threading.BoundedSemaphore(max_connections)
+        # Keyed by the connection itself and dropped when it is closed, so a
+        # new connection never inherits a closed one's entries
+        self._last_used = {}
+        # Names of the statements PREPAREd on each connection (queries.py)
+        self._prepared = {}
+        self.min_connections = min_connections
+        self.max_connections = max_connections
+        self.health_check_after = health_check_after
+        self.acquire_timeout = acquire_timeout
+        self.idle_timeout = idle_timeout
+        for _ in range(min_connections):
+            self._idle.append(self._connect())
+
+    def _connect(self):
+        connection = psycopg2.connect(**self._db_params)
+        self._last_used[connection] = time.monotonic()
+        return connection
+
+    def _close(self, connection):
+        self._last_used.pop(connection, None)
+        self._prepared.pop(connection, None)
+        if not connection.closed:
+            try:
+                connection.close()
+            except psycopg2.Error:
+                pass
+
+    def _is_healthy(self, connection):
+        if connection.closed:
+            return False
+        last_used = self._last_used.get(connection)
+        if last_used is not None and time.monotonic() - last_used < self.health_check_after:
+            return True
+        # Idle for a while: make sure the server still answers
+        try:
+            with connection.cursor() as cursor:
+                cursor.execute("SELECT 1")
+            connection.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def _take_idle(self):
+        # The most recently returned connection, closing the ones idle too
+        # long on the way
+        expired = []
+        with self._lock:
+            now = time.monotonic()
+            while (len(self._idle) > self.min_connections
+                   and now - self._last_used.get(self._idle[0], now) > self.idle_timeout):
+                expired.append(self._idle.pop(0))
+            connection = self._idle.pop() if self._idle else None
+        for stale in expired:
+            self._close(stale)
+        return connection
+
+    def prepared_statements(self, connection):
+        return self._prepared.setdefault(connection, set())
+
+    def getconn(self):
+        # Timed including the wait for a free slot and any health checks
+        with timed("db.connect", kind="db"):
+            return self._getconn()
+
+    def _getconn(self):
+        if not self._slots.acquire(timeout=self.acquire_timeout):
+            raise pool.PoolError("timed out waiting for a free database connection")
+        try:
+            # Stale connections (server restart, idle timeout) are replaced; a
+            # full pool's worth of failures means the database itself is down
+            for _ in range(self.max_connections + 1):
+                connection = self._take_idle()
+                if connection is None:
+                    return self._connect()
+                if self._is_healthy(connection):
+                    return connection
+                self._close(connection)
+            raise psycopg2.OperationalError("could not obtain a healthy database connection")
+        except Exception:
+            self._slots.release()
+            raise
+
+    def putconn(self, connection):
+        close = bool(connection.closed)
+        if not close and connection.get_transaction_status() != extensions.TRANSACTION_STATUS_IDLE:
+            try:
+                connection.rollback()
+            except psycopg2.Error:
+                close = True
+        if close:
+            self._close(connection)
+        else:
+            with self._lock:
+                self._last_used[connection] = time.monotonic()
+                self._idle.append(connection)
+        self._slots.release()
+
+    @contextmanager
+    def connection(self):
+        connection = self.getconn()
+        try:
+            yield connection
+        finally:
+            self.putconn(connection)
+
+    def closeall(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for connection in idle:
+            self._close(connection)
+
+
+# One pool per server process, shared by every session and rerun
+@st.cache_resource(show_spinner=False)
+def get_pool():
+    return ConnectionPool(
+        get_db_params(),
+        min_connections=int(get_setting("POOL_MIN_CONNECTIONS", 1)),
+        max_connections=int(get_setting("POOL_MAX_CONNECTIONS", 5)),
+        health_check_after=float(get_setting("POOL_HEALTH_CHECK_SECONDS", 30)),
+        acquire_timeout=float(get_setting("POOL_ACQUIRE_TIMEOUT_SECONDS", 30)),
+        idle_timeout=float(get_setting("POOL_IDLE_TIMEOUT_SECONDS", 600)),
+    )
+
+
+def with_cursor(handler):
+    # A connection can still die between the health check and the query;
+    # retry once on a fresh one in that case
+    for attempt in range(2):
+        with get_pool().connection() as connection:
+            try:
+                with connection.cursor() as cursor:
+                    return handler(cursor)
+            except (psycopg2.OperationalError, psycopg2.InterfaceError):
+                if attempt or not connection.closed:
+                    raise
+
+
+def iter_query_batches(query, params=None, batch_size=10000, max_rows=None):
+    # Streams rows through a named (server-side) cursor so only one batch of
+    # tuples is held in Python at a time. Yields (column_names, rows).
+    with get_pool().connection() as connection:
+        with connection.cursor(name=f"stream_{uuid.uuid4().hex}") as cursor:
+            cursor.itersize = batch_size
+            cursor.execute(query, params)
+            total = 0
+            while True:
+                rows = cursor.fetchmany(batch_size)
+                total += len(rows)
+                if max_rows is not None and total > max_rows:
+                    raise QueryTooLarge(f"query returned more than {max_rows} rows")
+                column_names = [desc[0] for desc in cursor.description]
+                if not rows:
+                    if total == 0:
+                        yield column_names, rows
+                    break
+                yield column_names, rows
+
+
+def iter_query_chunks(query, params=None, batch_size=10000, max_rows=None):
+    # DataFrame per batch, for consumers that aggregate as they go
+    for column_names, rows in iter_query_batches(query, params, batch_size, max_rows):
+        yield pd.DataFrame.from_records(rows, columns=column_names)
+
+
+# Postgres type OIDs that need more than pandas' default CSV inference
+INT_TYPES = {20, 21, 23}
+FLOAT_TYPES = {700, 701, 1700}
+BOOL_TYPES = {16}
+DATE_TYPES = {1082}
+TIMESTAMP_TYPES = {1114}
+TIMESTAMPTZ_TYPES = {1184}
+COPY_NULL = '\\N'
+
+
+def copy_select_list(columns, cursor):
+    # Dates and timestamps are sent as integers (days / epoch microseconds):
+    # far cheaper to parse than ISO text, and exact
+    expressions = []
+    for name, type_code in columns:
+        column = extensions.quote_ident(name, cursor)
+        if type_code in TIMESTAMP_TYPES or type_code in TIMESTAMPTZ_TYPES:
+            expressions.append(f"(EXTRACT(EPOCH FROM {column}) * 1000000)::bigint")
+        elif type_code in DATE_TYPES:
+            expressions.append(f"{column} - DATE '1970-01-01'")
+        elif type_code in BOOL_TYPES:
+            expressions.append(f"{column}::int")
+        else:
+            expressions.append(column)
+    return ", ".join(expressions)
+
+
+def read_copy_csv(buffer, columns):
+    # Parse COPY's CSV straight into the dtypes the regular fetch produces
+    names = [name for name, _ in columns]
+    numeric_types = INT_TYPES | FLOAT_TYPES | DATE_TYPES | TIMESTAMP_TYPES | TIMESTAMPTZ_TYPES | BOOL_TYPES
+    # Numeric columns are left to the C parser's own (fast) inference: int64,
+    # or float64 when the column has NULLs
+    dtypes = {name: str for name, type_code in columns if type_code not in numeric_types}
+    frame = pd.read_csv(buffer, names=names, header=None, dtype=dtypes,
+                        keep_default_na=False, na_values=[COPY_NULL])
+    for name, type_code in columns:
+        values = frame[name]
+        if type_code in TIMESTAMP_TYPES:
+            frame[name] = pd.to_datetime(values, unit='us')
+        elif type_code in TIMESTAMPTZ_TYPES:
+            frame[name] = pd.to_datetime(values, unit='us', utc=True)
+        elif type_code in DATE_TYPES:
+            frame[name] = pd.to_datetime(values, unit='D').dt.date
+        elif type_code in BOOL_TYPES:
+            frame[name] = values.astype('boolean') if values.hasnans else values.astype(bool)
+        elif type_code in INT_TYPES and values.hasnans:
+            frame[name] = values.astype('Int64')
+        elif type_code in FLOAT_TYPES:
+            frame[name] = values.astype('float64')
+    return frame
+
+
+def run_query_copy(query, params=None, max_rows=None):
+    # COPY (query) TO STDOUT lets Postgres render the whole result as CSV in
+    # one stream, skipping psycopg2's per-row tuple conversion. The CSV
+    # text is much smaller than the equivalent list of Python tuples.
+    def handler(cursor):
+        sql = cursor.mogrify(query, params).decode() if params is not None else query
+        sql = sql.strip().rstrip(';')
+        cursor.execute(f"SELECT * FROM ({sql}) AS copy_source LIMIT 0")
+        columns = [(desc.name, desc.type_code) for desc in cursor.description]
+        if len({name for name, _ in columns}) != len(columns):
+            raise CopyNotSupported("duplicate output column names")
+        copy_sql = f"SELECT {copy_select_list(columns, cursor)} FROM ({sql}) AS copy_source"
+        with io.BytesIO() as buffer:
+            cursor.copy_expert(f"COPY ({copy_sql}) TO STDOUT WITH (FORMAT csv, NULL '{COPY_NULL}')", buffer)
+            buffer.seek(0)
+            frame = read_copy_csv(buffer, columns)
+        if max_rows is not None and len(frame) > max_rows:
+            raise QueryTooLarge(f"query returned more than {max_rows} rows")
+        return frame
+
+    return with_cursor(handler)
+
+
+def can_copy(query):
+    return query.lstrip().upper().startswith(("SELECT", "WITH"))
+
+
+def run_query(query, params=None, batch_size=None, max_rows=None, transport="fetch"):
+    label = query_label(query)
+    with timed(label, kind="query", transport=transport) as event:
+        return frame_size(event, read_query_frame(query, params, batch_size, max_rows, transport, label, event))
+
+
+def read_query_frame(query, params, batch_size, max_rows, transport, label, event):
+    # The result with compact dtypes (schema.ingest)
+    if transport == "copy" and can_copy(query):
+        try:
+            return ingest(run_query_copy(query, params, max_rows), event)
+        except (psycopg2.ProgrammingError, psycopg2.NotSupportedError, CopyNotSupported):
+            # Not every statement can be wrapped in COPY (...), e.g. duplicate
+            # output column names; use the regular fetch for those
+            pass
+
+    if batch_size:
+        # Chunks are built and compacted while streaming, so neither the full
+        # list of row tuples nor the uncompacted frame is ever held
+        return ingest_chunks(iter_query_chunks(query, params, batch_size, max_rows), event)
+
+    def handler(cursor):
+        with timed(f"{label}.execute", kind="db"):
+            cursor.execute(query, params)
+        with timed(f"{label}.fetch", kind="db") as event:
+            records = cursor.fetchall()
+            event['rows'] = len(records)
+        if max_rows is not None and len(records) > max_rows:
+            raise QueryTooLarge(f"query returned more than {max_rows} rows")
+        column_names = [desc[0] for desc in cursor.description]
+        with timed(f"{label}.frame", kind="db") as event:
+            return frame_size(event, pd.DataFrame(records, columns=column_names))
+
+    return ingest(with_cursor(handler), event)
+
+
+def probe_data_version():
+    def handler(cursor):
+        cursor.execute(CHANGE_PROBE_QUERY)
+        return cursor.fetchone()
+
+    return with_cursor(handler)
+
+
+# Results are shared by every session; entries expire after the TTL or as
+# soon as the change probe reports new data
+@st.cache_resource(show_spinner=False)
+def get_query_cache():
+    return QueryCache(
+        ttl=float(get_setting("QUERY_CACHE_TTL_SECONDS", 900)),
+        max_bytes=int(float(get_setting("QUERY_CACHE_MAX_MB", 256)) * 1024 * 1024),
+        probe=probe_data_version,
+        probe_interval=float(get_setting("QUERY_CACHE_PROBE_SECONDS", 60)),
+    )
+
+
+def large_result_settings():
+    # Fetch options for the big report queries: streaming batch size, row
+    # guard and transport ("fetch" or "copy")
+    max_rows = int(get_setting("STREAM_MAX_ROWS", 0))
+    return {
+        'batch_size': int(get_setting("STREAM_BATCH_SIZE", 10000)),
+        'max_rows': max_rows or None,
+        'transport': get_setting("LARGE_RESULT_TRANSPORT", "fetch"),
+    }
+
+
+def cached_query(query, params=None, **options):
+    # Timed separately from run_query, so cache hits show up as near-zero samples
+    with timed(f"{query_label(query)}.cached", kind="cache") as event:
+        frame = frame_size(event, get_query_cache().get_or_load(query, params, lambda: run_query(query, params, **options)))
+    # Callers add and rename columns; a shallow copy keeps the cached frame intact
+    return frame.copy(deep=False)
+
+
+def cached_scalar(query, params=None):
+    df = cached_query(query, params)
+    return df.iat[0, 0] if not df.empty else None
+
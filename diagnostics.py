@@ -0,0 +1,36 @@
+import pandas as pd
+import streamlit as st
+
+from charts import chart_metrics
+from db import get_query_cache
+from instrumentation import get_timing_stats
+from live_updates import get_listener, use_live_updates
+from schema import memory_report
+
+
+def show_diagnostics(run_id):
+    # Sidebar breakdown of where this page render spent its time, plus rolling
+    # p50/p95 per timer across every session of this server process
+    stats = get_timing_stats()
+    st.sidebar.subheader("Diagnostics")
+
+    events = pd.DataFrame(stats.run_events(run_id))
+    if not events.empty:
+        events = events.sort_values('at', kind='stable')
+        events['ms'] = events['seconds'] * 1000
+        columns = [column for column in ['name', 'kind', 'ms', 'rows', 'bytes', 'raw_bytes', 'compact_bytes', 'cached'] if column in events]
+        st.sidebar.caption("This render")
+        st.sidebar.dataframe(events[columns], hide_index=True)
+
+    st.sidebar.caption(f"Rolling stats (last {stats.window} samples per timer)")
+    st.sidebar.dataframe(pd.DataFrame(stats.summary()), hide_index=True)
+
+    caches = {
+        'query_cache': get_query_cache().stats(),
+        'charts': chart_metrics(),
+        'compact_dtypes': memory_report.stats(),
+    }
+    if use_live_updates():
+        caches['live_updates'] = get_listener().stats()
+    st.sidebar.caption("Caches")
+    st.sidebar.json(caches, expanded=False)
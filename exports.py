@@ -0,0 +1,75 @@
+import tempfile
+from datetime import datetime
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+import streamlit as st
+
+from config import get_setting
+from instrumentation import timed
+
+
+def export_chunk_rows():
+    return int(get_setting("EXPORT_CHUNK_ROWS", 50000))
+
+
+def chunks(frame, chunk_rows, transform=None):
+    # Row slices of frame (views, not copies), each passed through transform
+    # (e.g. adding FUB links) so derived columns exist for one chunk at a time
+    for start in range(0, max(len(frame), 1), chunk_rows):
+        chunk = frame.iloc[start:start + chunk_rows]
+        yield chunk if transform is None else transform(chunk)
+
+
+def write_csv(frame, f, chunk_rows, transform=None):
+    for number, chunk in enumerate(chunks(frame, chunk_rows, transform)):
+        f.write(chunk.to_csv(index=False, header=number == 0).encode())
+
+
+def write_parquet(frame, f, chunk_rows, transform=None):
+    # One row group per chunk, all in the first chunk's schema
+    writer = None
+    for chunk in chunks(frame, chunk_rows, transform):
+        if writer is None:
+            table = pa.Table.from_pandas(chunk, preserve_index=False)
+            writer = pq.ParquetWriter(f, table.schema)
+        else:
+            table = pa.Table.from_pandas(chunk, schema=writer.schema, preserve_index=False)
+        writer.write_table(table)
+    writer.close()
+
+
+# {format: (writer, file extension, MIME type)}
+EXPORT_FORMATS = {
+    'CSV': (write_csv, 'csv', 'text/csv'),
+    'Parquet': (write_parquet, 'parquet', 'application/vnd.apache.parquet'),
+}
+
+
+def export_file(frame, export_format, name, transform=None):
+    # The export's bytes, written chunk by chunk to a temporary file first so
+    # serializing never holds a second full copy of the frame in memory.
+    # Streamlit keeps the download as bytes either way; reading them here
+    # closes the file before the download is served.
+    write, _, _ = EXPORT_FORMATS[export_format]
+    with tempfile.TemporaryFile() as f:
+        with timed(f"export.{name}", kind="export", rows=len(frame), format=export_format) as event:
+            write(frame, f, export_chunk_rows(), transform)
+            event['bytes'] = f.tell()
+        f.seek(0)
+        return f.read()
+
+
+def export_buttons(frame, name, transform=None):
+    # A download button per format for a report section's frame. Files are
+    # written only when a button is clicked, from the frame already loaded.
+    stamp = datetime.today().strftime('%Y-%m-%d')
+    columns = st.columns(len(EXPORT_FORMATS))
+    for column, (export_format, (_, extension, mime)) in zip(columns, EXPORT_FORMATS.items()):
+        column.download_button(
+            f"Download {export_format}",
+            data=lambda export_format=export_format: export_file(frame, export_format, name, transform),
+            file_name=f"{name}_{stamp}.{extension}",
+            mime=mime,
+            key=f"export_{name}_{export_format.lower()}",
+        )
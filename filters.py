@@ -0,0 +1,202 @@
+import threading
+from collections import OrderedDict, namedtuple
+
+import numpy as np
+import pandas as pd
+import streamlit as st
+
+from instrumentation import timed
+from stages import STAGE_NAMES
+
+# Sidebar selections; None (or an empty list) means "don't filter on this".
+# stages is an inclusive (low, high) range of stage numbers, dates an
+# inclusive (first day, last day) range of time_entered_stage. employee_ids
+# (matched against an employee_id column) is a page's default selection,
+# used until the employee filter is changed.
+Filters = namedtuple('Filters', ['employees', 'stages', 'dates', 'search', 'employee_ids'], defaults=(None,))
+NO_FILTERS = Filters(None, None, None, None)
+
+
+def grouped_positions(codes, groups):
+    # Row positions ordered by code, and where each code's run starts: the
+    # rows of group g are order[starts[g]:starts[g + 1]]
+    order = np.argsort(codes, kind='stable')
+    starts = np.r_[0, np.cumsum(np.bincount(codes, minlength=groups))]
+    return order, starts
+
+
+class FrameIndex:
+    # Row indexes of a stage frame (client_id, client_name, employee_name,
+    # current_stage, time_entered_stage), built once per loaded frame so
+    # every filter change is array slicing instead of a query or a scan of
+    # the string columns
+    def __init__(self, frame):
+        self.frame = frame
+        employee_codes, self.employees = pd.factorize(frame['employee_name'], sort=True)
+        self.employees = list(self.employees)
+        self._employee_codes = {name: code for code, name in enumerate(self.employees)}
+        self._by_employee = grouped_positions(employee_codes, len(self.employees))
+
+        stages = frame['current_stage'].to_numpy()
+        self.stages = np.unique(stages)
+        self._by_stage = grouped_positions(np.searchsorted(self.stages, stages), len(self.stages))
+
+        times = frame['time_entered_stage']
+        self.tz = times.dt.tz
+        self._by_time = np.argsort(times.values, kind='stable')
+        self._sorted_times = times.values[self._by_time]
+
+        client_names = pd.Categorical(frame['client_name'])
+        self._client_codes = client_names.codes
+        self._client_names = client_names.categories.astype(str).str.lower()
+
+    def __len__(self):
+        return len(self.frame)
+
+    def date_range(self):
+        if not len(self):
+            return None
+        first, last = (pd.Timestamp(value) for value in self._sorted_times[[0, -1]])
+        if self.tz is not None:
+            first, last = first.tz_localize('UTC').tz_convert(self.tz), last.tz_localize('UTC').tz_convert(self.tz)
+        return first.date(), last.date()
+
+    def _group_rows(self, index, groups):
+        order, starts = index
+        return np.concatenate([order[starts[g]:starts[g + 1]] for g in groups] or [np.array([], dtype=np.intp)])
+
+    def _bound(self, day):
+        # Midnight of day as a value comparable with the (UTC) time values
+        bound = pd.Timestamp(day)
+        if self.tz is not None:
+            bound = bound.tz_localize(self.tz).tz_convert('UTC').tz_localize(None)
+        return bound.to_datetime64()
+
+    def employee_rows(self, employees):
+        codes = [self._employee_codes[name] for name in employees if name in self._employee_codes]
+        return self._group_rows(self._by_employee, codes)
+
+    def stage_rows(self, low, high):
+        first, last = np.searchsorted(self.stages, [low, high + 1])
+        order, starts = self._by_stage
+        return order[starts[first]:starts[last]]
+
+    def date_rows(self, first_day, last_day):
+        start, end = np.searchsorted(
+            self._sorted_times, [self._bound(first_day), self._bound(pd.Timestamp(last_day) + pd.Timedelta(days=1))]
+        )
+        return self._by_time[start:end]
+
+    def search_mask(self, text):
+        matches = np.asarray(self._client_names.str.contains(text.lower(), regex=False), dtype=bool)
+        return np.r_[matches, False][self._client_codes]
+
+    def mask(self, filters):
+        # Each active filter marks its rows; the result is their intersection
+        mask = None
+
+        def narrow(selected):
+            nonlocal mask
+            if selected.dtype != bool:
+                rows, selected = selected, np.zeros(len(self), dtype=bool)
+                selected[rows] = True
+            mask = selected if mask is None else mask & selected
+
+        if filters.employees:
+            narrow(self.employee_rows(filters.employees))
+        if filters.employee_ids:
+            narrow(np.isin(self.frame['employee_id'].to_numpy(), filters.employee_ids))
+        if filters.stages is not None:
+            narrow(self.stage_rows(*filters.stages))
+        if filters.dates is not None:
+            narrow(self.date_rows(*filters.dates))
+        if filters.search:
+            narrow(self.search_mask(filters.search))
+        return mask
+
+    def filter(self, filters):
+        # Matching rows in their original order
+        mask = self.mask(filters)
+        if mask is None:
+            return self.frame
+        return self.frame.take(np.flatnonzero(mask))
+
+
+class IndexCache:
+    # Indexes of the frames a page loaded recently, shared by every session;
+    # the least recently used is dropped past max_entries. A frame is
+    # identified by the caller's key for what was loaded (e.g. the report
+    # window) plus its row count and latest timestamp: the table is
+    # append-only in practice (see db.CHANGE_PROBE_QUERY), so those tell
+    # loads of the same query apart.
+    def __init__(self, max_entries=8):
+        self.max_entries = max_entries
+        self._indexes = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, frame, key=None):
+        times = frame['time_entered_stage']
+        key = (key, len(frame), times.max() if len(frame) else None)
+        with self._lock:
+            index = self._indexes.get(key)
+            if index is None:
+                with timed('filters.build_index', kind='transform', rows=len(frame)):
+                    index = self._indexes[key] = FrameIndex(frame)
+                while len(self._indexes) > self.max_entries:
+                    self._indexes.popitem(last=False)
+            self._indexes.move_to_end(key)
+            return index
+
+
+@st.cache_resource(show_spinner=False)
+def get_index_cache(name='stage_history'):
+    # One cache per frame kind, so pages don't evict each other's index
+    return IndexCache()
+
+
+def filter_sidebar(index, key, employees=True, stages=True, dates=True, search=True, default_employees=None,
+                   default_employee_ids=None):
+    # Sidebar widgets for the chosen filters over the index's values; key
+    # prefixes the widget keys so each page keeps its own selections. With
+    # default_employee_ids, rows are restricted to those employees until the
+    # employee selection is changed, even when none of them has rows loaded
+    # (default_employees are their names, shown as the initial selection).
+    st.sidebar.subheader("Filters")
+    selected = NO_FILTERS
+    if employees:
+        changed = f"{key}_employees_changed"
+
+        def employees_changed():
+            st.session_state[changed] = True
+
+        chosen = st.sidebar.multiselect(
+            "Employees", index.employees,
+            default=[name for name in default_employees or [] if name in index.employees],
+            key=f"{key}_employees", placeholder="All employees", on_change=employees_changed,
+        )
+        if default_employee_ids is not None and not st.session_state.get(changed):
+            selected = selected._replace(employee_ids=list(default_employee_ids))
+        else:
+            selected = selected._replace(employees=chosen)
+    if stages and len(index.stages) > 1:
+        low, high = int(index.stages[0]), int(index.stages[-1])
+        chosen = st.sidebar.select_slider(
+            "Stages", options=list(range(low, high + 1)), value=(low, high),
+            format_func=lambda stage: STAGE_NAMES.get(stage, str(stage)).split(':')[0], key=f"{key}_stages",
+        )
+        if chosen != (low, high):
+            selected = selected._replace(stages=chosen)
+    date_range = index.date_range()
+    if dates and date_range is not None:
+        chosen = st.sidebar.date_input(
+            "Entered stage between", value=date_range, min_value=date_range[0], max_value=date_range[1],
+            key=f"{key}_dates",
+        )
+        # A range that is still being picked has only its first day
+        if isinstance(chosen, tuple) and len(chosen) == 2 and chosen != date_range:
+            selected = selected._replace(dates=chosen)
+    if search:
+        text = st.sidebar.text_input("Client name contains", key=f"{key}_search").strip()
+        if text:
+            selected = selected._replace(search=text)
+    return selected
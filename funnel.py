@@ -0,0 +1,137 @@
+import numpy as np
+import pandas as pd
+
+import stage_history
+
+# Shown for clients without an assigned employee name
+UNASSIGNED = 'Unassigned'
+
+# Dwell-time distribution reported per stage
+DWELL_QUANTILES = {'p25_hours': 0.25, 'median_hours': 0.5, 'p75_hours': 0.75, 'p90_hours': 0.9}
+
+
+def group_quantiles(keys, values, value_order, quantiles, groups):
+    # Linear-interpolated quantiles (as pandas computes them) of values for
+    # every key in range(groups); NaN for empty groups. value_order is
+    # argsort(values), shared between groupings: a stable sort by key on top
+    # of it (a radix sort for small keys) puts every group in value order.
+    small = np.int16 if groups <= np.iinfo(np.int16).max else keys.dtype
+    order = value_order[np.argsort(keys[value_order].astype(small), kind='stable')]
+    values = values[order]
+    counts = np.bincount(keys, minlength=groups)
+    starts = np.cumsum(counts) - counts
+    present = counts > 0
+    result = {}
+    for name, q in quantiles.items():
+        column = np.full(groups, np.nan)
+        position = starts[present] + q * (counts[present] - 1)
+        low = np.floor(position).astype(np.intp)
+        high = np.ceil(position).astype(np.intp)
+        column[present] = values[low] + (values[high] - values[low]) * (position - low)
+        result[name] = column
+    return result
+
+
+def dwell_summary(keys, dwell_hours, dwell_order, groups):
+    counts = np.bincount(keys, minlength=groups)
+    totals = np.bincount(keys, weights=dwell_hours, minlength=groups)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = totals / counts
+    return {'transitions': counts, 'mean_hours': mean,
+            **group_quantiles(keys, dwell_hours, dwell_order, DWELL_QUANTILES, groups)}
+
+
+def funnel_analytics(history):
+    # Stage-to-stage transition counts, clients reaching each stage and the
+    # time spent in a stage before the next change, per employee, computed
+    # from the client-ordered history with array operations only. A
+    # client's last row has no next change, so its open stage has no dwell
+    # time yet. Results are small frames keyed by employee_name and stage
+    # numbers; overall figures are sums over employees, except dwell_overall.
+    history = stage_history.client_ordered(history)
+    ids = history['client_id'].to_numpy()
+    stages = history['current_stage'].to_numpy().astype(np.intp)
+    times = history['time_entered_stage'].values
+    # A NULL employee name gets its own code (and label) rather than -1,
+    # which bincount can't count
+    employee_codes, employees = pd.factorize(history['employee_name'], sort=True, use_na_sentinel=False)
+    employees = np.asarray(employees, dtype=object)
+    employees[pd.isna(employees)] = UNASSIGNED
+    stage_count = int(stages.max()) + 1 if len(stages) else 1
+    employee_count = len(employees)
+
+    # Consecutive rows of the same client are one transition
+    same_client = ids[1:] == ids[:-1]
+    from_stage = stages[:-1][same_client]
+    to_stage = stages[1:][same_client]
+    transition_employee = employee_codes[:-1][same_client]
+    dwell_hours = ((times[1:] - times[:-1])[same_client] / np.timedelta64(1, 'h')).astype(np.float64)
+
+    counts = np.bincount(
+        (transition_employee * stage_count + from_stage) * stage_count + to_stage,
+        minlength=employee_count * stage_count * stage_count,
+    ).reshape(employee_count, stage_count, stage_count)
+    employee_index, from_index, to_index = np.nonzero(counts)
+    transitions = pd.DataFrame({
+        'employee_name': employees[employee_index],
+        'from_stage': from_index,
+        'to_stage': to_index,
+        'transitions': counts[employee_index, from_index, to_index],
+    })
+
+    # Clients that ever entered each stage, out of the employee's clients
+    starts, _ = stage_history.client_bounds(ids)
+    client_position = np.cumsum(np.r_[False, ~same_client]) if len(ids) else np.array([], dtype=np.intp)
+    entered = np.zeros((len(starts), stage_count), dtype=bool)
+    entered[client_position, stages] = True
+    client_employee = employee_codes[starts]
+    cells = (client_employee[:, None] * stage_count + np.arange(stage_count))[entered]
+    reached_counts = np.bincount(cells, minlength=employee_count * stage_count).reshape(employee_count, stage_count)
+    client_totals = np.bincount(client_employee, minlength=employee_count)
+    employee_index, stage_index = np.nonzero(reached_counts)
+    reached = pd.DataFrame({
+        'employee_name': employees[employee_index],
+        'current_stage': stage_index,
+        'clients_reached': reached_counts[employee_index, stage_index],
+        'clients_total': client_totals[employee_index],
+    })
+
+    # Dwell time: from entering a stage to the client's next stage change
+    dwell_order = np.argsort(dwell_hours)
+    per_employee = dwell_summary(transition_employee * stage_count + from_stage, dwell_hours, dwell_order,
+                                 employee_count * stage_count)
+    employee_index, stage_index = np.divmod(np.arange(employee_count * stage_count), stage_count)
+    dwell_by_employee = pd.DataFrame({
+        'employee_name': employees[employee_index],
+        'current_stage': stage_index,
+        **per_employee,
+    })
+    dwell_by_employee = dwell_by_employee[dwell_by_employee['transitions'] > 0].reset_index(drop=True)
+    overall = dwell_summary(from_stage, dwell_hours, dwell_order, stage_count)
+    dwell_overall = pd.DataFrame({'current_stage': np.arange(stage_count), **overall})
+    dwell_overall = dwell_overall[dwell_overall['transitions'] > 0].reset_index(drop=True)
+
+    return {
+        'transitions': transitions,
+        'reached': reached,
+        'dwell_by_employee': dwell_by_employee,
+        'dwell_overall': dwell_overall,
+    }
+
+
+def transition_matrix(transitions):
+    # from_stage x to_stage transition counts (summed over the given rows)
+    return transitions.pivot_table(index='from_stage', columns='to_stage', values='transitions',
+                                   aggfunc='sum', fill_value=0)
+
+
+def conversion_rates(matrix):
+    # Share of the transitions out of each stage that went to each next stage
+    return matrix.div(matrix.sum(axis=1), axis=0)
+
+
+def reach_rates(reached):
+    # Clients that ever entered each stage, as counts and shares of all clients
+    clients = reached.drop_duplicates('employee_name')['clients_total'].sum()
+    counts = reached.groupby('current_stage')['clients_reached'].sum()
+    return pd.DataFrame({'clients_reached': counts, 'share_of_clients': counts / clients if clients else np.nan})
@@ -0,0 +1,282 @@
+import argparse
+import json
+import re
+import statistics
+import sys
+from collections import namedtuple
+
+import pandas as pd
+
+import queries
+import rollup
+from benchmarks.report_suite import git_revision, report_queries
+from db import get_pool, with_cursor
+
+EXPLAIN = "EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON)"
+
+# Indexes the report SQL relies on; sql/report_indexes.sql creates them all.
+# An existing index counts when its leading columns are these, in order.
+ReportIndex = namedtuple('ReportIndex', ['name', 'table', 'columns', 'reason'])
+REPORT_INDEXES = [
+    ReportIndex('client_stage_progression_client_created_on', 'client_stage_progression', ('client_id', 'created_on'),
+                'per-client history in time order: ROW_NUMBER, latest-stage lookups, rollup refresh'),
+    ReportIndex('client_stage_progression_created_on_stage', 'client_stage_progression', ('created_on', 'current_stage'),
+                'windowed reports: created_on range with a current_stage filter'),
+    ReportIndex('client_assigned_employee', 'client', ('assigned_employee',),
+                'client -> employee joins and employee_ids filters'),
+]
+
+INDEX_COLUMNS_QUERY = """
+    SELECT t.relname, i.relname, array_agg(a.attname ORDER BY k.ord)
+    FROM pg_index x
+    JOIN pg_class t ON t.oid = x.indrelid
+    JOIN pg_class i ON i.oid = x.indexrelid
+    JOIN pg_namespace n ON n.oid = t.relnamespace
+    CROSS JOIN LATERAL unnest(x.indkey::int2[]) WITH ORDINALITY AS k(attnum, ord)
+    LEFT JOIN pg_attribute a ON a.attrelid = t.oid AND a.attnum = k.attnum
+    WHERE n.nspname = 'public' AND t.relname = ANY(%s) AND x.indisvalid
+    GROUP BY t.relname, i.relname;
+"""
+
+# A failed CREATE INDEX CONCURRENTLY leaves an invalid index behind, which
+# IF NOT EXISTS would then silently keep
+INVALID_INDEX_QUERY = """
+    SELECT NOT indisvalid FROM pg_index WHERE indexrelid = to_regclass(%s);
+"""
+
+
+def create_index_sql(index):
+    return f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {index.name} ON public.{index.table} ({', '.join(index.columns)});"
+
+
+def migration_sql(indexes):
+    lines = [
+        "-- Indexes behind the report queries; see REPORT_INDEXES in index_advisor.py.",
+        "-- CONCURRENTLY keeps the tables writable: run outside a transaction.",
+    ]
+    for index in indexes:
+        lines += ["", f"-- {index.reason}", create_index_sql(index)]
+    return "\n".join(lines) + "\n"
+
+
+def index_status():
+    # {index name: name of the existing index that serves it, or None}
+    def handler(cursor):
+        cursor.execute(INDEX_COLUMNS_QUERY, (sorted({index.table for index in REPORT_INDEXES}),))
+        return cursor.fetchall()
+
+    existing = with_cursor(handler)
+    status = {}
+    for index in REPORT_INDEXES:
+        status[index.name] = next(
+            (name for table, name, columns in existing
+             if table == index.table and tuple(columns[:len(index.columns)]) == index.columns),
+            None,
+        )
+    return status
+
+
+def apply_indexes(indexes):
+    def handler(cursor):
+        connection = cursor.connection
+        connection.autocommit = True
+        try:
+            for index in indexes:
+                cursor.execute(INVALID_INDEX_QUERY, (f"public.{index.name}",))
+                invalid = cursor.fetchone()
+                if invalid and invalid[0]:
+                    cursor.execute(f"DROP INDEX CONCURRENTLY IF EXISTS public.{index.name}")
+                print(f"Creating {index.name} ...")
+                cursor.execute(create_index_sql(index))
+                cursor.execute(f"ANALYZE public.{index.table}")
+        finally:
+            connection.autocommit = False
+
+    with_cursor(handler)
+
+
+# Quoted constants in plan conditions, e.g. the window start timestamp
+LITERAL = re.compile(r"'(?:[^']|'')*'")
+
+
+def walk(node, depth=0):
+    yield depth, node
+    for child in node.get('Plans', []):
+        yield from walk(child, depth + 1)
+
+
+def node_label(node):
+    label = node['Node Type']
+    if 'Relation Name' in node:
+        label += f" on {node['Relation Name']}"
+    if 'Index Name' in node:
+        label += f" using {node['Index Name']}"
+    return label
+
+
+def plan_flags(plan, min_rows):
+    # Problems worth an index or more work_mem. Keys identify the problem
+    # without its numbers, so runs compare on what went wrong, not by how much.
+    for _, node in walk(plan):
+        kind = node['Node Type']
+        loops = node.get('Actual Loops', 1)
+        if kind == 'Seq Scan':
+            removed = node.get('Rows Removed by Filter', 0) * loops
+            kept = node.get('Actual Rows', 0) * loops
+            if removed >= min_rows and removed >= kept:
+                yield {'key': f"seq_scan:{node['Relation Name']}:{LITERAL.sub('?', node.get('Filter', ''))}",
+                       'detail': f"seq scan on {node['Relation Name']} discards {removed} of {removed + kept} rows "
+                                 f"(filter: {node.get('Filter')})"}
+        for part in [node] + node.get('Workers', []):
+            if part.get('Sort Space Type') == 'Disk':
+                sort_key = ', '.join(node.get('Sort Key', []))
+                yield {'key': f"sort_spill:{sort_key}",
+                       'detail': f"sort spilled to disk ({part.get('Sort Space Used')} kB, key: {sort_key})"}
+                break
+        if node.get('Hash Batches', 1) > 1:
+            yield {'key': f"hash_spill:{node_label(node)}",
+                   'detail': f"hash spilled to disk ({node['Hash Batches']} batches)"}
+        if node.get('Storage') == 'Disk':
+            yield {'key': f"storage_spill:{node_label(node)}",
+                   'detail': f"{kind} spilled to disk ({node.get('Maximum Storage')} kB)"}
+
+
+def explain(query, params):
+    # Report queries are explained as the dashboard runs them: EXECUTE of
+    # the prepared statement, so the plan is the one it actually gets
+    def handler(cursor):
+        try:
+            if isinstance(query, queries.ReportQuery):
+                prepared = get_pool().prepared_statements(cursor.connection)
+                if query.statement not in prepared:
+                    cursor.execute(queries.prepare_sql(query))
+                    prepared.add(query.statement)
+                cursor.execute(f"{EXPLAIN} {queries.execute_sql(query)}", [params[name] for name in query.params])
+            else:
+                cursor.execute(f"{EXPLAIN} {query}", params)
+            return cursor.fetchone()[0][0]
+        finally:
+            cursor.connection.rollback()
+
+    return with_cursor(handler)
+
+
+def check_query(query, params, repeat, min_rows):
+    runs = [explain(query, params) for _ in range(repeat)]
+    # Numbers from the median run; shape and flags from the last (warm) one
+    median_run = sorted(runs, key=lambda run: run['Execution Time'])[len(runs) // 2]
+    plan = runs[-1]['Plan']
+    return {
+        'execution_ms': median_run['Execution Time'],
+        'planning_ms': statistics.median(run['Planning Time'] for run in runs),
+        'rows': plan.get('Actual Rows'),
+        'shared_hit_blocks': median_run['Plan'].get('Shared Hit Blocks', 0),
+        'shared_read_blocks': median_run['Plan'].get('Shared Read Blocks', 0),
+        'temp_written_blocks': median_run['Plan'].get('Temp Written Blocks', 0),
+        'shape': [f"{'  ' * depth}{node_label(node)}" for depth, node in walk(plan)],
+        'flags': list(plan_flags(plan, min_rows)),
+    }
+
+
+def advised_queries():
+    checked = report_queries()
+    if rollup.rollup_exists():
+        checked['rollup.latest_stage'] = (rollup.ROLLUP_LATEST_STAGE_QUERY, None)
+        checked['rollup.employee_stage'] = (rollup.ROLLUP_EMPLOYEE_STAGE_QUERY, None)
+    return checked
+
+
+def compare(results, baseline, tolerance):
+    # Returns the number of regressions: new flags or slower than tolerance.
+    # A changed plan shape alone is reported but may well be an improvement.
+    regressions = 0
+    print(f"\nCompared with baseline ({baseline['meta'].get('revision')})")
+    for name, current in results['queries'].items():
+        before = baseline['queries'].get(name)
+        if before is None:
+            continue
+        notes = []
+        if current['shape'] != before['shape']:
+            notes.append("PLAN CHANGED")
+        new_flags = {flag['key'] for flag in current['flags']} - {flag['key'] for flag in before['flags']}
+        if new_flags:
+            notes.append(f"NEW FLAGS: {len(new_flags)}")
+        ratio = current['execution_ms'] / before['execution_ms'] if before['execution_ms'] else 1.0
+        if ratio > 1 + tolerance:
+            notes.append("SLOWER")
+        if new_flags or ratio > 1 + tolerance:
+            regressions += 1
+        print(f"  {name:<52} {before['execution_ms']:9.1f}ms -> {current['execution_ms']:9.1f}ms "
+              f"({ratio:.2f}x) {' '.join(notes)}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Check the report queries' plans and the indexes they rely on. Uses DATABASE_URL "
+                    "when set, else the dashboard's secrets.toml."
+    )
+    parser.add_argument('--repeat', type=int, default=3, help='EXPLAIN ANALYZE runs per query')
+    parser.add_argument('--min-rows', type=int, default=10000,
+                        help='flag seq scans that discard at least this many rows')
+    parser.add_argument('--output', help='write results as JSON to this file')
+    parser.add_argument('--baseline', help='JSON results of an earlier run; exit 1 on regressions')
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help='execution time ratio above which a query counts as slower')
+    parser.add_argument('--write-migration', metavar='PATH', help='write SQL creating the missing indexes')
+    parser.add_argument('--apply', action='store_true', help='create the missing indexes (CONCURRENTLY)')
+    args = parser.parse_args()
+
+    results = {
+        'meta': {
+            'revision': git_revision(),
+            'started_at': pd.Timestamp.now().isoformat(),
+            'repeat': args.repeat,
+            'min_rows': args.min_rows,
+        },
+        'queries': {},
+        'indexes': index_status(),
+    }
+    seq_scanned = {}
+    for name, (query, params) in advised_queries().items():
+        result = results['queries'][name] = check_query(query, params, args.repeat, args.min_rows)
+        print(f"{name:<52} {result['execution_ms']:9.1f}ms  {result['shared_read_blocks']} blocks read, "
+              f"{result['temp_written_blocks']} temp blocks written")
+        for flag in result['flags']:
+            print(f"    ! {flag['detail']}")
+            if flag['key'].startswith('seq_scan:'):
+                seq_scanned.setdefault(flag['key'].split(':')[1], []).append(name)
+
+    print("\nReport indexes")
+    missing = []
+    for index in REPORT_INDEXES:
+        existing = results['indexes'][index.name]
+        if existing:
+            print(f"  ok       {index.table} ({', '.join(index.columns)}) via {existing}")
+            continue
+        missing.append(index)
+        print(f"  MISSING  {index.table} ({', '.join(index.columns)}): {index.reason}")
+        if index.table in seq_scanned:
+            print(f"           seq scans on {index.table} in: {', '.join(seq_scanned[index.table])}")
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    if args.write_migration:
+        with open(args.write_migration, 'w') as f:
+            f.write(migration_sql(missing))
+        print(f"\nWrote {len(missing)} index statements to {args.write_migration}")
+    if args.apply and missing:
+        apply_indexes(missing)
+        print("Indexes created; run again to see the new plans")
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    # e.g. python index_advisor.py --output plans.json, then after a schema or
+    # query change: python index_advisor.py --baseline plans.json
+    main()
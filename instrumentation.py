@@ -0,0 +1,134 @@
+import hashlib
+import json
+import logging
+import math
+import threading
+import time
+import uuid
+from collections import defaultdict, deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+import streamlit as st
+
+from config import get_setting
+from query_cache import normalize_query
+
+logger = logging.getLogger("dashboard.timing")
+
+# Id of the script run (page render) the current code belongs to; query_graph
+# copies it onto its worker threads so their timings count towards the run
+current_run = ContextVar("current_run", default=None)
+
+# Readable names for report queries, keyed by normalized SQL
+QUERY_NAMES = {}
+
+
+def name_queries(queries):
+    # queries: {name: sql}
+    for name, query in queries.items():
+        QUERY_NAMES[normalize_query(query)] = name
+
+
+def query_label(query):
+    normalized = normalize_query(query)
+    name = QUERY_NAMES.get(normalized)
+    if name is None:
+        name = "query_" + hashlib.sha1(normalized.encode()).hexdigest()[:8]
+    return name
+
+
+def percentile(sorted_values, fraction):
+    # Nearest-rank percentile over an already sorted list
+    index = max(0, math.ceil(fraction * len(sorted_values)) - 1)
+    return sorted_values[index]
+
+
+class TimingStats:
+    # Rolling durations per timer name (the last `window` samples) plus the
+    # most recent events, for the diagnostics panel
+    def __init__(self, window=200, recent_events=1000):
+        self.window = window
+        self._durations = defaultdict(lambda: deque(maxlen=window))
+        self._latest = {}
+        self._counts = defaultdict(int)
+        self._events = deque(maxlen=recent_events)
+        self._lock = threading.Lock()
+
+    def record(self, event):
+        with self._lock:
+            self._durations[event['name']].append(event['seconds'])
+            self._latest[event['name']] = event
+            self._counts[event['name']] += 1
+            self._events.append(event)
+
+    def summary(self):
+        with self._lock:
+            rows = []
+            for name, durations in self._durations.items():
+                ordered = sorted(durations)
+                latest = self._latest[name]
+                rows.append({
+                    'name': name,
+                    'kind': latest['kind'],
+                    'count': self._counts[name],
+                    'p50_ms': percentile(ordered, 0.5) * 1000,
+                    'p95_ms': percentile(ordered, 0.95) * 1000,
+                    'last_ms': latest['seconds'] * 1000,
+                    'rows': latest.get('rows'),
+                    'bytes': latest.get('bytes'),
+                })
+            return sorted(rows, key=lambda row: row['name'])
+
+    def run_events(self, run_id):
+        with self._lock:
+            return [event for event in self._events if event.get('run') == run_id]
+
+
+@st.cache_resource(show_spinner=False)
+def get_timing_stats():
+    log_file = get_setting("TIMING_LOG_FILE")
+    if log_file:
+        handler = logging.FileHandler(log_file)
+        handler.setFormatter(logging.Formatter("%(message)s"))
+        logger.addHandler(handler)
+        logger.setLevel(logging.INFO)
+    return TimingStats(window=int(get_setting("TIMING_WINDOW", 200)))
+
+
+@contextmanager
+def timed(name, kind="section", **fields):
+    # Times the block and records it under `name`. The yielded dict can be
+    # filled with rows / bytes (or anything else worth logging) by the block.
+    event = {'name': name, 'kind': kind, **fields}
+    started = time.perf_counter()
+    try:
+        yield event
+    except BaseException:
+        event['error'] = True
+        raise
+    finally:
+        event['seconds'] = time.perf_counter() - started
+        event['run'] = current_run.get()
+        event['at'] = time.time()
+        get_timing_stats().record(event)
+        # Serialized only when someone is listening (TIMING_LOG_FILE)
+        if logger.isEnabledFor(logging.INFO):
+            logger.info(json.dumps(event, default=str))
+
+
+def frame_size(event, frame):
+    # Row count and (shallow) memory footprint of a result, for timed() events
+    if frame is not None:
+        event['rows'] = len(frame)
+        event['bytes'] = int(frame.memory_usage(index=True).sum())
+    return frame
+
+
+@contextmanager
+def run_scope():
+    token = current_run.set(uuid.uuid4().hex)
+    try:
+        yield current_run.get()
+    finally:
+        current_run.reset(token)
@@ -0,0 +1,347 @@
+import argparse
+import json
+import logging
+import os
+import select
+import threading
+import time
+from collections import namedtuple
+
+import numpy as np
+import pandas as pd
+import psycopg2
+import streamlit as st
+
+import stage_history
+from config import get_setting
+from db import get_db_params, large_result_settings, run_query, with_cursor
+from instrumentation import timed
+from queries import DEFAULT_WINDOW, REPORT_WINDOWS
+
+logger = logging.getLogger(__name__)
+
+DDL_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "sql", "live_updates.sql")
+
+# Channel and payload fields of the trigger in sql/live_updates.sql: one
+# stage history row, as stage_history.STAGE_HISTORY_QUERY returns it
+CHANNEL = "client_stage_progression"
+COLUMNS = ['client_id', 'client_name', 'employee_id', 'employee_name', 'current_stage', 'stage_name',
+           'time_entered_stage']
+# A notification for a row the last history load already had is ignored
+ROW_KEY = ['client_id', 'time_entered_stage', 'current_stage']
+
+# Report datasets kept live. source is the aggregate a view is computed
+# from: "latest" (every client's latest stage rows) or "recent" (stage rows
+# inside the default report window); build takes that frame.
+LiveView = namedtuple('LiveView', ['name', 'source', 'build'])
+LIVE_VIEWS = {}
+
+
+def register_view(name, source, build):
+    LIVE_VIEWS[name] = LiveView(name, source, build)
+
+
+def use_live_updates():
+    return get_setting("LIVE_UPDATES", False)
+
+
+def delta_frame(payloads, like):
+    # Notification payloads as stage history rows in the dtypes of like
+    rows = pd.DataFrame([json.loads(payload) for payload in payloads], columns=COLUMNS)
+    # timestamptz payloads carry the session's offset, which changes across
+    # DST, so they are parsed as UTC instants first; plain timestamps are
+    # taken as UTC and converted back unchanged (tz None)
+    times = pd.to_datetime(rows['time_entered_stage'], format='ISO8601', utc=True)
+    times = times.dt.tz_convert(like['time_entered_stage'].dt.tz)
+    return rows.assign(time_entered_stage=times.astype(like['time_entered_stage'].dtype))
+
+
+def unseen_rows(frame, rows):
+    if frame.empty or rows.empty:
+        return rows
+    return rows[~pd.MultiIndex.from_frame(rows[ROW_KEY]).isin(pd.MultiIndex.from_frame(frame[ROW_KEY]))]
+
+
+def append_rows(frame, rows):
+    # frame plus rows in frame's dtypes. Categorical columns are extended
+    # code by code: concatenating categoricals compares (and hashes) their
+    # categories, which for client names costs more than the update itself.
+    columns = {}
+    for name in frame.columns:
+        values, added = frame[name], rows[name]
+        if isinstance(values.dtype, pd.CategoricalDtype):
+            # The dtype object is carried over unchanged unless names are
+            # added, so its categories' lookup table is built only once
+            dtype = values.dtype
+            if added.dtype is dtype:
+                added_codes = added.cat.codes.to_numpy()
+            else:
+                # A lookup key of another dtype than the categories would
+                # convert all of them on every call
+                added = pd.Index(added.astype(object), dtype=dtype.categories.dtype)
+                new = added.dropna().unique().difference(dtype.categories)
+                if len(new):
+                    dtype = pd.CategoricalDtype(dtype.categories.append(new))
+                added_codes = dtype.categories.get_indexer(added)
+            codes = np.concatenate([values.cat.codes.to_numpy(), added_codes])
+            columns[name] = pd.Categorical.from_codes(codes, dtype=dtype)
+        else:
+            columns[name] = pd.concat([values, added.astype(values.dtype)], ignore_index=True)
+    return pd.DataFrame(columns)
+
+
+class LiveAggregates:
+    # Every client's latest stage rows plus the stage rows of the default
+    # report window, kept current by applying notified rows instead of
+    # reloading the history. Views are computed from them once per change
+    # and shared by every session.
+    def __init__(self, window=REPORT_WINDOWS[DEFAULT_WINDOW]):
+        self.window = window
+        self.versions = {'latest': 0, 'recent': 0}
+        self.updated_at = None
+        self.rows_applied = 0
+        self._latest = None
+        self._recent = None
+        self._views = {}
+        self._lock = threading.Lock()
+
+    def ready(self):
+        return self._latest is not None
+
+    def _in_window(self, rows):
+        return rows[rows['time_entered_stage'] >= stage_history.window_start(rows, window=self.window)]
+
+    def rebuild(self, history):
+        history = history[COLUMNS]
+        latest = stage_history.latest_stage_rows(history).reset_index(drop=True)
+        recent = self._in_window(history).reset_index(drop=True)
+        with self._lock:
+            self._latest, self._recent = latest, recent
+            self.versions = {source: version + 1 for source, version in self.versions.items()}
+            self.updated_at = time.time()
+
+    def apply(self, payloads):
+        # Returns the sources that changed
+        with self._lock:
+            latest, recent = self._latest, self._recent
+        if latest is None:
+            return set()
+        rows = delta_frame(payloads, latest)
+        changed = set()
+
+        # Only the notified clients' latest rows are recomputed: a new row
+        # replaces them when it is at least as new (ties keep both, like
+        # latest_stage_rows)
+        affected = latest['client_id'].isin(rows['client_id'].unique()).to_numpy()
+        current = latest[affected]
+        fresh = unseen_rows(current, rows)
+        if not fresh.empty:
+            candidates = append_rows(current, fresh)
+            updated = stage_history.latest_stage_rows(candidates)
+            if (updated.index >= len(current)).any():
+                latest = append_rows(latest[~affected], updated)
+                changed.add('latest')
+
+        # Rows age out of the window as well as arriving in it
+        kept = self._in_window(recent)
+        fresh = self._in_window(unseen_rows(kept[kept['client_id'].isin(rows['client_id'].unique())], rows))
+        if not fresh.empty or len(kept) != len(recent):
+            recent = append_rows(kept, fresh)
+            changed.add('recent')
+
+        with self._lock:
+            self._latest, self._recent = latest, recent
+            for source in changed:
+                self.versions[source] += 1
+            self.rows_applied += len(rows)
+            self.updated_at = time.time()
+        return changed
+
+    def view(self, name):
+        # Current frame of a registered view, or None before the first load.
+        # Window views also change as time passes, so they are recomputed at
+        # least once a minute.
+        live_view = LIVE_VIEWS[name]
+        with self._lock:
+            source = self._latest if live_view.source == 'latest' else self._recent
+            if source is None:
+                return None
+            key = (self.versions[live_view.source], int(time.time() // 60) if live_view.source == 'recent' else None)
+            cached = self._views.get(name)
+        if cached is None or cached[0] != key:
+            with timed(f"live.view.{name}", kind="transform"):
+                cached = (key, live_view.build(source))
+            with self._lock:
+                self._views[name] = cached
+        return cached[1].copy(deep=False)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'ready': self._latest is not None,
+                'clients': 0 if self._latest is None else int(self._latest['client_id'].nunique()),
+                'window_rows': 0 if self._recent is None else len(self._recent),
+                'rows_applied': self.rows_applied,
+                'versions': dict(self.versions),
+                'updated_at': self.updated_at,
+            }
+
+
+def load_history():
+    # Always a fresh read: the result cache may predate rows whose
+    # notifications were missed while disconnected
+    if stage_history.use_replica():
+        return stage_history.stage_history_frame()
+    return run_query(stage_history.STAGE_HISTORY_QUERY, **large_result_settings())
+
+
+class LiveListener:
+    # One LISTEN connection per server process, outside the pool since it
+    # stays open for good. Notified rows are applied to the aggregates as
+    # they arrive; after a (re)connect, and every resync_interval to pick up
+    # changes no trigger reports (reassigned clients, deleted rows), the
+    # aggregates are rebuilt from the full history.
+    def __init__(self, aggregates, resync_interval=3600.0, retry_delay=5.0, max_batch_wait=0.5):
+        self.aggregates = aggregates
+        self.resync_interval = resync_interval
+        self.retry_delay = retry_delay
+        self.max_batch_wait = max_batch_wait
+        self.connected = False
+        self.errors = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _connect(self):
+        connection = psycopg2.connect(**get_db_params())
+        connection.autocommit = True
+        with connection.cursor() as cursor:
+            cursor.execute(f"LISTEN {CHANNEL}")
+        return connection
+
+    def _rebuild(self):
+        with timed("live.rebuild", kind="db") as event:
+            history = load_history()
+            event['rows'] = len(history)
+            self.aggregates.rebuild(history)
+
+    def _listen(self, connection):
+        # LISTEN is already in effect, so rows inserted while the history
+        # loads arrive as notifications instead of being missed
+        self._rebuild()
+        resync_at = time.monotonic() + self.resync_interval
+        while not self._stop.is_set():
+            if select.select([connection], [], [], 1.0)[0]:
+                connection.poll()
+                # A bulk insert notifies row by row; take the whole burst
+                # (up to max_batch_wait) as one update
+                deadline = time.monotonic() + self.max_batch_wait
+                while time.monotonic() < deadline and select.select([connection], [], [], 0.05)[0]:
+                    connection.poll()
+            if connection.notifies:
+                payloads = [notify.payload for notify in connection.notifies]
+                connection.notifies.clear()
+                with timed("live.apply", kind="transform", rows=len(payloads)):
+                    self.aggregates.apply(payloads)
+            if time.monotonic() >= resync_at:
+                self._rebuild()
+                resync_at = time.monotonic() + self.resync_interval
+
+    def _run(self):
+        while not self._stop.is_set():
+            connection = None
+            try:
+                connection = self._connect()
+                self.connected = True
+                self._listen(connection)
+            except Exception:
+                self.errors += 1
+                logger.exception("live update listener failed; reconnecting")
+            finally:
+                self.connected = False
+                if connection is not None:
+                    connection.close()
+            self._stop.wait(self.retry_delay)
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="live-updates", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def stats(self):
+        return {'connected': self.connected, 'errors': self.errors, **self.aggregates.stats()}
+
+
+@st.cache_resource(show_spinner=False)
+def get_listener():
+    listener = LiveListener(
+        LiveAggregates(),
+        resync_interval=float(get_setting("LIVE_RESYNC_SECONDS", 3600)),
+    )
+    listener.start()
+    return listener
+
+
+def live_section(name, frame, render, enabled=True):
+    # render(frame) for one page section. In live mode the section is a
+    # fragment rerun every LIVE_POLL_SECONDS with the current frame of live
+    # view `name`, so new stage rows show up in it without rerunning the
+    # page; until the listener's first load it shows frame.
+    if not (enabled and use_live_updates()):
+        render(frame)
+        return
+
+    @st.fragment(run_every=float(get_setting("LIVE_POLL_SECONDS", 5)), key=f"live_{name}")
+    def section():
+        aggregates = get_listener().aggregates
+        current = aggregates.view(name)
+        render(frame if current is None else current)
+        if aggregates.updated_at is not None:
+            st.caption(f"Live: updated {time.strftime('%H:%M:%S', time.localtime(aggregates.updated_at))}")
+
+    section()
+
+
+def install_trigger():
+    with open(DDL_PATH) as f:
+        ddl = f.read()
+
+    def handler(cursor):
+        cursor.execute(ddl)
+        cursor.connection.commit()
+
+    with_cursor(handler)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Install the stage change trigger, or watch the live aggregates follow it. Uses "
+                    "DATABASE_URL when set, else the dashboard's secrets.toml."
+    )
+    parser.add_argument('--install', action='store_true', help='create the trigger in sql/live_updates.sql')
+    parser.add_argument('--watch', action='store_true', help='listen and print the aggregates after each change')
+    args = parser.parse_args()
+
+    if args.install:
+        install_trigger()
+        print(f"Installed the {CHANNEL} trigger")
+    if args.watch:
+        listener = LiveListener(LiveAggregates())
+        listener.start()
+        versions = None
+        try:
+            while True:
+                time.sleep(1)
+                stats = listener.stats()
+                if stats['versions'] != versions:
+                    versions = stats['versions']
+                    print(json.dumps(stats, default=str))
+        except KeyboardInterrupt:
+            listener.stop()
+
+
+if __name__ == "__main__":
+    # e.g. python live_updates.py --install --watch, then INSERT INTO
+    # client_stage_progression from psql and watch the versions move
+    main()
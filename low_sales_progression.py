@@ -1,64 +1,34 @@
 import streamlit as st
-import psycopg2
-import pandas as pd
 from datetime import datetime
+import stage_history
+from exports import export_buttons
+from filters import filter_sidebar, get_index_cache
+from instrumentation import timed
+from live_updates import live_section, register_view
+from messages import MessageThreads
+from pagination import paginate
+from queries import (DEFAULT_WINDOW, REPORT_WINDOWS, WINDOW_LABELS, cached_report_query, register_query,
+                     select_window, window_bounds)
+from query_graph import QueryTask, run_query_graph
+from schema import with_fub_links
+from snapshots import report_datasets
 
-# def messageParser(client_id: int):
-    # db_params = {
-    #     'dbname': st.secrets["database"]["DB_NAME"],
-    #     'user': st.secrets["database"]["DB_USER"],
-    #     'password': st.secrets["database"]["DB_PASSWORD"],
-    #     'host': st.secrets["database"]["DB_HOST"],
-    #     'port': st.secrets["database"]["DB_PORT"]
-    # }
-#     try:
-#         connection = psycopg2.connect(**db_params)
-#         cursor = connection.cursor()
-#         query = '''
-#             SELECT client.fullname, employee.fullname, message, status, textmessage.created
-#             FROM textmessage 
-#             JOIN client ON client.id = client_id
-#             JOIN employee ON employee.id = employee_id
-#             WHERE client_id = %s
-#             ORDER BY textmessage.created ASC
-#         '''
-#         cursor.execute(query, (client_id,))
-#         messages_raw = cur.fetchall()
-
-#         messages = [
-#             f"[{msg[-1]}] {'Client' if msg[3] == 'Received' else 'Sales Rep'}: {msg[2]}"
-#             for msg in messages_raw
-#         ]
-
-#         cursor.close()
-#         connection.close()
-
-#         return '\n'.join(messages)
-#     except Exception as e:
-#         print(e)
-#         return None
+# Employees the page shows until the sidebar selection is changed; the report
+# itself covers every employee (employee_ids=None), so changing the selection
+# needs no new query
+LOW_PROGRESSION_EMPLOYEE_IDS = [378, 375, 356, 373, 333, 173]
 
-def show_low_sales_progression():
-    st.title("Low Sales Progression Report")
-    
-    db_params = {
-        'dbname': st.secrets["database"]["DB_NAME"],
-        'user': st.secrets["database"]["DB_USER"],
-        'password': st.secrets["database"]["DB_PASSWORD"],
-        'host': st.secrets["database"]["DB_HOST"],
-        'port': st.secrets["database"]["DB_PORT"]
-    }
-    # Employee IDs to filter
-    employee_ids = [378, 375, 356, 373, 333, 173]
-
-    fetch_low_progression_clients_query = f"""
+# The low progression query also returns employee_id, for the preselection
+LOW_PROGRESSION_KEYS = ('client_id', 'client_name', 'employee_id', 'employee_name')
+
+FETCH_LOW_PROGRESSION_CLIENTS_QUERY = register_query('low_sales_progression.low_progression_clients', """
     SELECT 
         csp.client_id,
         c.fullname AS client_name,
+        e.id AS employee_id,
         e.fullname AS employee_name,
         MAX(csp.current_stage) AS current_stage,
-        MAX(csp.created_on) AS time_entered_stage,
-        CONCAT('https://services.followupboss.com/2/people/view/', csp.client_id) AS followup_boss_link
+        MAX(csp.created_on) AS time_entered_stage
     FROM 
         public.client_stage_progression csp
     JOIN 
@@ -67,63 +37,110 @@ def show_low_sales_progression():
         public.employee e ON c.assigned_employee = e.id
     WHERE 
         csp.current_stage <= 3
-        AND csp.created_on >= NOW() - INTERVAL '24 hours'
-        AND e.id IN ({','.join(map(str, employee_ids))})
+        AND csp.created_on >= %(window_start)s
+        AND csp.created_on < COALESCE(%(window_end)s, 'infinity')
+        AND (%(employee_ids)s IS NULL OR e.id = ANY(%(employee_ids)s))
     GROUP BY 
-        csp.client_id, c.fullname, e.fullname
+        csp.client_id, c.fullname, e.id, e.fullname
     HAVING 
         MAX(csp.current_stage) <= 3
     ORDER BY 
         e.fullname, csp.client_id;
-    """
-
-    def fetch_data(query):
-        connection = None
-        cursor = None
-        try:
-            connection = psycopg2.connect(**db_params)
-            cursor = connection.cursor()
-            cursor.execute(query)
-            records = cursor.fetchall()
-            column_names = [desc[0] for desc in cursor.description]
-            df = pd.DataFrame(records, columns=column_names)
-            
-            return df
-            
-        except Exception as error:
-            st.error(f"Error fetching records: {error}")
-        finally:
-            if cursor:
-                cursor.close()
-            if connection:
-                connection.close()
+""", window_start='timestamptz', window_end='timestamptz', employee_ids='integer[]')
+
+
+def low_progression_clients(history, window=DEFAULT_WINDOW, employee_ids=None):
+    # Clients still in stages 1-3 over the window's stage rows
+    since = stage_history.window_start(history, window=REPORT_WINDOWS[window])
+    return stage_history.clients_in_window(
+        history, since, max_stage=3, employee_ids=employee_ids, keys=LOW_PROGRESSION_KEYS,
+    ).sort_values(['employee_name', 'client_id'], kind='stable', ignore_index=True)
+
+
+# Kept current in live mode from the default window's stage rows
+register_view('low_sales_progression.low_progression_clients_data', 'recent', low_progression_clients)
+
+
+def markdown_cell(value):
+    return str(value).replace('|', '\\|')
+
+
+def low_progression_table(page):
+    lines = ["| Sales Rep | Client | Current Stage | FUB Link |", "| --- | --- | --- | --- |"]
+    lines += [
+        f"| {markdown_cell(employee)} | {markdown_cell(client)} | {stage} | [FUB Link]({link}) |"
+        for employee, client, stage, link in zip(
+            page['employee_name'], page['client_name'], page['current_stage'], page['followup_boss_link']
+        )
+    ]
+    return "\n".join(lines)
+
+
+def load_low_sales_progression_data(employee_ids=None, window=DEFAULT_WINDOW):
+    if stage_history.use_replica():
+        # Same aggregation, computed from the local replica's stage history
+        history = stage_history.load_stage_history()
+        if history is None:
+            return {'low_progression_clients_data': None}
+        with timed('low_sales_progression.transform.clients_in_window', kind='transform'):
+            low_progression_clients_data = low_progression_clients(history, window, employee_ids)
+        return {'low_progression_clients_data': low_progression_clients_data}
+
+    params = {**window_bounds(window), 'employee_ids': list(employee_ids) if employee_ids is not None else None}
+    return run_query_graph({
+        'low_progression_clients_data': QueryTask(
+            lambda: cached_report_query(FETCH_LOW_PROGRESSION_CLIENTS_QUERY, params)
+        ),
+    })
+
+
+def show_low_sales_progression():
+    st.title("Low Sales Progression Report")
+
+    window = select_window()
 
     def display_low_progression_clients(df):
-        st.subheader("Clients with Low Progression in the Last 24 Hours")
+        st.subheader(f"Clients with Low Progression in the {WINDOW_LABELS[window].title()}")
         if df.empty:
-            st.write("No clients found with low progression in the last 24 hours.")
+            st.write(f"No clients found with low progression in the {WINDOW_LABELS[window]}.")
             return
 
-        for idx, row in df.iterrows():
-            st.write(f"**Sales Rep:** {row['employee_name']}")
-            st.write(f"**Client:** {row['client_name']} - [FUB Link]({row['followup_boss_link']})")
-            st.write(f"**Current Stage:** {row['current_stage']}")
-            st.write("---")
-
-            # Commented out the message display part
-            # messages = messageParser(row['client_id'])
-            # st.text_area(
-            #     f"Messages with {row['client_name']} (Client ID: {row['client_id']})", 
-            #     messages if messages else "No messages found.", 
-            #     height=150,
-            #     key=f"messages_{row['client_id']}_{idx}"  # Unique key based on client_id and index
-            # )
+        # One page of clients as a single markdown table; message threads
+        # for the page's clients come from one batched query
+        page = with_fub_links(paginate(df, 'low_progression_page', sort_by='employee_name',
+                                       sort_columns=['employee_name', 'client_name', 'client_id', 'current_stage']))
+        st.markdown(low_progression_table(page))
+        threads = MessageThreads(page['client_id'])
+        threads.picker(dict(zip(page['client_id'], page['client_name'])), key='low_progression_messages')
+        # Every client matching the filters, not just this page
+        export_buttons(df, 'low_progression_clients', transform=with_fub_links)
 
     # The "Show Data / Refresh Data" button is not needed since the page refreshes automatically
     today = datetime.today().strftime('%Y-%m-%d')
-    st.markdown(f"**DATE: {today}** (This report contains data from the last 24 hours)")
+    st.markdown(f"**DATE: {today}** (This report contains data from the {WINDOW_LABELS[window]})")
 
-    low_progression_clients_data = fetch_data(fetch_low_progression_clients_query)
+    with timed('low_sales_progression.load'):
+        datasets = report_datasets('low_sales_progression', load_low_sales_progression_data, window=window)
+        low_progression_clients_data = datasets.get('low_progression_clients_data')
 
     if low_progression_clients_data is not None:
-        display_low_progression_clients(low_progression_clients_data)
+        # Employee, stage and client filters narrow the loaded report in
+        # memory, through an index built once per loaded report and window
+        index = get_index_cache('low_progression').get(low_progression_clients_data, key=window)
+        preselected = low_progression_clients_data.loc[
+            low_progression_clients_data['employee_id'].isin(LOW_PROGRESSION_EMPLOYEE_IDS), 'employee_name'
+        ].unique()
+        filters = filter_sidebar(index, 'low_progression', dates=False, default_employees=list(preselected),
+                                 default_employee_ids=LOW_PROGRESSION_EMPLOYEE_IDS)
+
+        def show_low_progression_clients(df):
+            # A live update brings a new frame, with its own cached index
+            if df is low_progression_clients_data:
+                shown = index
+            else:
+                shown = get_index_cache('low_progression_live').get(df)
+            with timed('low_sales_progression.render.low_progression_clients'):
+                display_low_progression_clients(shown.filter(filters))
+
+        live_section('low_sales_progression.low_progression_clients_data', low_progression_clients_data,
+                     show_low_progression_clients, enabled=window == DEFAULT_WINDOW)
@@ -0,0 +1,118 @@
+import numpy as np
+import streamlit as st
+
+from config import get_setting
+from instrumentation import timed
+from queries import cached_report_query, register_query
+from stage_history import client_bounds
+
+# Text message threads of many clients in one round trip: the most recent
+# max_messages of each client, oldest first, with the client's total count
+FETCH_CLIENT_MESSAGES_QUERY = register_query('messages.client_threads', """
+    SELECT
+        client_id,
+        created,
+        status,
+        message,
+        message_count
+    FROM (
+        SELECT
+            tm.client_id,
+            tm.created,
+            tm.status,
+            tm.message,
+            COUNT(*) OVER (PARTITION BY tm.client_id) AS message_count,
+            ROW_NUMBER() OVER (PARTITION BY tm.client_id ORDER BY tm.created DESC, tm.id DESC) AS recency
+        FROM
+            public.textmessage tm
+        WHERE
+            tm.client_id = ANY(%(client_ids)s)
+    ) thread
+    WHERE
+        recency <= %(max_messages)s
+    ORDER BY
+        client_id, recency DESC;
+""", client_ids='integer[]', max_messages='integer')
+
+
+def message_settings():
+    return {
+        'max_messages': int(get_setting("MESSAGES_MAX_PER_CLIENT", 200)),
+        'page_size': int(get_setting("MESSAGES_PAGE_SIZE", 20)),
+    }
+
+
+def load_message_threads(client_ids, max_messages):
+    # Sorted, de-duplicated ids: the same set of clients always hits the same
+    # cache entry, whatever order the report lists them in
+    params = {'client_ids': sorted({int(client_id) for client_id in client_ids}), 'max_messages': max_messages}
+    return cached_report_query(FETCH_CLIENT_MESSAGES_QUERY, params)
+
+
+def format_messages(messages):
+    sender = np.where(messages['status'].to_numpy() == 'Received', 'Client', 'Sales Rep')
+    return ("[" + messages['created'].astype(str) + "] " + sender + ": " + messages['message'].fillna('')).to_numpy()
+
+
+def group_threads(messages):
+    # {client_id: (formatted lines oldest first, total messages)}; rows come
+    # ordered by client, so each thread is one slice
+    ids = messages['client_id'].to_numpy()
+    lines = format_messages(messages)
+    counts = messages['message_count'].to_numpy()
+    starts, ends = client_bounds(ids)
+    return {int(ids[start]): (lines[start:end + 1], int(counts[start])) for start, end in zip(starts, ends)}
+
+
+def page_bounds(loaded, page, page_size):
+    # Page 1 is the most recent page_size messages; slice bounds into the
+    # oldest-first lines
+    end = max(loaded - (page - 1) * page_size, 0)
+    return max(end - page_size, 0), end
+
+
+class MessageThreads:
+    # Threads for every client shown on a page, fetched together the first
+    # time any of them is opened. Opening the others (or paging) then reuses
+    # the same result, from this run or the query cache.
+    def __init__(self, client_ids):
+        self.client_ids = list(client_ids)
+        self.settings = message_settings()
+        self._threads = None
+
+    def thread(self, client_id):
+        if self._threads is None:
+            with timed('messages.load', clients=len(self.client_ids)):
+                messages = load_message_threads(self.client_ids, self.settings['max_messages'])
+            self._threads = group_threads(messages)
+        return self._threads.get(int(client_id), (np.array([], dtype=object), 0))
+
+    def show_thread(self, client_id):
+        try:
+            lines, total = self.thread(client_id)
+        except Exception as error:
+            st.error(f"Error fetching messages: {error}")
+            return
+        if not len(lines):
+            st.write("No messages found.")
+            return
+        page_size = self.settings['page_size']
+        pages = -(-len(lines) // page_size)
+        page = 1
+        if pages > 1:
+            page = st.number_input("Page (1 = most recent)", min_value=1, max_value=pages, value=1,
+                                   key=f"messages_page_{client_id}")
+        start, end = page_bounds(len(lines), page, page_size)
+        st.text("\n".join(lines[start:end]))
+        if total > len(lines):
+            st.caption(f"Showing the latest {len(lines)} of {total} messages")
+
+    def picker(self, clients, key):
+        # One client chooser plus the chosen thread, instead of an expander
+        # per listed client. clients: {client_id: client name}.
+        client_id = st.selectbox(
+            "Messages with", list(clients), format_func=lambda client_id: clients[client_id], index=None,
+            placeholder="Choose a client", key=key,
+        )
+        if client_id is not None:
+            self.show_thread(client_id)
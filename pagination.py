@@ -0,0 +1,139 @@
+import numpy as np
+import pandas as pd
+import streamlit as st
+
+from config import get_setting
+
+
+def page_size():
+    return int(get_setting("TABLE_PAGE_SIZE", 100))
+
+
+def sort_codes(values, descending=False):
+    # Rank of each row's value among the sorted distinct values, nulls last,
+    # and those distinct values (for locating a cursor)
+    if isinstance(values.dtype, pd.CategoricalDtype):
+        # Ranked through the categories, without hashing every row's value
+        categories = values.cat.categories
+        uniques = categories.sort_values()
+        ranks = np.empty(len(categories), dtype=np.int64)
+        ranks[categories.argsort()] = np.arange(len(categories))
+        raw = values.cat.codes.to_numpy()
+        codes = np.where(raw < 0, -1, ranks[raw])
+    else:
+        uniques = pd.Index(values.dropna().unique()).sort_values()
+        codes = uniques.get_indexer(values).astype(np.int64)
+    nulls = codes < 0
+    if descending:
+        codes = len(uniques) - 1 - codes
+    codes[nulls] = len(uniques)
+    return codes, uniques
+
+
+class KeysetPager:
+    # Pages of a frame in (sort column, client_id) order. A page is addressed
+    # by the key of its first row instead of an offset, so it stays put when a
+    # reload adds or drops rows ahead of it, and each page is selected without
+    # sorting the whole frame.
+    def __init__(self, frame, sort_by='client_id', descending=False, key_column='client_id'):
+        self.frame = frame
+        self.sort_by = sort_by
+        self.descending = descending
+        self._values = frame[sort_by]
+        self._ids = frame[key_column].to_numpy(dtype=np.int64)
+        codes, self._uniques = sort_codes(self._values, descending)
+        # (code, id) packed into one int64 so comparisons are single array ops
+        self._span = int(self._ids.max()) + 1 if len(self._ids) else 1
+        self._keys = codes * self._span + self._ids
+
+    def __len__(self):
+        return len(self.frame)
+
+    def cursor(self, row):
+        # Key of a row, in terms that stay meaningful in a reloaded frame
+        value = self._values.iloc[row]
+        return (None if pd.isna(value) else value, int(self._ids[row]))
+
+    def _start_key(self, cursor):
+        if cursor is None:
+            return np.iinfo(np.int64).min
+        value, client_id = cursor
+        count = len(self._uniques)
+        if value is None:
+            code, exact = count, True
+        else:
+            left, right = self._uniques.searchsorted(value, side='left'), self._uniques.searchsorted(value, side='right')
+            exact = right > left
+            code = count - right if self.descending else left
+        # A value no longer present starts at the next one, whatever its ids
+        return code * self._span + (client_id if exact else 0)
+
+    def page(self, cursor=None, limit=100):
+        # (rows from cursor on, offset of the first one, cursor of the next
+        # page or None). Rows sharing the last row's key stay on this page.
+        start = self._start_key(cursor)
+        keys = self._keys
+        candidates = np.flatnonzero(keys >= start)
+        if len(candidates) > limit:
+            boundary = np.partition(keys[candidates], limit - 1)[limit - 1]
+            candidates = candidates[keys[candidates] <= boundary]
+        rows = candidates[np.argsort(keys[candidates], kind='stable')]
+        offset = int(np.count_nonzero(keys < start))
+        later = np.flatnonzero(keys > keys[rows[-1]]) if len(rows) else np.array([], dtype=np.intp)
+        next_cursor = self.cursor(later[np.argmin(keys[later])]) if len(later) else None
+        return self.frame.take(rows), offset, next_cursor
+
+
+def paginate(frame, key, sort_by='client_id', descending=False, sort_columns=None):
+    # Sort and page controls for a report table; returns the rows of the
+    # current page, so only that many are serialized and rendered however
+    # large the frame is. The page start is kept in session state under key.
+    sort_columns = [column for column in sort_columns or frame.columns if column in frame.columns]
+    controls = st.columns([3, 2])
+    sort_by = controls[0].selectbox(
+        "Sort by", sort_columns, index=sort_columns.index(sort_by) if sort_by in sort_columns else 0,
+        key=f"{key}_sort_by",
+    )
+    descending = controls[1].toggle("Descending", value=descending, key=f"{key}_descending")
+
+    state = st.session_state.setdefault(key, {'sort': None, 'starts': []})
+    if state['sort'] != (sort_by, descending):
+        state['sort'], state['starts'] = (sort_by, descending), []
+
+    pager = KeysetPager(frame, sort_by, descending)
+    limit = page_size()
+    try:
+        rows, offset, next_cursor = pager.page(state['starts'][-1] if state['starts'] else None, limit)
+    except TypeError:
+        # A cursor of another type than the reloaded column's values
+        state['starts'] = []
+        rows, offset, next_cursor = pager.page(None, limit)
+    if rows.empty and state['starts']:
+        # Every row from the page start on is gone
+        state['starts'] = []
+        rows, offset, next_cursor = pager.page(None, limit)
+
+    def first():
+        state['starts'].clear()
+
+    def previous():
+        state['starts'].pop()
+
+    def following(cursor):
+        state['starts'].append(cursor)
+
+    navigation = st.columns([1, 1, 1, 4])
+    navigation[0].button("First", key=f"{key}_first", on_click=first, disabled=not state['starts'])
+    navigation[1].button("Previous", key=f"{key}_previous", on_click=previous, disabled=not state['starts'])
+    navigation[2].button("Next", key=f"{key}_next", on_click=following, args=(next_cursor,),
+                         disabled=next_cursor is None)
+    if len(rows):
+        navigation[3].caption(f"Rows {offset + 1:,}–{offset + len(rows):,} of {len(pager):,}")
+    return rows
+
+
+def paged_dataframe(frame, key, display=None, **options):
+    # st.dataframe of one page; display adds derived columns to the page
+    # (e.g. FUB links) so they are computed for the shown rows only
+    rows = paginate(frame, key, **options)
+    st.dataframe(rows if display is None else display(rows))
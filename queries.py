@@ -0,0 +1,108 @@
+import hashlib
+import re
+from collections import namedtuple
+from datetime import datetime, timedelta, timezone
+
+import pandas as pd
+import streamlit as st
+from psycopg2 import errors
+
+from db import QueryTooLarge, get_pool, get_query_cache, with_cursor
+from instrumentation import frame_size, name_queries, timed
+from schema import ingest
+
+# Report windows selectable in the UI; queries take the window as bind
+# parameters, so switching never changes the SQL text or its plan
+REPORT_WINDOWS = {
+    '24h': timedelta(hours=24),
+    '7d': timedelta(days=7),
+    '30d': timedelta(days=30),
+}
+WINDOW_LABELS = {
+    '24h': 'last 24 hours',
+    '7d': 'last 7 days',
+    '30d': 'last 30 days',
+}
+DEFAULT_WINDOW = '24h'
+
+# sql uses %(name)s placeholders; params maps each name to its Postgres type,
+# in the order of the prepared statement's $1, $2, ...
+ReportQuery = namedtuple('ReportQuery', ['name', 'sql', 'params', 'statement'])
+
+# Every parameterized report query, by name
+REPORT_QUERIES = {}
+
+PLACEHOLDER = re.compile(r"%\((\w+)\)s")
+
+
+def register_query(name, sql, **param_types):
+    used = set(PLACEHOLDER.findall(sql))
+    if used != set(param_types):
+        raise ValueError(f"{name}: placeholders {sorted(used)} don't match declared params {sorted(param_types)}")
+    statement = "report_" + hashlib.sha1(sql.encode()).hexdigest()[:16]
+    query = ReportQuery(name, sql, dict(param_types), statement)
+    REPORT_QUERIES[name] = query
+    name_queries({name: sql})
+    return query
+
+
+def prepare_sql(query):
+    positions = {name: i for i, name in enumerate(query.params, 1)}
+    body = PLACEHOLDER.sub(lambda match: f"${positions[match.group(1)]}", query.sql)
+    body = body.replace('%%', '%').strip().rstrip(';')
+    return f"PREPARE {query.statement} ({', '.join(query.params.values())}) AS {body}"
+
+
+def execute_sql(query):
+    return f"EXECUTE {query.statement} ({', '.join(['%s'] * len(query.params))})"
+
+
+def run_report_query(query, params, max_rows=None):
+    # Runs as a server-side prepared statement: prepared once per pooled
+    # connection, then only EXECUTEd with new values, so every window or
+    # employee list reuses the same plan
+    values = [params[name] for name in query.params]
+
+    def handler(cursor):
+        prepared = get_pool().prepared_statements(cursor.connection)
+        for attempt in range(2):
+            try:
+                if query.statement not in prepared:
+                    cursor.execute(prepare_sql(query))
+                    prepared.add(query.statement)
+                cursor.execute(execute_sql(query), values)
+                break
+            except errors.InvalidSqlStatementName:
+                # Dropped on the server (DISCARD ALL, pooler reset); prepare again
+                cursor.connection.rollback()
+                prepared.discard(query.statement)
+                if attempt:
+                    raise
+        records = cursor.fetchall()
+        if max_rows is not None and len(records) > max_rows:
+            raise QueryTooLarge(f"query returned more than {max_rows} rows")
+        return pd.DataFrame(records, columns=[desc[0] for desc in cursor.description])
+
+    with timed(query.name, kind="query", transport="prepared") as event:
+        return frame_size(event, ingest(with_cursor(handler), event))
+
+
+def cached_report_query(query, params, max_rows=None):
+    frame = get_query_cache().get_or_load(query.sql, params, lambda: run_report_query(query, params, max_rows))
+    return frame.copy(deep=False)
+
+
+def window_bounds(window=DEFAULT_WINDOW, now=None):
+    # (window_start, window_end) bind values for "the last <window>". The start
+    # is rounded down to the minute so reruns within a minute share cached
+    # results; window_end None means open-ended (up to now).
+    if now is None:
+        now = datetime.now(timezone.utc).replace(second=0, microsecond=0)
+    return {'window_start': now - REPORT_WINDOWS[window], 'window_end': None}
+
+
+def select_window():
+    # Sidebar picker shared by the windowed reports
+    return st.sidebar.selectbox(
+        "Report window", list(REPORT_WINDOWS), format_func=WINDOW_LABELS.get, key="report_window"
+    )
@@ -0,0 +1,133 @@
+import threading
+import time
+from collections import OrderedDict, namedtuple
+
+CacheEntry = namedtuple("CacheEntry", ["frame", "nbytes", "loaded_at", "version"])
+
+
+def normalize_query(query):
+    # Indentation and line breaks differ between otherwise identical queries
+    return " ".join(query.split())
+
+
+def freeze_params(params):
+    if isinstance(params, dict):
+        return tuple(sorted((key, freeze_params(value)) for key, value in params.items()))
+    if isinstance(params, (list, tuple)):
+        return tuple(freeze_params(value) for value in params)
+    if isinstance(params, (set, frozenset)):
+        return tuple(sorted(freeze_params(value) for value in params))
+    return params
+
+
+class KeyLock:
+    # Per-key load lock, with the number of callers holding or waiting for it
+    # so the last one can drop it from the map
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.users = 0
+
+
+class QueryCache:
+    def __init__(self, ttl=900.0, max_bytes=256 * 1024 * 1024, probe=None, probe_interval=60.0):
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.probe_interval = probe_interval
+        self._probe = probe
+        self._version = None
+        self._probed_at = None
+        self._probe_lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._key_locks = {}
+        self._lock = threading.Lock()
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def current_version(self):
+        # The probe is a cheap "has anything changed" query; it runs at most
+        # once per probe_interval no matter how many sessions ask
+        if self._probe is None:
+            return None
+        with self._probe_lock:
+            now = time.monotonic()
+            if self._probed_at is None or now - self._probed_at >= self.probe_interval:
+                self._version = self._probe()
+                self._probed_at = now
+            return self._version
+
+    def _fresh_entry(self, key, version):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if entry.version != version or time.monotonic() - entry.loaded_at > self.ttl:
+            self._evict(key)
+            return None
+        self._entries.move_to_end(key)
+        return entry
+
+    def _evict(self, key):
+        entry = self._entries.pop(key)
+        self.total_bytes -= entry.nbytes
+
+    def _store(self, key, frame, version):
+        nbytes = int(frame.memory_usage(deep=True).sum())
+        if nbytes > self.max_bytes:
+            return
+        if key in self._entries:
+            self._evict(key)
+        self._entries[key] = CacheEntry(frame, nbytes, time.monotonic(), version)
+        self.total_bytes += nbytes
+        while self.total_bytes > self.max_bytes:
+            self._evict(next(iter(self._entries)))
+
+    def get_or_load(self, query, params, loader):
+        key = (normalize_query(query), freeze_params(params))
+        version = self.current_version()
+        with self._lock:
+            entry = self._fresh_entry(key, version)
+            if entry is not None:
+                self.hits += 1
+                return entry.frame
+            key_lock = self._key_locks.get(key)
+            if key_lock is None:
+                key_lock = self._key_locks[key] = KeyLock()
+            key_lock.users += 1
+
+        # Concurrent misses for the same query wait for the first loader
+        # instead of all hitting the database
+        try:
+            with key_lock.lock:
+                with self._lock:
+                    entry = self._fresh_entry(key, version)
+                    if entry is not None:
+                        self.hits += 1
+                        return entry.frame
+                    self.misses += 1
+                frame = loader()
+                with self._lock:
+                    self._store(key, frame, version)
+                return frame
+        finally:
+            # Keys include per-minute window bounds and id lists, so their
+            # locks can't be kept for the life of the process
+            with self._lock:
+                key_lock.users -= 1
+                if not key_lock.users:
+                    del self._key_locks[key]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.total_bytes = 0
+        with self._probe_lock:
+            self._probed_at = None
+
+    def stats(self):
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "bytes": self.total_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+            }
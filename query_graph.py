@@ -0,0 +1,92 @@
+from collections import namedtuple
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from contextlib import contextmanager
+from contextvars import ContextVar, copy_context
+
+import streamlit as st
+
+from config import get_setting
+
+# run is called with the results of depends_on as keyword arguments. It runs
+# on a worker thread, so it must raise on failure rather than call st.error.
+QueryTask = namedtuple('QueryTask', ['run', 'depends_on'], defaults=[()])
+
+# Set while datasets are built off the script thread (see snapshots.py), where
+# st.error would go nowhere; failures are collected here instead
+collected_errors = ContextVar("collected_errors", default=None)
+
+
+def report_error(error):
+    errors = collected_errors.get()
+    if errors is None:
+        st.error(f"Error fetching records: {error}")
+    else:
+        errors.append(str(error))
+
+
+@contextmanager
+def collect_errors():
+    errors = []
+    token = collected_errors.set(errors)
+    try:
+        yield errors
+    finally:
+        collected_errors.reset(token)
+
+
+@st.cache_resource(show_spinner=False)
+def get_executor():
+    # Shared by all sessions so concurrent viewers can't multiply the threads;
+    # the connection pool still caps how many queries reach Postgres at once
+    return ThreadPoolExecutor(
+        max_workers=int(get_setting("QUERY_WORKERS", 4)),
+        thread_name_prefix="report-query",
+    )
+
+
+def run_query_graph(tasks):
+    # Runs every task as soon as its dependencies are done, so independent
+    # queries overlap and page latency approaches the slowest chain. Failed
+    # tasks are reported here, on the script thread; tasks that depend on
+    # them are skipped. Returns {name: result or None}.
+    executor = get_executor()
+    results = {}
+    failed = set()
+    pending = dict(tasks)
+    running = {}
+
+    while pending or running:
+        # Keep sweeping until nothing else can be started or skipped, so a
+        # failure propagates down a whole dependency chain at once
+        progressed = True
+        while progressed:
+            progressed = False
+            for name, task in list(pending.items()):
+                if any(dep in failed for dep in task.depends_on):
+                    failed.add(name)
+                    results[name] = None
+                elif all(dep in results for dep in task.depends_on):
+                    kwargs = {dep: results[dep] for dep in task.depends_on}
+                    # copy_context carries the run id for timing instrumentation
+                    running[executor.submit(copy_context().run, task.run, **kwargs)] = name
+                else:
+                    continue
+                del pending[name]
+                progressed = True
+
+        if not running:
+            if pending:
+                raise ValueError(f"unresolvable query dependencies: {sorted(pending)}")
+            break
+
+        done, _ = wait(running, return_when=FIRST_COMPLETED)
+        for future in done:
+            name = running.pop(future)
+            try:
+                results[name] = future.result()
+            except Exception as error:
+                report_error(error)
+                failed.add(name)
+                results[name] = None
+
+    return results
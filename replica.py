@@ -0,0 +1,231 @@
+import sqlite3
+import threading
+import time
+from contextlib import closing
+from datetime import datetime, timedelta, timezone
+
+import pandas as pd
+import streamlit as st
+
+from config import get_setting
+from db import iter_query_batches, large_result_settings, with_cursor
+from instrumentation import frame_size, name_queries, timed
+from schema import ingest
+
+# Local copy of the three tables the reports read. Stage rows are
+# append-only, so they are copied incrementally past a high-water mark on
+# created_on; the (small) dimension tables are upserted on every sync.
+# created_on is stored as UTC epoch microseconds, so ORDER BY and MAX()
+# follow the actual instant across DST and offset changes.
+LOCAL_SCHEMA = """
+    CREATE TABLE IF NOT EXISTS client_stage_progression (
+        client_id INTEGER NOT NULL,
+        current_stage INTEGER,
+        stage_name TEXT,
+        created_on INTEGER NOT NULL
+    );
+    -- A UNIQUE constraint treats NULLs as distinct, so rows with a NULL stage
+    -- would be copied again on every sync; the index compares them as values
+    CREATE UNIQUE INDEX IF NOT EXISTS csp_row ON client_stage_progression (
+        client_id, created_on, COALESCE(current_stage, -1), COALESCE(stage_name, '')
+    );
+    CREATE INDEX IF NOT EXISTS csp_created_on ON client_stage_progression (created_on);
+    CREATE TABLE IF NOT EXISTS client (
+        id INTEGER PRIMARY KEY,
+        fullname TEXT,
+        assigned_employee INTEGER
+    );
+    CREATE TABLE IF NOT EXISTS employee (
+        id INTEGER PRIMARY KEY,
+        fullname TEXT
+    );
+    CREATE TABLE IF NOT EXISTS replica_info (
+        name TEXT PRIMARY KEY,
+        value TEXT
+    );
+"""
+# Bumped when stored values change format; an older replica's stage rows
+# are dropped and copied again on the next sync (version 1 stored ISO text,
+# version 2 kept repeats of rows with a NULL stage)
+SCHEMA_VERSION = 3
+
+ALL_STAGE_ROWS_QUERY = """
+    SELECT client_id, current_stage, stage_name, created_on
+    FROM public.client_stage_progression;
+"""
+
+# >= rather than > so rows committed later with the same timestamp as the
+# mark are still picked up; the unique index drops the repeats
+NEW_STAGE_ROWS_QUERY = """
+    SELECT client_id, current_stage, stage_name, created_on
+    FROM public.client_stage_progression
+    WHERE created_on >= %s;
+"""
+
+CLIENTS_QUERY = """
+    SELECT id, fullname, assigned_employee
+    FROM public.client;
+"""
+
+EMPLOYEES_QUERY = """
+    SELECT id, fullname
+    FROM public.employee;
+"""
+
+LOCAL_STAGE_HISTORY_QUERY = """
+    SELECT
+        csp.client_id,
+        c.fullname AS client_name,
+        e.id AS employee_id,
+        e.fullname AS employee_name,
+        csp.current_stage,
+        csp.stage_name,
+        csp.created_on AS time_entered_stage
+    FROM
+        client_stage_progression csp
+    JOIN
+        client c ON csp.client_id = c.id
+    JOIN
+        employee e ON c.assigned_employee = e.id
+    ORDER BY
+        csp.client_id, csp.created_on;
+"""
+
+name_queries({
+    'replica.all_stage_rows': ALL_STAGE_ROWS_QUERY,
+    'replica.new_stage_rows': NEW_STAGE_ROWS_QUERY,
+})
+
+
+EPOCH = datetime(1970, 1, 1)
+
+
+def to_epoch_micros(value):
+    # timestamptz values are normalized to UTC; plain timestamps are stored
+    # as they are
+    if value.tzinfo is not None:
+        value = value.astimezone(timezone.utc).replace(tzinfo=None)
+    return (value - EPOCH) // timedelta(microseconds=1)
+
+
+def from_epoch_micros(micros, aware):
+    value = EPOCH + timedelta(microseconds=micros)
+    return value.replace(tzinfo=timezone.utc) if aware else value
+
+
+class LocalReplica:
+    def __init__(self, path, sync_interval=60.0, batch_size=10000):
+        self.path = path
+        self.sync_interval = sync_interval
+        self.batch_size = batch_size
+        self.synced_at = None
+        self.version = 0
+        self._frame = None
+        self._frame_version = None
+        self._lock = threading.Lock()
+        with closing(self._connect()) as local:
+            if local.execute("PRAGMA user_version").fetchone()[0] < SCHEMA_VERSION:
+                local.executescript("DROP TABLE IF EXISTS client_stage_progression; DROP TABLE IF EXISTS replica_info;")
+            local.executescript(LOCAL_SCHEMA)
+            local.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=30)
+
+    def timestamps_aware(self, local):
+        # Whether the source created_on is timestamptz (None before any rows)
+        row = local.execute("SELECT value FROM replica_info WHERE name = 'timestamps_aware'").fetchone()
+        return None if row is None else row[0] == '1'
+
+    def high_water_mark(self, local):
+        mark = local.execute("SELECT MAX(created_on) FROM client_stage_progression").fetchone()[0]
+        return None if mark is None else from_epoch_micros(mark, self.timestamps_aware(local))
+
+    def _copy_stage_rows(self, local, mark):
+        if mark is None:
+            batches = iter_query_batches(ALL_STAGE_ROWS_QUERY, batch_size=self.batch_size)
+        else:
+            batches = iter_query_batches(NEW_STAGE_ROWS_QUERY, (mark,), batch_size=self.batch_size)
+        for _, rows in batches:
+            if rows and self.timestamps_aware(local) is None:
+                local.execute(
+                    "INSERT INTO replica_info VALUES ('timestamps_aware', ?)", ('1' if rows[0][3].tzinfo else '0',)
+                )
+            local.executemany(
+                "INSERT OR IGNORE INTO client_stage_progression VALUES (?, ?, ?, ?)",
+                [(client_id, stage, name, to_epoch_micros(created_on))
+                 for client_id, stage, name, created_on in rows],
+            )
+
+    def _upsert_dimensions(self, local):
+        def fetch_all(query):
+            def handler(cursor):
+                cursor.execute(query)
+                return cursor.fetchall()
+            return with_cursor(handler)
+
+        local.executemany(
+            """
+            INSERT INTO client VALUES (?, ?, ?)
+            ON CONFLICT (id) DO UPDATE SET
+                fullname = excluded.fullname,
+                assigned_employee = excluded.assigned_employee
+            WHERE fullname IS NOT excluded.fullname
+                OR assigned_employee IS NOT excluded.assigned_employee
+            """,
+            fetch_all(CLIENTS_QUERY),
+        )
+        local.executemany(
+            """
+            INSERT INTO employee VALUES (?, ?)
+            ON CONFLICT (id) DO UPDATE SET fullname = excluded.fullname
+            WHERE fullname IS NOT excluded.fullname
+            """,
+            fetch_all(EMPLOYEES_QUERY),
+        )
+
+    def sync(self):
+        # Returns the number of local rows inserted or updated
+        with self._lock, closing(self._connect()) as local, timed("replica.sync", kind="db") as event:
+            changes_before = local.total_changes
+            self._copy_stage_rows(local, self.high_water_mark(local))
+            self._upsert_dimensions(local)
+            local.commit()
+            changed = event['rows'] = local.total_changes - changes_before
+            if changed:
+                self.version += 1
+            self.synced_at = time.monotonic()
+            return changed
+
+    def load_stage_history(self):
+        if self.synced_at is None or time.monotonic() - self.synced_at >= self.sync_interval:
+            self.sync()
+        with self._lock:
+            if self._frame is None or self._frame_version != self.version:
+                with closing(self._connect()) as local, timed("replica.stage_history", kind="query") as event:
+                    frame = pd.read_sql_query(LOCAL_STAGE_HISTORY_QUERY, local)
+                    # timestamptz rows come back in UTC, as ingest() gives
+                    # Postgres results with mixed offsets; plain timestamps
+                    # stay naive
+                    aware = bool(self.timestamps_aware(local))
+                    times = pd.to_datetime(frame['time_entered_stage'], unit='us', utc=aware)
+                    frame['time_entered_stage'] = times.astype('datetime64[us, UTC]' if aware else 'datetime64[us]')
+                    frame = frame_size(event, ingest(frame, event))
+                self._frame = frame
+                self._frame_version = self.version
+            return self._frame.copy(deep=False)
+
+
+@st.cache_resource(show_spinner=False)
+def get_replica():
+    return LocalReplica(
+        get_setting("REPLICA_PATH", "replica.sqlite3"),
+        sync_interval=float(get_setting("REPLICA_SYNC_SECONDS", 60)),
+        batch_size=large_result_settings()['batch_size'],
+    )
+
+
+if __name__ == "__main__":
+    # Can also be run from cron to keep the replica warm between page views
+    replica = get_replica()
+    print(f"Synced {replica.sync()} rows into {replica.path}")
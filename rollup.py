@@ -0,0 +1,230 @@
+import argparse
+import logging
+import os
+
+import psycopg2
+
+from config import get_setting
+from db import cached_scalar, with_cursor
+from instrumentation import name_queries, timed
+from stages import stage_case_sql
+
+logger = logging.getLogger(__name__)
+
+DDL_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "sql", "client_stage_rollup.sql")
+
+ROLLUP_EXISTS_QUERY = """
+    SELECT to_regclass('public.client_stage_rollup') IS NOT NULL;
+"""
+
+# The DDL declares the rollup's timestamps with this type, so they are
+# copied without a conversion through the session TimeZone
+CREATED_ON_TYPE_QUERY = """
+    SELECT format_type(atttypid, atttypmod)
+    FROM pg_attribute
+    WHERE attrelid = 'public.client_stage_progression'::regclass AND attname = 'created_on';
+"""
+
+# Recomputes the rollup rows of every client matched by {changed_clients}
+# from that client's full history, so a refresh can be repeated safely
+REFRESH_CLIENTS_QUERY_TEMPLATE = """
+    WITH changed AS (
+        {changed_clients}
+    ),
+    history AS (
+        SELECT csp.client_id, csp.current_stage, csp.stage_name, csp.created_on
+        FROM public.client_stage_progression csp
+        WHERE csp.client_id IN (SELECT client_id FROM changed)
+    ),
+    latest AS (
+        SELECT DISTINCT ON (client_id) client_id, current_stage, stage_name
+        FROM history
+        ORDER BY client_id, created_on DESC, current_stage DESC
+    ),
+    totals AS (
+        SELECT
+            client_id,
+            MIN(created_on) AS first_stage_time,
+            MAX(created_on) AS last_stage_time,
+            MAX(current_stage) AS max_stage,
+            COUNT(*) - 1 AS transition_count
+        FROM history
+        GROUP BY client_id
+    )
+    INSERT INTO public.client_stage_rollup AS r (
+        client_id, latest_stage, latest_stage_name, first_stage_time,
+        last_stage_time, max_stage, transition_count, refreshed_at
+    )
+    SELECT
+        t.client_id, l.current_stage, l.stage_name, t.first_stage_time,
+        t.last_stage_time, t.max_stage, t.transition_count, now()
+    FROM totals t
+    JOIN latest l ON l.client_id = t.client_id
+    ON CONFLICT (client_id) DO UPDATE SET
+        latest_stage = excluded.latest_stage,
+        latest_stage_name = excluded.latest_stage_name,
+        first_stage_time = excluded.first_stage_time,
+        last_stage_time = excluded.last_stage_time,
+        max_stage = excluded.max_stage,
+        transition_count = excluded.transition_count,
+        refreshed_at = excluded.refreshed_at;
+"""
+
+ALL_CLIENTS = "SELECT DISTINCT client_id FROM public.client_stage_progression"
+
+# >= so rows committed after the last refresh with the mark's timestamp are
+# still seen; recomputing a client twice is harmless
+CLIENTS_CHANGED_SINCE = "SELECT DISTINCT client_id FROM public.client_stage_progression WHERE created_on >= %(since)s"
+
+# Concurrent refreshes (cron plus dashboard sessions) would only repeat the
+# same work; the loser of this lock skips its refresh
+REFRESH_LOCK_KEY = 0x726f6c6c7570
+
+
+def rollup_exists():
+    # Cached like any report query, so checking costs nothing per rerun. A
+    # failed check falls back to the full-history queries, which report the
+    # database error themselves.
+    try:
+        return bool(cached_scalar(ROLLUP_EXISTS_QUERY))
+    except psycopg2.Error:
+        return False
+
+
+def use_rollup():
+    return get_setting("USE_CLIENT_ROLLUP", True) and rollup_exists()
+
+
+def create_rollup():
+    with open(DDL_PATH) as f:
+        ddl = f.read()
+
+    def handler(cursor):
+        cursor.execute(CREATED_ON_TYPE_QUERY)
+        cursor.execute(ddl.format(created_on_type=cursor.fetchone()[0]))
+        cursor.connection.commit()
+
+    with_cursor(handler)
+
+
+def refresh_rollup(full=False, max_age=None):
+    # Brings the rollup up to date with client_stage_progression. Returns the
+    # number of client rows rewritten, or None when another refresh holds the
+    # lock or the last one is younger than max_age seconds.
+    def handler(cursor):
+        cursor.execute("SELECT pg_try_advisory_xact_lock(%s)", (REFRESH_LOCK_KEY,))
+        if not cursor.fetchone()[0]:
+            return None
+        cursor.execute(
+            "SELECT high_water_mark, EXTRACT(EPOCH FROM now() - refreshed_at) "
+            "FROM public.client_stage_rollup_state"
+        )
+        state = cursor.fetchone()
+        mark, age = state if state else (None, None)
+        if max_age is not None and age is not None and age < max_age:
+            return None
+
+        cursor.execute("SELECT MAX(created_on) FROM public.client_stage_progression")
+        new_mark = cursor.fetchone()[0]
+        if full or mark is None:
+            cursor.execute("TRUNCATE public.client_stage_rollup")
+            cursor.execute(REFRESH_CLIENTS_QUERY_TEMPLATE.format(changed_clients=ALL_CLIENTS))
+        else:
+            cursor.execute(REFRESH_CLIENTS_QUERY_TEMPLATE.format(changed_clients=CLIENTS_CHANGED_SINCE),
+                           {'since': mark})
+        changed = cursor.rowcount
+        cursor.execute(
+            """
+            INSERT INTO public.client_stage_rollup_state (id, high_water_mark, refreshed_at)
+            VALUES (true, %s, now())
+            ON CONFLICT (id) DO UPDATE SET
+                high_water_mark = COALESCE(excluded.high_water_mark, client_stage_rollup_state.high_water_mark),
+                refreshed_at = excluded.refreshed_at
+            """,
+            (new_mark,),
+        )
+        cursor.connection.commit()
+        return changed
+
+    with timed("rollup.refresh", kind="db") as event:
+        changed = event['rows'] = with_cursor(handler)
+    return changed
+
+
+def refresh_if_stale():
+    # An incremental refresh before reading the rollup once the last one is
+    # ROLLUP_REFRESH_SECONDS old. It writes to the database, so it is off by
+    # default (0) and refreshes come from `python rollup.py` in cron. A
+    # failed refresh (read-only role, lock or statement timeout) is logged
+    # and the rollup is read as it is.
+    max_age = float(get_setting("ROLLUP_REFRESH_SECONDS", 0))
+    if not max_age:
+        return None
+    try:
+        return refresh_rollup(max_age=max_age)
+    except psycopg2.Error:
+        logger.exception("could not refresh client_stage_rollup; reading it as it is")
+        return None
+
+
+# Same shapes as the window-function queries in sales_leads.py, read from
+# one row per client. A client whose newest rows share a timestamp now gets
+# a single row (the highest stage) instead of one per tied row.
+ROLLUP_LATEST_STAGE_QUERY = """
+    SELECT
+        r.client_id,
+        c.fullname AS client_name,
+        e.fullname AS employee_name,
+        {stage_case} AS latest_stage_name
+    FROM
+        public.client_stage_rollup r
+    JOIN
+        public.client c ON r.client_id = c.id
+    JOIN
+        public.employee e ON c.assigned_employee = e.id
+    ORDER BY
+        r.client_id;
+""".format(stage_case=stage_case_sql('r.latest_stage'))
+
+ROLLUP_EMPLOYEE_STAGE_QUERY = """
+    SELECT
+        r.client_id,
+        e.fullname AS employee_name,
+        c.fullname AS client_name,
+        r.latest_stage_name AS current_stage_name
+    FROM
+        public.client_stage_rollup r
+    JOIN
+        public.client c ON r.client_id = c.id
+    JOIN
+        public.employee e ON c.assigned_employee = e.id
+    ORDER BY
+        e.fullname, c.fullname;
+"""
+
+name_queries({
+    'rollup.exists': ROLLUP_EXISTS_QUERY,
+    'rollup.latest_stage': ROLLUP_LATEST_STAGE_QUERY,
+    'rollup.employee_stage': ROLLUP_EMPLOYEE_STAGE_QUERY,
+})
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Create or refresh the client_stage_rollup table")
+    parser.add_argument('--create', action='store_true', help='run the DDL in sql/client_stage_rollup.sql first')
+    parser.add_argument('--full', action='store_true', help='rebuild every client instead of only changed ones')
+    args = parser.parse_args()
+
+    if args.create:
+        create_rollup()
+    # Creating (or retyping) the table rebuilds every client
+    changed = refresh_rollup(full=args.full or args.create)
+    if changed is None:
+        print("Another refresh is running; skipped")
+    else:
+        print(f"Refreshed {changed} client rows")
+
+
+if __name__ == "__main__":
+    # Run from cron when ROLLUP_REFRESH_SECONDS is 0
+    main()
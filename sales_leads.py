@@ -1,138 +1,46 @@
-import psycopg2
-import pandas as pd
 import streamlit as st
-import matplotlib.pyplot as plt
 from datetime import datetime
-def show_sales_leads():
-    st.title("Sales Leads Monitoring")
-
-    db_params = {
-        'dbname': st.secrets["database"]["DB_NAME"],
-        'user': st.secrets["database"]["DB_USER"],
-        'password': st.secrets["database"]["DB_PASSWORD"],
-        'host': st.secrets["database"]["DB_HOST"],
-        'port': st.secrets["database"]["DB_PORT"]
-    }
-    fetch_max_stages_query = """
-    WITH StageHistory AS (
-        SELECT 
-            csp.client_id,
-            ROW_NUMBER() OVER (PARTITION BY csp.client_id ORDER BY csp.created_on ASC) AS stage_order
-        FROM 
-            public.client_stage_progression csp
-    )
-    SELECT MAX(stage_order) AS max_stage
-    FROM StageHistory;
-    """
-
-    # Step 2: Adjust the Data Fetch Query
-    def fetch_dynamic_stages_query(max_stage):
-        stages_select = ",\n".join(
-            [f"MAX(CASE WHEN ds.stage_number = {i} THEN ds.stage_name END) AS Data_{i}_recorded," +
-            f"MAX(CASE WHEN ds.stage_number = {i} THEN ds.time_entered_stage END) AS Time_for_data{i}_recorded"
-            for i in range(1, max_stage + 1)]
-        )
+import classification
+import rollup
+import stage_history
+from charts import render_chart, rotate_xticklabels
+from config import get_setting
+from exports import export_buttons
+from db import cached_query, large_result_settings
+from instrumentation import name_queries, timed
+from live_updates import live_section, register_view
+from pagination import paged_dataframe
+from query_graph import QueryTask, run_query_graph
+from schema import with_fub_links
+from snapshots import report_datasets
+from stages import stage_case_sql
 
-        return f"""
-        WITH StageHistory AS (
-            SELECT 
-                csp.client_id,
-                c.fullname AS client_name,
-                e.fullname AS employee_name,
-                csp.current_stage,
-                csp.created_on AS time_entered_stage,
-                csp.stage_name,
-                ROW_NUMBER() OVER (PARTITION BY csp.client_id ORDER BY csp.created_on ASC) AS stage_order
-            FROM 
-                public.client_stage_progression csp
-            JOIN 
-                public.client c ON csp.client_id = c.id
-            JOIN 
-                public.employee e ON c.assigned_employee = e.id
-        ),
-        ClientTimeDiff AS (
-            SELECT 
-                client_id,
-                MIN(time_entered_stage) AS first_stage_time,
-                MAX(time_entered_stage) AS last_stage_time,
-                EXTRACT(EPOCH FROM (MAX(time_entered_stage) - MIN(time_entered_stage))) / 3600 AS time_diff_hours,
-                MAX(current_stage) AS max_stage_reached
-            FROM 
-                StageHistory
-            GROUP BY 
-                client_id
-        ),
-        DynamicStages AS (
-            SELECT
-                client_id,
-                stage_name,
-                time_entered_stage,
-                ROW_NUMBER() OVER (PARTITION BY client_id ORDER BY time_entered_stage) AS stage_number
-            FROM
-                StageHistory
-        )
-        SELECT 
-            sh.client_id,
-            CONCAT('https://services.followupboss.com/2/people/view/', sh.client_id) AS followup_boss_link,
-            sh.client_name,
-            sh.employee_name,
-            {stages_select}
-        FROM 
-            StageHistory sh
-        LEFT JOIN 
-            DynamicStages ds ON sh.client_id = ds.client_id
-        GROUP BY 
-            sh.client_id, sh.client_name, sh.employee_name
-        ORDER BY 
-            sh.client_id;
-        """
-
-    # SQL query to calculate the average time difference for clients whose current_stage=8
-    calculate_average_time_diff_query = """
-    WITH StageHistory AS (
-        SELECT 
-            csp.client_id,
-            csp.created_on AS time_entered_stage,
-            ROW_NUMBER() OVER (PARTITION BY csp.client_id ORDER BY csp.created_on ASC) AS stage_order
-        FROM 
-            public.client_stage_progression csp
-        WHERE 
-            csp.current_stage = 8
-    ),
-    ClientTimeDiff AS (
-        SELECT 
-            client_id,
-            MIN(time_entered_stage) AS first_stage_time,
-            MAX(time_entered_stage) AS last_stage_time,
-            EXTRACT(EPOCH FROM (MAX(time_entered_stage) - MIN(time_entered_stage))) / 3600 AS time_diff_hours
-        FROM 
-            StageHistory
-        GROUP BY 
-            client_id
-    )
+# Narrow long-format stage history; it is pivoted into one column pair per
+# recorded stage in pandas, so a long history no longer widens the SQL, and
+# the client classification is computed from the same rows. Rows come
+# ordered by client and time, so positions are numbered in pandas too.
+FETCH_STAGE_HISTORY_QUERY = """
     SELECT 
-        AVG(time_diff_hours) AS avg_time_diff_hours
+        csp.client_id,
+        csp.current_stage,
+        csp.stage_name,
+        csp.created_on AS time_entered_stage
     FROM 
-        ClientTimeDiff;
-    """
+        public.client_stage_progression csp
+    JOIN 
+        public.client c ON csp.client_id = c.id
+    JOIN 
+        public.employee e ON c.assigned_employee = e.id
+    ORDER BY 
+        csp.client_id, csp.created_on;
+"""
 
-    fetch_latest_stage_query = """
+FETCH_LATEST_STAGE_QUERY = """
     SELECT 
         csp.client_id,
         c.fullname AS client_name,
         e.fullname AS employee_name,
-        CASE 
-            WHEN csp.current_stage = 2 THEN 'Stage 2: Initial Contact'
-            WHEN csp.current_stage = 3 THEN 'Stage 3: Requirement Collection'
-            WHEN csp.current_stage = 4 THEN 'Stage 4: Property Touring'
-            WHEN csp.current_stage = 5 THEN 'Stage 5: Property Tour and Feedback'
-            WHEN csp.current_stage = 6 THEN 'Stage 6: Application and Approval'
-            WHEN csp.current_stage = 7 THEN 'Stage 7: Post-Approval and Follow-Up'
-            WHEN csp.current_stage = 8 THEN 'Stage 8: Commission Collection'
-            WHEN csp.current_stage = 1 THEN 'Stage 1: Not Interested'
-            WHEN csp.current_stage = 9 THEN 'Stage 9: Dead Stage'
-            ELSE 'Unknown Stage'
-        END AS latest_stage_name
+        {stage_case} AS latest_stage_name
     FROM 
         public.client_stage_progression csp
     JOIN 
@@ -147,14 +55,12 @@ def show_sales_leads():
         )
     ORDER BY 
         csp.client_id;
-    """
-
+""".format(stage_case=stage_case_sql('csp.current_stage'))
 
-    # SQL query to fetch employee-wise client stage information
-    fetch_employee_stage_query = """
+# SQL query to fetch employee-wise client stage information
+FETCH_EMPLOYEE_STAGE_QUERY = """
     SELECT 
         csp.client_id,
-        CONCAT('https://services.followupboss.com/2/people/view/', csp.client_id) AS followup_boss_link,
         e.fullname AS employee_name,
         c.fullname AS client_name,
         csp.stage_name AS current_stage_name
@@ -172,175 +78,114 @@ def show_sales_leads():
         )
     ORDER BY 
         e.fullname, c.fullname;
-    """
-
-    # SQL query to classify clients based on the calculated average time difference
-    calculate_average_time_diff_query = """
-    WITH StageHistory AS (
-        SELECT 
-            csp.client_id,
-            csp.current_stage,
-            csp.created_on AS time_entered_stage,
-            ROW_NUMBER() OVER (PARTITION BY csp.client_id ORDER BY csp.created_on DESC) AS row_num -- Ordering DESC to get the last row
-        FROM 
-            public.client_stage_progression csp
-    ),
-    ClientTimeDiff AS (
-        SELECT 
-            client_id,
-            MIN(time_entered_stage) AS first_stage_time,
-            MAX(time_entered_stage) AS last_stage_time,
-            current_stage,
-            EXTRACT(EPOCH FROM (MAX(time_entered_stage) - MIN(time_entered_stage))) / 3600 AS time_diff_hours
-        FROM 
-            StageHistory
-        WHERE 
-            row_num = 1 -- Selecting only the last row for each client
-        GROUP BY 
-            client_id, current_stage
-        HAVING
-            current_stage = 8 -- Ensure that the last stage is 8
-    )
-    SELECT 
-        AVG(time_diff_hours) AS avg_time_diff_hours
-    FROM 
-        ClientTimeDiff;
-    """
-
-    # SQL query to classify clients based on the calculated average time difference
-    classify_clients_query_template = """
-    WITH StageHistory AS (
-        SELECT 
-            csp.client_id,
-            csp.current_stage,
-            csp.created_on AS time_entered_stage,
-            ROW_NUMBER() OVER (PARTITION BY csp.client_id ORDER BY csp.created_on DESC) AS row_num -- Ordering DESC to get the last row
-        FROM 
-            public.client_stage_progression csp
-    ),
-    ClientTimeDiff AS (
-        SELECT 
-            client_id,
-            MIN(time_entered_stage) AS first_stage_time,
-            MAX(time_entered_stage) AS last_stage_time,
-            current_stage,
-            EXTRACT(EPOCH FROM (MAX(time_entered_stage) - MIN(time_entered_stage))) / 3600 AS time_diff_hours
-        FROM 
-            StageHistory
-        WHERE 
-            row_num = 1 -- Selecting only the last row for each client
-        GROUP BY 
-            client_id, current_stage
-    )
-    SELECT 
-        ctd.client_id,
-        c.fullname AS client_name,
-        e.fullname AS employee_name,
-        CASE 
-            WHEN ctd.current_stage = 8 AND ctd.time_diff_hours <= {avg_time_diff_hours} THEN 'NORMAL CLIENT'
-            ELSE 'NOT NORMAL CLIENT'
-        END AS client_status
-    FROM 
-        ClientTimeDiff ctd
-    JOIN 
-        public.client c ON ctd.client_id = c.id
-    JOIN 
-        public.employee e ON c.assigned_employee = e.id
-    ORDER BY 
-        ctd.client_id;
-    """
-    def fetch_max_stage():
-        connection = None
-        cursor = None
-        try:
-            # Connect to the database
-            connection = psycopg2.connect(**db_params)
-            cursor = connection.cursor()
-            
-            # Execute the query to fetch the maximum number of stages
-            cursor.execute(fetch_max_stages_query)
-            
-            # Fetch the result (maximum stage number)
-            max_stage = cursor.fetchone()[0]
-            
-            return max_stage
-            
-        except Exception as error:
-            st.error(f"Error fetching maximum stage: {error}")
-        finally:
-            # Close the cursor and connection
-            if cursor:
-                cursor.close()
-            if connection:
-                connection.close()
-
-    def fetch_data(query):
-        connection = None
-        cursor = None
-        try:
-            # Connect to the database
-            connection = psycopg2.connect(**db_params)
-            cursor = connection.cursor()
-            
-            # Execute the query to fetch records
-            cursor.execute(query)
-            
-            # Fetch all records
-            records = cursor.fetchall()
-            
-            # Get column names from cursor
-            column_names = [desc[0] for desc in cursor.description]
-            
-            # Create a pandas DataFrame from the records
-            df = pd.DataFrame(records, columns=column_names)
-            
-            return df
-            
-        except Exception as error:
-            st.error(f"Error fetching records: {error}")
-        finally:
-            # Close the cursor and connection
-            if cursor:
-                cursor.close()
-            if connection:
-                connection.close()
-
-    def fetch_average_time_diff():
-        connection = None
-        cursor = None
-        try:
-            # Connect to the database
-            connection = psycopg2.connect(**db_params)
-            cursor = connection.cursor()
-            
-            # Execute the query to calculate average time difference
-            cursor.execute(calculate_average_time_diff_query)
-            
-            # Fetch the result (average time difference)
-            avg_time_diff = cursor.fetchone()[0]
-            
-            return avg_time_diff
-            
-        except Exception as error:
-            st.error(f"Error calculating average time difference: {error}")
-        finally:
-            # Close the cursor and connection
-            if cursor:
-                cursor.close()
-            if connection:
-                connection.close()
+"""
+
+name_queries({
+    'sales_leads.stage_history': FETCH_STAGE_HISTORY_QUERY,
+    'sales_leads.latest_stage': FETCH_LATEST_STAGE_QUERY,
+    'sales_leads.employee_stage': FETCH_EMPLOYEE_STAGE_QUERY,
+})
+
+# Sections kept current in live mode, from every client's latest stage rows
+register_view('sales_leads.latest_stage_data', 'latest', stage_history.latest_stage_data)
+register_view('sales_leads.employee_stage_data', 'latest', stage_history.employee_stage_data)
+
+
+def sales_leads_tasks(engine):
+    # "snapshot" derives every view from one long-format history scan; "sql"
+    # runs the per-view queries, and the classification is computed from the
+    # narrow history rows. The local replica only supports the snapshot engine.
+    large = large_result_settings()
+    if engine == "snapshot" or stage_history.use_replica():
+        return {'history': QueryTask(stage_history.stage_history_frame)}
+
+    # With the per-client rollup in place the latest-stage queries read one
+    # row per client instead of sorting the full history
+    if rollup.use_rollup():
+        # Opt-in and best-effort; the reads don't depend on it succeeding
+        rollup.refresh_if_stale()
+        latest_query = rollup.ROLLUP_LATEST_STAGE_QUERY
+        employee_query = rollup.ROLLUP_EMPLOYEE_STAGE_QUERY
+    else:
+        latest_query = FETCH_LATEST_STAGE_QUERY
+        employee_query = FETCH_EMPLOYEE_STAGE_QUERY
+
+    return {
+        'latest_stage_data': QueryTask(lambda: cached_query(latest_query, **large)),
+        'stage_rows': QueryTask(lambda: cached_query(FETCH_STAGE_HISTORY_QUERY, **large)),
+        'employee_stage_data': QueryTask(lambda: cached_query(employee_query, **large)),
+    }
+
+
+def load_sales_leads_data(engine=None):
+    engine = engine or get_setting("SALES_LEADS_ENGINE", "snapshot")
+    results = run_query_graph(sales_leads_tasks(engine))
+
+    if 'history' in results:
+        history = results['history']
+        if history is None:
+            return dict.fromkeys(['data', 'latest_stage_data', 'employee_stage_data', 'classified_clients_data'])
+        datasets = {}
+        with timed('sales_leads.transform.pivot', kind='transform'):
+            datasets['data'] = stage_history.pivot_stage_history(history)
+        with timed('sales_leads.transform.latest_stage_data', kind='transform'):
+            datasets['latest_stage_data'] = stage_history.latest_stage_data(history)
+        with timed('sales_leads.transform.employee_stage_data', kind='transform'):
+            datasets['employee_stage_data'] = stage_history.employee_stage_data(history)
+        with timed('sales_leads.transform.classify_clients', kind='transform'):
+            datasets['classified_clients_data'] = classification.classify(classification.client_durations(history))
+        return datasets
+
+    # Client and employee names for the wide table come from the latest-stage rows
+    stage_rows, latest_stage_data = results['stage_rows'], results['latest_stage_data']
+    if stage_rows is not None and latest_stage_data is not None:
+        with timed('sales_leads.transform.pivot', kind='transform'):
+            data = stage_history.pivot_stage_history(stage_rows, clients=latest_stage_data)
+        with timed('sales_leads.transform.classify_clients', kind='transform'):
+            classified_clients_data = classification.classify(
+                classification.client_durations(stage_rows, clients=latest_stage_data)
+            )
+    else:
+        data = classified_clients_data = None
+    return {
+        'data': data,
+        'latest_stage_data': latest_stage_data,
+        'employee_stage_data': results['employee_stage_data'],
+        'classified_clients_data': classified_clients_data,
+    }
+
+
+def draw_latest_stage_summary(ax, stage_summary):
+    ax.bar(stage_summary['latest_stage_name'], stage_summary['Number of Clients'])
+    ax.set_xlabel('Stage')
+    ax.set_ylabel('Number of Clients')
+    ax.set_title('Clients in Latest Stage')
+    rotate_xticklabels(ax)
+
+
+def draw_employee_stage_summary(ax, employee_stage_summary):
+    employee_stage_summary.plot(kind='bar', stacked=True, ax=ax)
+    ax.set_xlabel('Employee', fontsize=12)
+    ax.set_ylabel('Number of Clients', fontsize=12)
+    ax.set_title('Client Stages by Employee', fontsize=16)
+    rotate_xticklabels(ax, fontsize=10)  # Adjust the rotation and font size for x-axis labels
+    ax.tick_params(axis='y', labelsize=10)  # Adjust the font size for y-axis labels
+
+
+def show_sales_leads():
+    st.title("Sales Leads Monitoring")
 
     # Add a refresh button
     # if st.button('Show Data / Refresh Data'):
-    # Fetch the average time difference for clients in stage 8
     
     st.markdown(f"**DATE: {datetime.today().strftime('%Y-%m-%d')}** (This report contains data from the last 24 hours)")
 
-    avg_time_diff_hours = fetch_average_time_diff()
-
-    max_stage = fetch_max_stage()    # Fetch data for the client stage progression report
-    dynamic_query = fetch_dynamic_stages_query(max_stage)
-    data = fetch_data(dynamic_query)
+    with timed('sales_leads.load'):
+        datasets = report_datasets('sales_leads', load_sales_leads_data)
+    data = datasets.get('data')
+    latest_stage_data = datasets.get('latest_stage_data')
+    employee_stage_data = datasets.get('employee_stage_data')
+    classified_clients_data = datasets.get('classified_clients_data')
 
     # Rename columns to "First_Stage_Recorded", "Second_Stage_Recorded", etc.
     rename_columns = {
@@ -368,62 +213,59 @@ def show_sales_leads():
     if data is not None:
         data.rename(columns=rename_columns, inplace=True)
 
-    # Display the data in a Streamlit table
+    # Display the data in a Streamlit table, one page of clients at a time
     if data is not None:
-        st.dataframe(data)
-        st.write(f"Total records fetched: {len(data)}")
-
-    # Fetch the latest stage each client is in for the summary
-    latest_stage_data = fetch_data(fetch_latest_stage_query)
+        with timed('sales_leads.render.stage_history_table'):
+            paged_dataframe(data, 'sales_leads_stage_history', display=lambda rows: with_fub_links(rows, loc=1))
+            st.write(f"Total records fetched: {len(data)}")
+            export_buttons(data, 'stage_history', transform=lambda rows: with_fub_links(rows, loc=1))
 
     # Display the summarized data in a table
+    def show_latest_stage_summary(latest_stage_data):
+        with timed('sales_leads.render.latest_stage_summary'):
+            stage_summary = latest_stage_data.groupby('latest_stage_name', observed=True).size().reset_index(name='Number of Clients')
+            st.subheader("Summary of Clients in Latest Stage")
+            st.table(stage_summary)
+            export_buttons(stage_summary, 'latest_stage_summary')
+
+            # Create a bar chart to visualize the summary
+            st.subheader("Bar Chart of Clients in Latest Stage")
+            render_chart('latest_stage_summary', stage_summary, draw_latest_stage_summary)
+
+    def show_employee_stage(employee_stage_data):
+        with timed('sales_leads.render.employee_stage'):
+            st.subheader("Client Stages by Employee")
+
+            # Display the data in a tabular form
+            paged_dataframe(employee_stage_data, 'sales_leads_employee_stage', sort_by='employee_name',
+                            display=lambda rows: with_fub_links(rows, loc=1))
+            export_buttons(employee_stage_data, 'employee_stage', transform=lambda rows: with_fub_links(rows, loc=1))
+
+            # Create a bar chart to visualize the number of clients per employee in different stages
+            st.subheader("Bar Chart of Client Stages by Employee")
+            employee_stage_summary = employee_stage_data.groupby(['employee_name', 'current_stage_name'], observed=True).size().unstack().fillna(0)
+            render_chart(
+                'employee_stage_summary', employee_stage_summary, draw_employee_stage_summary,
+                figsize=(14, 8),  # Increase the figure size
+            )
+
+    # In live mode these sections follow new stage rows as they are inserted
     if latest_stage_data is not None:
-        stage_summary = latest_stage_data.groupby('latest_stage_name').size().reset_index(name='Number of Clients')
-        st.subheader("Summary of Clients in Latest Stage")
-        st.table(stage_summary)
-        
-        # Create a bar chart to visualize the summary
-        st.subheader("Bar Chart of Clients in Latest Stage")
-        fig, ax = plt.subplots()
-        ax.bar(stage_summary['latest_stage_name'], stage_summary['Number of Clients'])
-        ax.set_xlabel('Stage')
-        ax.set_ylabel('Number of Clients')
-        ax.set_title('Clients in Latest Stage')
-        plt.xticks(rotation=45, ha='right')
-        st.pyplot(fig)
-    
-    # Fetch employee-wise client stage information
-    employee_stage_data = fetch_data(fetch_employee_stage_query)
+        live_section('sales_leads.latest_stage_data', latest_stage_data, show_latest_stage_summary)
 
     if employee_stage_data is not None:
-        st.subheader("Client Stages by Employee")
-        
-        # Display the data in a tabular form
-        st.dataframe(employee_stage_data)
-
-    # Create a bar chart to visualize the number of clients per employee in different stages
-    st.subheader("Bar Chart of Client Stages by Employee")
-    fig, ax = plt.subplots(figsize=(14, 8))  # Increase the figure size
-    employee_stage_summary = employee_stage_data.groupby(['employee_name', 'current_stage_name']).size().unstack().fillna(0)
-    employee_stage_summary.plot(kind='bar', stacked=True, ax=ax)
-    ax.set_xlabel('Employee', fontsize=12)
-    ax.set_ylabel('Number of Clients', fontsize=12)
-    ax.set_title('Client Stages by Employee', fontsize=16)
-    plt.xticks(rotation=45, ha='right', fontsize=10)  # Adjust the rotation and font size for x-axis labels
-    plt.yticks(fontsize=10)  # Adjust the font size for y-axis labels
-    st.pyplot(fig)
-    
-    # Classify clients as NORMAL or NOT NORMAL based on the calculated average time difference
-    classify_clients_query = classify_clients_query_template.format(avg_time_diff_hours=avg_time_diff_hours)
-    classified_clients_data = fetch_data(classify_clients_query)
+        live_section('sales_leads.employee_stage_data', employee_stage_data, show_employee_stage)
 
     if classified_clients_data is not None:
-        st.subheader("NORMAL CLIENTS")
-        normal_clients = classified_clients_data[classified_clients_data['client_status'] == 'NORMAL CLIENT']
-        st.dataframe(normal_clients)
-        st.write(f"Total NORMAL CLIENTS: {len(normal_clients)}")
-
-        st.subheader("NOT NORMAL CLIENTS")
-        not_normal_clients = classified_clients_data[classified_clients_data['client_status'] == 'NOT NORMAL CLIENT']
-        st.dataframe(not_normal_clients)
-        st.write(f"Total NOT NORMAL CLIENTS: {len(not_normal_clients)}")
\ No newline at end of file
+        with timed('sales_leads.render.classified_clients'):
+            st.subheader("NORMAL CLIENTS")
+            normal_clients = classified_clients_data[classified_clients_data['client_status'] == classification.NORMAL]
+            paged_dataframe(normal_clients, 'sales_leads_normal_clients')
+            st.write(f"Total NORMAL CLIENTS: {len(normal_clients)}")
+            export_buttons(normal_clients, 'normal_clients')
+
+            st.subheader("NOT NORMAL CLIENTS")
+            not_normal_clients = classified_clients_data[classified_clients_data['client_status'] == classification.NOT_NORMAL]
+            paged_dataframe(not_normal_clients, 'sales_leads_not_normal_clients')
+            st.write(f"Total NOT NORMAL CLIENTS: {len(not_normal_clients)}")
+            export_buttons(not_normal_clients, 'not_normal_clients')
\ No newline at end of file
@@ -0,0 +1,158 @@
+import threading
+
+import numpy as np
+import pandas as pd
+
+from config import get_setting
+
+FUB_PEOPLE_URL = 'https://services.followupboss.com/2/people/view/'
+
+# Compact dtypes for the report columns, applied to every frame on ingest.
+# Names repeat across rows (every stage row carries its employee and stage
+# names), so categoricals store each distinct string once; integer columns
+# are narrowed only when every value fits.
+CATEGORY_COLUMNS = {
+    'client_name', 'employee_name', 'stage_name', 'latest_stage_name', 'current_stage_name',
+}
+INTEGER_COLUMNS = {
+    'client_id': np.int32,
+    'employee_id': np.int32,
+    'current_stage': np.int8,
+    'stage_number': np.int16,
+}
+TIMESTAMP_COLUMNS = {'time_entered_stage'}
+
+
+def use_compact_dtypes():
+    return get_setting("COMPACT_DTYPES", True)
+
+
+def memory_bytes(frame):
+    # Deep footprint: object columns count their strings, not just pointers
+    return int(frame.memory_usage(index=True, deep=True).sum())
+
+
+def estimated_memory_bytes(frame, sample_rows=10000):
+    # Deep footprint scaled up from evenly spaced rows; measuring every
+    # string of a million-row object frame costs more than compacting it
+    if len(frame) <= sample_rows:
+        return memory_bytes(frame)
+    sample = frame.iloc[::len(frame) // sample_rows]
+    return int(memory_bytes(sample) * len(frame) / len(sample))
+
+
+def narrow_integers(values, dtype):
+    if values.dtype.kind not in 'iu' or values.empty:
+        return values
+    limits = np.iinfo(dtype)
+    if values.min() < limits.min or values.max() > limits.max:
+        return values
+    return values.astype(dtype)
+
+
+def compact_frame(frame):
+    # Same columns and values in compact dtypes; frames without any of the
+    # known columns come back unchanged
+    columns = {}
+    for name in frame.columns:
+        values = frame[name]
+        if name in CATEGORY_COLUMNS and not isinstance(values.dtype, pd.CategoricalDtype):
+            columns[name] = values.astype('category')
+        elif name in INTEGER_COLUMNS:
+            narrowed = narrow_integers(values, INTEGER_COLUMNS[name])
+            if narrowed is not values:
+                columns[name] = narrowed
+        elif name in TIMESTAMP_COLUMNS and values.dtype == object:
+            columns[name] = pd.to_datetime(values, utc=True)
+    return frame.assign(**columns) if columns else frame
+
+
+class MemoryReport:
+    # Running totals of deep frame memory before and after compaction, across
+    # every ingested frame of this server process
+    def __init__(self):
+        self.frames = 0
+        self.bytes_before = 0
+        self.bytes_after = 0
+        self._lock = threading.Lock()
+
+    def record(self, before, after):
+        with self._lock:
+            self.frames += 1
+            self.bytes_before += before
+            self.bytes_after += after
+
+    def stats(self):
+        with self._lock:
+            return {
+                'frames': self.frames,
+                'bytes_before': self.bytes_before,
+                'bytes_after': self.bytes_after,
+                'saved_ratio': 1 - self.bytes_after / self.bytes_before if self.bytes_before else 0.0,
+            }
+
+
+memory_report = MemoryReport()
+
+
+def ingest(frame, event=None):
+    # Applied to every query result before it is cached. With an event from
+    # timed(), the before/after sizes also show up in the diagnostics panel.
+    if frame is None or not use_compact_dtypes():
+        return frame
+    before = estimated_memory_bytes(frame)
+    frame = compact_frame(frame)
+    after = memory_bytes(frame)
+    memory_report.record(before, after)
+    if event is not None:
+        event['raw_bytes'] = before
+        event['compact_bytes'] = after
+    return frame
+
+
+def concat_frames(frames):
+    # Row-wise concatenation that keeps categorical columns categorical:
+    # chunks compacted separately have different categories, which plain
+    # pd.concat would turn into object columns
+    if len(frames) == 1:
+        return frames[0]
+    columns = {}
+    for name in frames[0].columns:
+        parts = [frame[name] for frame in frames]
+        if all(isinstance(part.dtype, pd.CategoricalDtype) for part in parts):
+            columns[name] = pd.api.types.union_categoricals(parts, sort_categories=True)
+        else:
+            columns[name] = pd.concat(parts, ignore_index=True)
+    return pd.DataFrame(columns)
+
+
+def ingest_chunks(chunks, event=None):
+    # ingest() for a result streamed in chunks: each chunk is compacted as
+    # it arrives, so the uncompacted rows are never all held at once
+    if not use_compact_dtypes():
+        return concat_frames(list(chunks))
+    before = 0
+    compacted = []
+    for chunk in chunks:
+        before += estimated_memory_bytes(chunk)
+        compacted.append(compact_frame(chunk))
+    frame = concat_frames(compacted)
+    after = memory_bytes(frame)
+    memory_report.record(before, after)
+    if event is not None:
+        event['raw_bytes'] = before
+        event['compact_bytes'] = after
+    return frame
+
+
+def fub_links(client_ids):
+    return FUB_PEOPLE_URL + pd.Series(client_ids).astype(str).to_numpy(dtype=object)
+
+
+def with_fub_links(frame, loc=None):
+    # Follow Up Boss profile links are derived from client_id at display
+    # time instead of being stored with every cached row. loc is the column
+    # position (default: last).
+    frame = frame.copy(deep=False)
+    frame.insert(len(frame.columns) if loc is None else loc, 'followup_boss_link', fub_links(frame['client_id']))
+    return frame
@@ -0,0 +1,143 @@
+import hashlib
+import json
+import logging
+import os
+import shutil
+import time
+
+import pyarrow as pa
+import pyarrow.ipc
+
+from config import get_setting
+from instrumentation import timed
+
+logger = logging.getLogger(__name__)
+
+# Bumped when the on-disk layout changes
+FORMAT_VERSION = 1
+MANIFEST = "manifest.json"
+CURRENT = "CURRENT"
+
+# Modules whose queries and transforms produce the snapshot datasets,
+# including db.py for the dtypes of fetched and COPY-parsed results. Their
+# source is hashed rather than their registered queries, so the fingerprint
+# doesn't depend on which modules happen to be imported yet.
+REPORT_SOURCES = (
+    'sales_leads.py', 'client_stage_progression.py', 'low_sales_progression.py', 'stage_funnel.py',
+    'stage_history.py', 'funnel.py', 'classification.py', 'rollup.py', 'replica.py', 'queries.py',
+    'schema.py', 'stages.py', 'db.py',
+)
+# Settings that change what the loaders return: engine and data source,
+# classification, and how results are fetched, streamed and typed
+REPORT_SETTINGS = (
+    'SALES_LEADS_ENGINE', 'DATA_SOURCE', 'USE_CLIENT_ROLLUP', 'CLASSIFICATION_THRESHOLD', 'CLASSIFICATION_PER_EMPLOYEE',
+    'COMPACT_DTYPES', 'LARGE_RESULT_TRANSPORT', 'STREAM_BATCH_SIZE', 'STREAM_MAX_ROWS',
+)
+
+
+def report_fingerprint():
+    # Identifies the code and configuration a snapshot was built with; a
+    # snapshot saved under others is not loaded
+    directory = os.path.dirname(os.path.abspath(__file__))
+    digest = hashlib.sha1(f"format {FORMAT_VERSION}".encode())
+    for source in REPORT_SOURCES:
+        with open(os.path.join(directory, source), 'rb') as f:
+            digest.update(f.read())
+    digest.update(json.dumps({name: get_setting(name) for name in REPORT_SETTINGS}, default=str).encode())
+    return digest.hexdigest()[:16]
+
+
+def write_frame(frame, path):
+    # Uncompressed, so a load can map the file instead of decoding it
+    table = pa.Table.from_pandas(frame)
+    with pa.OSFile(path, 'wb') as sink, pa.ipc.new_file(sink, table.schema) as writer:
+        writer.write_table(table)
+    return os.path.getsize(path)
+
+
+def read_frame(path):
+    # Column buffers are read straight from the mapped file; only columns
+    # pandas can't share with Arrow are copied
+    return pa.ipc.open_file(pa.memory_map(path)).read_all().to_pandas()
+
+
+class SnapshotStore:
+    # The last report snapshot on disk, so a restarted server renders at once
+    # from it while the first build runs. Each save goes to its own
+    # directory of Arrow IPC files (one per dataset) plus a manifest, and
+    # CURRENT is switched to it last, so a crash mid-save leaves the
+    # previous snapshot in place.
+    def __init__(self, path, fingerprint, max_age=86400.0):
+        self.path = path
+        self.fingerprint = fingerprint
+        self.max_age = max_age
+
+    def _current(self):
+        try:
+            with open(os.path.join(self.path, CURRENT)) as f:
+                return os.path.join(self.path, f.read().strip())
+        except FileNotFoundError:
+            return None
+
+    def save(self, snapshot):
+        version = str(int(snapshot.built_at * 1000))
+        directory = os.path.join(self.path, version)
+        partial = directory + ".partial"
+        shutil.rmtree(partial, ignore_errors=True)
+        os.makedirs(partial)
+        with timed("snapshot_store.save", kind="snapshot") as event:
+            files = {}
+            size = 0
+            for report, datasets in snapshot.datasets.items():
+                files[report] = {}
+                for name, frame in datasets.items():
+                    if frame is None:
+                        files[report][name] = None
+                        continue
+                    filename = f"{report}.{name}.arrow"
+                    size += write_frame(frame, os.path.join(partial, filename))
+                    files[report][name] = filename
+            manifest = {
+                'fingerprint': self.fingerprint,
+                'built_at': snapshot.built_at,
+                'build_seconds': snapshot.build_seconds,
+                'errors': snapshot.errors,
+                'files': files,
+            }
+            with open(os.path.join(partial, MANIFEST), 'w') as f:
+                json.dump(manifest, f)
+            os.replace(partial, directory)
+            pointer = os.path.join(self.path, CURRENT + ".partial")
+            with open(pointer, 'w') as f:
+                f.write(version)
+            os.replace(pointer, os.path.join(self.path, CURRENT))
+            event['bytes'] = size
+        # Older snapshots are no longer reachable
+        for entry in os.listdir(self.path):
+            if entry not in (version, CURRENT) and os.path.isdir(os.path.join(self.path, entry)):
+                shutil.rmtree(os.path.join(self.path, entry), ignore_errors=True)
+
+    def load(self):
+        # (datasets, errors, built_at, build_seconds) of the saved snapshot,
+        # or None when there is none usable
+        directory = self._current()
+        if directory is None:
+            return None
+        try:
+            with open(os.path.join(directory, MANIFEST)) as f:
+                manifest = json.load(f)
+            if manifest['fingerprint'] != self.fingerprint:
+                logger.info("saved report snapshot was built by other code or settings; ignoring it")
+                return None
+            if time.time() - manifest['built_at'] > self.max_age:
+                return None
+            with timed("snapshot_store.load", kind="snapshot"):
+                datasets = {
+                    report: {name: None if filename is None else read_frame(os.path.join(directory, filename))
+                             for name, filename in files.items()}
+                    for report, files in manifest['files'].items()
+                }
+        except (OSError, ValueError, KeyError, pa.ArrowException):
+            logger.exception("could not load the saved report snapshot")
+            return None
+        return datasets, manifest['errors'], manifest['built_at'], manifest['build_seconds']
@@ -0,0 +1,220 @@
+import importlib
+import inspect
+import logging
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import Future
+
+import streamlit as st
+
+from config import get_setting
+from instrumentation import timed
+from query_graph import collect_errors
+from snapshot_store import SnapshotStore, report_fingerprint
+
+logger = logging.getLogger(__name__)
+
+# datasets: {report: {dataset name: frame or None}}, with an empty dict for a
+# report whose loader raised; errors: {report: [message]}; restored: loaded
+# from the on-disk store rather than built by this process.
+# A published snapshot is never modified; readers get shallow copies.
+ReportSnapshot = namedtuple('ReportSnapshot', ['datasets', 'errors', 'built_at', 'build_seconds', 'restored'],
+                            defaults=(False,))
+
+
+class SnapshotScheduler:
+    # Rebuilds every report's datasets on one background thread, `lead_time`
+    # seconds before each `interval` boundary (the hourly autorefresh), so
+    # page runs only read the latest snapshot and never wait on the database.
+    # Overlapping build requests share a single build. With a store, each
+    # error-free build is saved to disk and the saved one is served until the
+    # first build of a new process completes; without one, page runs wait for
+    # that first build. builders: {report: loader, or
+    # "module.function" imported on the build thread}.
+    def __init__(self, builders, interval=3600.0, lead_time=120.0, store=None):
+        self.builders = builders
+        self.interval = interval
+        self.lead_time = lead_time
+        self.store = store
+        self._snapshot = None
+        self._building = None
+        # Set once there is a snapshot or the first build has failed
+        self._settled = threading.Event()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def build(self):
+        with self._lock:
+            building = self._building
+            if building is None:
+                building = self._building = Future()
+                owner = True
+            else:
+                owner = False
+        if not owner:
+            return building.result()
+
+        try:
+            snapshot = self._build()
+            self._snapshot = snapshot
+            building.set_result(snapshot)
+            self._save(snapshot)
+            return snapshot
+        except BaseException as error:
+            building.set_exception(error)
+            raise
+        finally:
+            with self._lock:
+                self._building = None
+            self._settled.set()
+
+    def _build(self):
+        previous = self._snapshot
+        started = time.perf_counter()
+        datasets = {}
+        errors = {}
+        for name, builder in self.builders.items():
+            with timed(f"snapshot.{name}", kind="snapshot"), collect_errors() as report_errors:
+                try:
+                    datasets[name] = resolve_builder(builder)()
+                except Exception as error:
+                    report_errors.append(str(error))
+                    datasets[name] = {}
+            errors[name] = report_errors
+            # Keep serving the last good data for a report whose rebuild failed
+            if report_errors and previous is not None and previous.datasets.get(name):
+                datasets[name] = previous.datasets[name]
+        return ReportSnapshot(datasets, errors, time.time(), time.perf_counter() - started)
+
+    def _save(self, snapshot):
+        if self.store is None or any(snapshot.errors.values()):
+            return
+        try:
+            self.store.save(snapshot)
+        except Exception:
+            logger.exception("saving the report snapshot failed")
+
+    def restore(self):
+        saved = self.store.load() if self.store is not None else None
+        if saved is not None and self._snapshot is None:
+            self._snapshot = ReportSnapshot(*saved, restored=True)
+            self._settled.set()
+
+    def next_build_delay(self):
+        now = time.time()
+        target = (now // self.interval + 1) * self.interval - self.lead_time
+        if target <= now:
+            target += self.interval
+        return target - now
+
+    def _run(self):
+        # First build right away, then ahead of every refresh boundary
+        delay = 0
+        while not self._stop.wait(delay):
+            try:
+                self.build()
+            except Exception:
+                logger.exception("report snapshot build failed")
+            delay = self.next_build_delay()
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="report-snapshots", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def current(self):
+        # The latest snapshot, or None until the first build (or restore);
+        # never waits for a build
+        return self._snapshot
+
+    def wait(self, timeout=None):
+        # The latest snapshot, waiting up to timeout seconds for the first
+        # build; None if it failed or is still running
+        self._settled.wait(timeout)
+        return self._snapshot
+
+
+def resolve_builder(builder):
+    if callable(builder):
+        return builder
+    module_name, function_name = builder.rsplit('.', 1)
+    return getattr(importlib.import_module(module_name), function_name)
+
+
+# Loaders by name, so starting the scheduler from one page doesn't import
+# the other report modules on that page's run
+REPORT_LOADERS = {
+    'sales_leads': 'sales_leads.load_sales_leads_data',
+    'client_stage_progression': 'client_stage_progression.load_client_stage_progression_data',
+    'low_sales_progression': 'low_sales_progression.load_low_sales_progression_data',
+    'stage_funnel': 'stage_funnel.load_stage_funnel_data',
+}
+
+
+@st.cache_resource(show_spinner=False)
+def get_scheduler():
+    scheduler = SnapshotScheduler(
+        REPORT_LOADERS,
+        interval=float(get_setting("SNAPSHOT_INTERVAL_SECONDS", 3600)),
+        lead_time=float(get_setting("SNAPSHOT_LEAD_SECONDS", 120)),
+        store=snapshot_store(),
+    )
+    # Pages render from the saved snapshot while the first build runs
+    scheduler.restore()
+    scheduler.start()
+    return scheduler
+
+
+def snapshot_store():
+    # Empty SNAPSHOT_STORE_PATH turns persistence off
+    path = get_setting("SNAPSHOT_STORE_PATH", "snapshot_store")
+    if not path:
+        return None
+    return SnapshotStore(
+        path, report_fingerprint(), max_age=float(get_setting("SNAPSHOT_STORE_MAX_AGE_SECONDS", 86400)),
+    )
+
+
+def use_snapshots():
+    return get_setting("SNAPSHOT_SCHEDULER", True)
+
+
+def age_text(seconds):
+    minutes = int(seconds // 60)
+    if minutes < 60:
+        return f"{minutes} min"
+    return f"{minutes // 60} h {minutes % 60} min"
+
+
+def report_datasets(name, loader, **options):
+    # Datasets for one report page: from the shared snapshot when the
+    # scheduler is on (reporting that build's errors here), else loaded now.
+    # The snapshot holds the loaders' defaults; other options (e.g. a
+    # non-default report window) are loaded on demand. On a cold start every
+    # session waits for the scheduler's first build instead of loading the
+    # reports itself at the same time; only if that build fails or takes
+    # longer than SNAPSHOT_WAIT_SECONDS is the page's data loaded here.
+    defaults = inspect.signature(loader).parameters
+    if not use_snapshots() or any(value != defaults[key].default for key, value in options.items()):
+        return loader(**options)
+    scheduler = get_scheduler()
+    snapshot = scheduler.current()
+    if snapshot is None:
+        with st.spinner("Loading report data..."):
+            snapshot = scheduler.wait(float(get_setting("SNAPSHOT_WAIT_SECONDS", 600)))
+    if snapshot is None:
+        return loader(**options)
+    for error in snapshot.errors.get(name, []):
+        st.error(f"Error fetching records: {error}")
+    built_at = time.strftime('%Y-%m-%d %H:%M', time.localtime(snapshot.built_at))
+    if snapshot.restored:
+        st.info(f"Showing saved data from {built_at} ({age_text(time.time() - snapshot.built_at)} old) "
+                "while fresh data loads.")
+    else:
+        st.caption(f"Data as of {built_at}")
+    return {key: frame.copy(deep=False) if frame is not None else None
+            for key, frame in snapshot.datasets[name].items()}
@@ -0,0 +1,46 @@
+-- One row per client summarising its stage history, so reports read N
+-- client rows instead of sorting the whole client_stage_progression table.
+-- Kept up to date by `python rollup.py` from cron, or optionally by the
+-- dashboard before reads (ROLLUP_REFRESH_SECONDS); see rollup.py. Run with
+-- `python rollup.py --create`, which fills in the created_on_type fields with
+-- the type of client_stage_progression.created_on, so times are copied
+-- unconverted.
+-- Safe to re-run.
+
+CREATE TABLE IF NOT EXISTS public.client_stage_rollup (
+    client_id integer PRIMARY KEY,
+    -- Stage of the client's newest row (highest stage on a timestamp tie)
+    latest_stage integer,
+    latest_stage_name text,
+    first_stage_time {created_on_type},
+    last_stage_time {created_on_type},
+    max_stage integer,
+    -- Stage rows recorded after the first one
+    transition_count integer NOT NULL,
+    refreshed_at timestamptz NOT NULL DEFAULT now()
+);
+
+CREATE INDEX IF NOT EXISTS client_stage_rollup_latest_stage
+    ON public.client_stage_rollup (latest_stage);
+
+-- Single-row bookkeeping for incremental refreshes: every client with a
+-- stage row at or after high_water_mark is recomputed on the next refresh
+CREATE TABLE IF NOT EXISTS public.client_stage_rollup_state (
+    id boolean PRIMARY KEY DEFAULT true CHECK (id),
+    high_water_mark {created_on_type},
+    refreshed_at timestamptz
+);
+
+-- Tables created before the types followed created_on
+ALTER TABLE public.client_stage_rollup
+    ALTER COLUMN first_stage_time TYPE {created_on_type},
+    ALTER COLUMN last_stage_time TYPE {created_on_type};
+ALTER TABLE public.client_stage_rollup_state
+    ALTER COLUMN high_water_mark TYPE {created_on_type};
+
+-- The refresh finds changed clients by created_on and recomputes them by
+-- client_id; both need an index on the history table
+CREATE INDEX IF NOT EXISTS client_stage_progression_created_on
+    ON public.client_stage_progression (created_on);
+CREATE INDEX IF NOT EXISTS client_stage_progression_client_created_on
+    ON public.client_stage_progression (client_id, created_on);
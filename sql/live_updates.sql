@@ -0,0 +1,29 @@
+-- NOTIFY on every new stage row, for the dashboard's live mode
+-- (LIVE_UPDATES, see live_updates.py). The payload carries the row plus the
+-- client and employee names the reports join in, so the listener never
+-- queries per change. Rows of clients without an assigned employee are left
+-- out of the reports and send nothing. Safe to re-run.
+
+CREATE OR REPLACE FUNCTION public.notify_client_stage_progression() RETURNS trigger
+LANGUAGE plpgsql AS $$
+BEGIN
+    PERFORM pg_notify('client_stage_progression', json_build_object(
+        'client_id', NEW.client_id,
+        'client_name', c.fullname,
+        'employee_id', e.id,
+        'employee_name', e.fullname,
+        'current_stage', NEW.current_stage,
+        'stage_name', NEW.stage_name,
+        'time_entered_stage', NEW.created_on
+    )::text)
+    FROM public.client c
+    JOIN public.employee e ON c.assigned_employee = e.id
+    WHERE c.id = NEW.client_id;
+    RETURN NULL;
+END;
+$$;
+
+DROP TRIGGER IF EXISTS client_stage_progression_notify ON public.client_stage_progression;
+CREATE TRIGGER client_stage_progression_notify
+    AFTER INSERT ON public.client_stage_progression
+    FOR EACH ROW EXECUTE FUNCTION public.notify_client_stage_progression();
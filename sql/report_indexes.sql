@@ -0,0 +1,11 @@
+-- Indexes behind the report queries; see REPORT_INDEXES in index_advisor.py.
+-- CONCURRENTLY keeps the tables writable: run outside a transaction.
+
+-- per-client history in time order: ROW_NUMBER, latest-stage lookups, rollup refresh
+CREATE INDEX CONCURRENTLY IF NOT EXISTS client_stage_progression_client_created_on ON public.client_stage_progression (client_id, created_on);
+
+-- windowed reports: created_on range with a current_stage filter
+CREATE INDEX CONCURRENTLY IF NOT EXISTS client_stage_progression_created_on_stage ON public.client_stage_progression (created_on, current_stage);
+
+-- client -> employee joins and employee_ids filters
+CREATE INDEX CONCURRENTLY IF NOT EXISTS client_assigned_employee ON public.client (assigned_employee);
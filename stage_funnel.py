@@ -0,0 +1,106 @@
+import streamlit as st
+from datetime import datetime
+import funnel
+import stage_history
+from charts import render_chart, rotate_xticklabels
+from exports import export_buttons
+from instrumentation import timed
+from snapshots import report_datasets
+from stages import STAGE_NAMES
+
+ALL_EMPLOYEES = "All employees"
+
+
+def load_stage_funnel_data():
+    # Every view is a small pre-aggregated frame, so switching employees on
+    # the page never touches the full history again
+    history = stage_history.load_stage_history()
+    if history is None:
+        return dict.fromkeys(['transitions', 'reached', 'dwell_by_employee', 'dwell_overall'])
+    with timed('stage_funnel.transform.funnel_analytics', kind='transform'):
+        return funnel.funnel_analytics(history)
+
+
+def name_stages(frame, columns=False):
+    frame = frame.rename(index=STAGE_NAMES, columns=STAGE_NAMES if columns else None)
+    frame.index.name = 'Stage'
+    return frame
+
+
+def draw_reach_rates(ax, reach):
+    ax.bar(reach.index, reach['share_of_clients'] * 100)
+    ax.set_xlabel('Stage')
+    ax.set_ylabel('% of Clients')
+    ax.set_title('Clients Reaching Each Stage')
+    rotate_xticklabels(ax)
+
+
+def draw_dwell_times(ax, dwell):
+    dwell[['median_hours', 'p90_hours']].plot(kind='bar', ax=ax)
+    ax.set_xlabel('Stage', fontsize=12)
+    ax.set_ylabel('Hours', fontsize=12)
+    ax.set_title('Time Spent in Each Stage', fontsize=16)
+    ax.legend(['Median', '90th percentile'])
+    rotate_xticklabels(ax, fontsize=10)
+
+
+def show_stage_funnel():
+    st.title("Stage Funnel Report")
+
+    today = datetime.today().strftime('%Y-%m-%d')
+    st.markdown(f"**DATE: {today}** (This report covers every client's full stage history)")
+
+    with timed('stage_funnel.load'):
+        datasets = report_datasets('stage_funnel', load_stage_funnel_data)
+    transitions = datasets.get('transitions')
+    reached = datasets.get('reached')
+    dwell_by_employee = datasets.get('dwell_by_employee')
+    dwell = datasets.get('dwell_overall')
+    if transitions is None or reached is None or dwell_by_employee is None or dwell is None:
+        return
+
+    employee = st.sidebar.selectbox(
+        "Employee", [ALL_EMPLOYEES] + sorted(reached['employee_name'].unique()), key="funnel_employee"
+    )
+    if employee != ALL_EMPLOYEES:
+        transitions = transitions[transitions['employee_name'] == employee]
+        reached = reached[reached['employee_name'] == employee]
+        dwell = dwell_by_employee[dwell_by_employee['employee_name'] == employee].drop(columns='employee_name')
+
+    with timed('stage_funnel.render.reach'):
+        st.subheader("Clients Reaching Each Stage")
+        reach = name_stages(funnel.reach_rates(reached))
+        st.dataframe(reach)
+        export_buttons(reach.reset_index(), 'funnel_reach')
+        if not reach.empty:
+            render_chart('funnel_reach_rates', reach, draw_reach_rates)
+
+    with timed('stage_funnel.render.transitions'):
+        matrix = funnel.transition_matrix(transitions)
+        st.subheader("Stage Transitions (rows: from, columns: to)")
+        st.dataframe(name_stages(matrix, columns=True))
+        export_buttons(name_stages(matrix, columns=True).reset_index(), 'funnel_transitions')
+        st.subheader("Conversion Rates (% of moves out of each stage)")
+        conversion = name_stages((funnel.conversion_rates(matrix) * 100).round(1), columns=True)
+        st.dataframe(conversion)
+        export_buttons(conversion.reset_index(), 'funnel_conversion_rates')
+
+    with timed('stage_funnel.render.dwell'):
+        st.subheader("Time in Stage Before the Next Change (hours)")
+        dwell = name_stages(dwell.set_index('current_stage'))
+        st.dataframe(dwell.round(1))
+        export_buttons(dwell.reset_index(), 'funnel_dwell_times')
+        if not dwell.empty:
+            render_chart('funnel_dwell_times', dwell, draw_dwell_times, figsize=(14, 8))
+
+    if employee == ALL_EMPLOYEES:
+        with timed('stage_funnel.render.employees'):
+            st.subheader("Median Hours in Stage by Employee")
+            medians = dwell_by_employee.pivot(index='employee_name', columns='current_stage', values='median_hours')
+            st.dataframe(medians.rename(columns=STAGE_NAMES).round(1))
+            export_buttons(medians.rename(columns=STAGE_NAMES).reset_index(), 'funnel_median_hours_by_employee')
+            st.subheader("% of Clients Reaching Each Stage by Employee")
+            shares = reached.assign(share=reached['clients_reached'] / reached['clients_total'] * 100)
+            shares = shares.pivot(index='employee_name', columns='current_stage', values='share').fillna(0)
+            st.dataframe(shares.rename(columns=STAGE_NAMES).round(1))
+            export_buttons(shares.rename(columns=STAGE_NAMES).reset_index(), 'funnel_stage_shares_by_employee')
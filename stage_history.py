@@ -0,0 +1,187 @@
+import numpy as np
+import pandas as pd
+
+from config import get_setting
+from db import cached_query, large_result_settings
+from instrumentation import name_queries
+from query_graph import report_error
+from stages import stage_name
+
+# The whole joined stage history in long format, one row per stage change.
+# Every Sales Leads view is derived from this single scan.
+STAGE_HISTORY_QUERY = """
+    SELECT
+        csp.client_id,
+        c.fullname AS client_name,
+        e.id AS employee_id,
+        e.fullname AS employee_name,
+        csp.current_stage,
+        csp.stage_name,
+        csp.created_on AS time_entered_stage
+    FROM
+        public.client_stage_progression csp
+    JOIN
+        public.client c ON csp.client_id = c.id
+    JOIN
+        public.employee e ON c.assigned_employee = e.id
+    ORDER BY
+        csp.client_id, csp.created_on;
+"""
+
+name_queries({'stage_history': STAGE_HISTORY_QUERY})
+
+
+# Per-client columns of the windowed report queries
+CLIENT_KEYS = ('client_id', 'client_name', 'employee_name')
+
+
+def use_replica():
+    return get_setting("DATA_SOURCE", "postgres") == "replica"
+
+
+def stage_history_frame():
+    # Raises on failure; safe to call from query_graph worker threads
+    if use_replica():
+        from replica import get_replica
+        return get_replica().load_stage_history()
+    return cached_query(STAGE_HISTORY_QUERY, **large_result_settings())
+
+
+def load_stage_history():
+    try:
+        return stage_history_frame()
+    except Exception as error:
+        report_error(error)
+
+
+def sort_history(history):
+    # Stable sort keeps the fetch order for rows that share a timestamp
+    order = 'stage_number' if 'stage_number' in history else 'time_entered_stage'
+    return history.sort_values(['client_id', order], kind='stable', ignore_index=True)
+
+
+def client_ordered(history):
+    # history as is when already ordered by client and time, as the report
+    # queries return it; otherwise a sorted copy. Checking is a linear scan.
+    order = 'stage_number' if 'stage_number' in history else 'time_entered_stage'
+    ids = history['client_id'].to_numpy()
+    keys = history[order].values
+    if len(ids) < 2:
+        return history
+    same_client = ids[1:] == ids[:-1]
+    if np.all(ids[1:] >= ids[:-1]) and np.all(~same_client | (keys[1:] >= keys[:-1])):
+        return history
+    return sort_history(history)
+
+
+def client_bounds(client_ids):
+    # First and last row position of every client in client-ordered ids
+    if not len(client_ids):
+        return np.array([], dtype=np.intp), np.array([], dtype=np.intp)
+    starts = np.flatnonzero(np.r_[True, client_ids[1:] != client_ids[:-1]])
+    return starts, np.r_[starts[1:], len(client_ids)] - 1
+
+
+def latest_stage_rows(history):
+    # Same as (client_id, created_on) IN (SELECT client_id, MAX(created_on) ...):
+    # clients with several rows at their latest timestamp keep all of them
+    latest_time = history.groupby('client_id')['time_entered_stage'].transform('max')
+    return history[history['time_entered_stage'] == latest_time]
+
+
+def pivot_stage_history(history, clients=None):
+    # Wide per-client history: Data_i_recorded / Time_for_datai_recorded for
+    # the i-th recorded stage, as the old MAX(CASE ...) query produced them.
+    # history needs client_id, stage_name and time_entered_stage (plus an
+    # optional 1-based stage_number); names come from clients when the
+    # history rows are too narrow to carry them.
+    if clients is None:
+        clients = history
+    clients = clients.drop_duplicates('client_id').sort_values('client_id').set_index('client_id')
+    history = sort_history(history[history['client_id'].isin(clients.index)])
+    wide = pd.DataFrame({
+        'client_id': clients.index,
+        'client_name': clients['client_name'].values,
+        'employee_name': clients['employee_name'].values,
+    })
+    if history.empty:
+        return wide
+
+    # Position of each row inside its client's history, then scatter the
+    # stage name codes and timestamps into a clients x positions grid; every
+    # name column shares the history's categories
+    client_pos = np.searchsorted(clients.index.values, history['client_id'].values)
+    if 'stage_number' in history:
+        stage_pos = history['stage_number'].values.astype(np.int64) - 1
+    else:
+        stage_pos = history.groupby('client_id').cumcount().values
+    max_stage = int(stage_pos.max()) + 1
+    time_column = history['time_entered_stage']
+    stage_names = history['stage_name'].astype('category')
+    names = np.full((len(clients), max_stage), -1, dtype=np.int32)
+    names[client_pos, stage_pos] = stage_names.cat.codes.values
+    times = np.full((len(clients), max_stage), np.datetime64('NaT'), dtype=time_column.values.dtype)
+    times[client_pos, stage_pos] = time_column.values
+
+    # .values drops the timezone of timestamptz columns; put it back
+    tz = time_column.dt.tz
+    columns = {}
+    for i in range(max_stage):
+        columns[f'data_{i + 1}_recorded'] = pd.Categorical.from_codes(names[:, i], stage_names.cat.categories)
+        columns[f'time_for_data{i + 1}_recorded'] = (
+            times[:, i] if tz is None else pd.DatetimeIndex(times[:, i]).tz_localize('UTC').tz_convert(tz)
+        )
+    return pd.concat([wide, pd.DataFrame(columns)], axis=1)
+
+
+def latest_stage_data(history):
+    latest = latest_stage_rows(history)
+    return pd.DataFrame({
+        'client_id': latest['client_id'],
+        'client_name': latest['client_name'],
+        'employee_name': latest['employee_name'],
+        'latest_stage_name': stage_name(latest['current_stage']),
+    }).sort_values('client_id', kind='stable', ignore_index=True)
+
+
+def employee_stage_data(history):
+    latest = latest_stage_rows(history)
+    return pd.DataFrame({
+        'client_id': latest['client_id'],
+        'employee_name': latest['employee_name'],
+        'client_name': latest['client_name'],
+        'current_stage_name': latest['stage_name'],
+    }).sort_values(['employee_name', 'client_name'], kind='stable', ignore_index=True)
+
+
+def window_start(history, window=pd.Timedelta(hours=24)):
+    # Start of "the last <window>", in the timezone of the history timestamps
+    return pd.Timestamp.now(tz=history['time_entered_stage'].dt.tz) - pd.Timedelta(window)
+
+
+def clients_in_window(history, since, min_stage=None, max_stage=None, employee_ids=None, keys=CLIENT_KEYS):
+    # One row per client over its stage rows since the window start, like the
+    # GROUP BY client_id queries of the 24h reports; keys are the client
+    # columns those queries return
+    rows = history[history['time_entered_stage'] >= since]
+    if min_stage is not None:
+        rows = rows[rows['current_stage'] >= min_stage]
+    if max_stage is not None:
+        rows = rows[rows['current_stage'] <= max_stage]
+    if employee_ids is not None:
+        rows = rows[rows['employee_id'].isin(employee_ids)]
+    clients = rows.groupby(list(keys), sort=False, observed=True).agg(
+        current_stage=('current_stage', 'max'),
+        time_entered_stage=('time_entered_stage', 'max'),
+    ).reset_index()
+    return clients.sort_values('client_id', kind='stable', ignore_index=True)
+
+
+def leads_moved_per_employee(clients):
+    # Leads per employee and day they last moved, from clients_in_window rows
+    moved = pd.DataFrame({
+        'employee_name': clients['employee_name'],
+        'date_moved': clients['time_entered_stage'].dt.date,
+    })
+    counts = moved.groupby(['employee_name', 'date_moved'], observed=True).size().reset_index(name='count_of_leads')
+    return counts.sort_values(['date_moved', 'count_of_leads'], ascending=False, kind='stable', ignore_index=True)
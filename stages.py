@@ -0,0 +1,27 @@
+STAGE_NAMES = {
+    1: 'Stage 1: Not Interested',
+    2: 'Stage 2: Initial Contact',
+    3: 'Stage 3: Requirement Collection',
+    4: 'Stage 4: Property Touring',
+    5: 'Stage 5: Property Tour and Feedback',
+    6: 'Stage 6: Application and Approval',
+    7: 'Stage 7: Post-Approval and Follow-Up',
+    8: 'Stage 8: Commission Collection',
+    9: 'Stage 9: Dead Stage'
+}
+
+UNKNOWN_STAGE = 'Unknown Stage'
+
+# Stage every "normal" client is expected to end in
+FINAL_STAGE = 8
+
+
+def stage_name(stage_numbers):
+    return stage_numbers.map(STAGE_NAMES).fillna(UNKNOWN_STAGE)
+
+
+def stage_case_sql(column):
+    # SQL CASE expression naming the stage numbers in column, for queries
+    # that return stage names
+    whens = "\n".join(f"            WHEN {column} = {number} THEN '{name}'" for number, name in STAGE_NAMES.items())
+    return f"CASE\n{whens}\n            ELSE '{UNKNOWN_STAGE}'\n        END"
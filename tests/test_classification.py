@@ -0,0 +1,74 @@
+import pandas as pd
+import pytest
+
+from classification import NORMAL, NOT_NORMAL, classify, client_durations
+
+START = pd.Timestamp('2024-03-01 09:00')
+
+# (client_id, client_name, employee_name, [(stage, hours after START), ...])
+CLIENTS = [
+    (1, 'Ann', 'Alice', [(1, 0), (4, 10), (8, 20)]),
+    (2, 'Bob', 'Alice', [(1, 0), (8, 40)]),
+    (3, 'Cid', 'Bruno', [(1, 0), (3, 5)]),
+    (4, 'Dee', 'Bruno', [(2, 0), (8, 35)]),
+    (5, 'Eve', 'Carla', [(1, 0), (2, 50)]),
+]
+
+
+def history():
+    rows = [
+        (client_id, client_name, employee_name, stage, START + pd.Timedelta(hours=hours))
+        for client_id, client_name, employee_name, stages in CLIENTS
+        for stage, hours in stages
+    ]
+    return pd.DataFrame(rows, columns=['client_id', 'client_name', 'employee_name', 'current_stage',
+                                       'time_entered_stage'])
+
+
+def statuses(classified):
+    return dict(zip(classified['client_id'], classified['client_status']))
+
+
+def test_client_durations_span_first_to_last_row():
+    durations = client_durations(history()).set_index('client_id')
+    assert durations['time_diff_hours'].to_dict() == {1: 20.0, 2: 40.0, 3: 5.0, 4: 35.0, 5: 50.0}
+    assert durations['current_stage'].to_dict() == {1: 8, 2: 8, 3: 3, 4: 8, 5: 2}
+    assert durations.loc[3, 'employee_name'] == 'Bruno'
+
+
+def test_client_durations_sort_unordered_history():
+    shuffled = history().sample(frac=1, random_state=7)
+    expected = client_durations(history())
+    pd.testing.assert_frame_equal(client_durations(shuffled), expected)
+
+
+def test_client_durations_take_names_from_clients():
+    narrow = history().drop(columns=['client_name', 'employee_name'])
+    clients = history()[['client_id', 'client_name', 'employee_name']].drop_duplicates()
+    durations = client_durations(narrow, clients).set_index('client_id')
+    assert durations['client_name'].to_dict() == {1: 'Ann', 2: 'Bob', 3: 'Cid', 4: 'Dee', 5: 'Eve'}
+
+
+def test_classify_against_overall_mean():
+    classified = classify(client_durations(history()), statistic='mean', per_employee=False)
+    # Finished clients took 20, 40 and 35 hours
+    assert classified['threshold_hours'].unique().tolist() == pytest.approx([95 / 3])
+    assert statuses(classified) == {1: NORMAL, 2: NOT_NORMAL, 3: NOT_NORMAL, 4: NOT_NORMAL, 5: NOT_NORMAL}
+
+
+@pytest.mark.parametrize('statistic, threshold', [('median', 35.0), ('p75', 37.5)])
+def test_classify_statistics(statistic, threshold):
+    classified = classify(client_durations(history()), statistic=statistic, per_employee=False)
+    assert classified['threshold_hours'].unique().tolist() == [threshold]
+    assert statuses(classified)[4] == NORMAL
+
+
+def test_classify_per_employee_falls_back_to_overall():
+    classified = classify(client_durations(history()), statistic='mean', per_employee=True).set_index('client_id')
+    assert classified['threshold_hours'].to_dict() == pytest.approx({1: 30.0, 2: 30.0, 3: 35.0, 4: 35.0, 5: 95 / 3})
+    assert classified.loc[4, 'client_status'] == NORMAL
+
+
+def test_classify_rejects_unknown_statistic():
+    with pytest.raises(ValueError):
+        classify(client_durations(history()), statistic='mode', per_employee=False)
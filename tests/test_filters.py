@@ -0,0 +1,114 @@
+import datetime
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from filters import NO_FILTERS, Filters, FrameIndex, IndexCache
+
+
+def stage_frame(rows=500, tz=None, seed=5):
+    rng = np.random.default_rng(seed)
+    times = pd.Timestamp('2024-03-05') + pd.to_timedelta(rng.integers(0, 20 * 24 * 60, size=rows), unit='min')
+    if tz is not None:
+        times = times.tz_localize('UTC').tz_convert(tz)
+    return pd.DataFrame({
+        'client_id': np.arange(rows),
+        'client_name': rng.choice(['Anna Smith', 'Bob Jones', 'Carla Smithers', 'Dan Brown'], size=rows),
+        'employee_id': rng.integers(1, 4, size=rows),
+        'employee_name': rng.choice(['Alice', 'Bruno', 'Carla'], size=rows),
+        'current_stage': rng.integers(1, 10, size=rows),
+        'time_entered_stage': times,
+    })
+
+
+def expected_rows(frame, filters):
+    # The same selections as plain boolean masks
+    mask = pd.Series(True, index=frame.index)
+    if filters.employees:
+        mask &= frame['employee_name'].isin(filters.employees)
+    if filters.stages is not None:
+        mask &= frame['current_stage'].between(*filters.stages)
+    if filters.dates is not None:
+        mask &= frame['time_entered_stage'].dt.date.between(*filters.dates)
+    if filters.search:
+        mask &= frame['client_name'].str.lower().str.contains(filters.search.lower(), regex=False)
+    if filters.employee_ids:
+        mask &= frame['employee_id'].isin(filters.employee_ids)
+    return frame[mask]
+
+
+CASES = [
+    Filters(['Alice'], None, None, None),
+    Filters(['Bruno', 'Carla', 'Nobody'], None, None, None),
+    Filters(None, (2, 4), None, None),
+    Filters(None, (9, 9), None, None),
+    Filters(None, None, (datetime.date(2024, 3, 10), datetime.date(2024, 3, 12)), None),
+    Filters(None, None, None, 'SMITH'),
+    Filters(['Alice', 'Carla'], (3, 8), (datetime.date(2024, 3, 6), datetime.date(2024, 3, 20)), 'smith'),
+    Filters(['Nobody'], None, None, None),
+    Filters(None, None, None, None, [1, 3]),
+    Filters(None, (1, 5), None, None, [2]),
+]
+
+
+@pytest.mark.parametrize('tz', [None, 'America/New_York'])
+@pytest.mark.parametrize('filters', CASES)
+def test_filter_matches_boolean_masks(filters, tz):
+    frame = stage_frame(tz=tz)
+    pd.testing.assert_frame_equal(FrameIndex(frame).filter(filters), expected_rows(frame, filters))
+
+
+def test_no_filters_return_the_frame():
+    frame = stage_frame()
+    assert FrameIndex(frame).filter(NO_FILTERS) is frame
+
+
+@pytest.mark.parametrize('tz', [None, 'America/New_York'])
+def test_date_range_in_frame_timezone(tz):
+    frame = stage_frame(tz=tz)
+    dates = frame['time_entered_stage'].dt.date
+    assert FrameIndex(frame).date_range() == (dates.min(), dates.max())
+
+
+def test_default_employee_ids_without_rows_match_nothing():
+    frame = stage_frame()
+    assert FrameIndex(frame).filter(Filters(None, None, None, None, [378, 375])).empty
+
+
+def test_empty_frame():
+    index = FrameIndex(stage_frame().iloc[:0])
+    assert index.date_range() is None
+    assert index.filter(Filters(['Alice'], (1, 9), None, 'a')).empty
+
+
+def test_index_cache_rebuilds_only_for_a_new_load():
+    cache = IndexCache()
+    frame = stage_frame()
+    index = cache.get(frame)
+    assert cache.get(frame.copy()) is index
+    grown = pd.concat([frame, stage_frame(rows=1, seed=9).assign(time_entered_stage=pd.Timestamp('2024-04-01'))])
+    assert cache.get(grown) is not index
+    assert cache.get(frame) is index
+
+
+def test_index_cache_keeps_loads_apart_by_key():
+    cache = IndexCache()
+    frame = stage_frame()
+    # Same length and latest timestamp, different rows
+    other = frame.assign(employee_name=frame['employee_name'].iloc[::-1].to_numpy())
+    day, week = cache.get(frame, key='24h'), cache.get(other, key='7d')
+    assert day is not week
+    assert day.frame is frame and week.frame is other
+    assert cache.get(frame, key='24h') is day
+
+
+def test_index_cache_drops_the_least_recently_used():
+    cache = IndexCache(max_entries=2)
+    frame = stage_frame()
+    first = cache.get(frame, key=1)
+    cache.get(frame, key=2)
+    assert cache.get(frame, key=1) is first
+    cache.get(frame, key=3)
+    assert cache.get(frame, key=1) is first
+    assert len(cache._indexes) == 2
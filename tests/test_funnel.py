@@ -0,0 +1,123 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from funnel import DWELL_QUANTILES, UNASSIGNED, conversion_rates, funnel_analytics, reach_rates, transition_matrix
+
+
+def random_history(clients=300, seed=11):
+    rng = np.random.default_rng(seed)
+    employees = np.array(['Alice', 'Bruno', 'Carla', 'Dmitri'])
+    rows = []
+    for client_id in range(1, clients + 1):
+        employee = employees[rng.integers(len(employees))]
+        time = pd.Timestamp('2024-01-01') + pd.Timedelta(minutes=int(rng.integers(100000)))
+        for stage in rng.integers(1, 10, size=rng.integers(1, 7)):
+            rows.append((client_id, employee, int(stage), time))
+            time += pd.Timedelta(minutes=int(rng.integers(1, 5000)))
+    return pd.DataFrame(rows, columns=['client_id', 'employee_name', 'current_stage', 'time_entered_stage'])
+
+
+def with_next_stage(history):
+    # Plain pandas: each row with the stage and time of the client's next row
+    history = history.sort_values(['client_id', 'time_entered_stage'], kind='stable')
+    following = history.groupby('client_id')[['current_stage', 'time_entered_stage']].shift(-1)
+    history = history.assign(to_stage=following['current_stage'],
+                             dwell_hours=(following['time_entered_stage'] - history['time_entered_stage'])
+                             / pd.Timedelta(hours=1))
+    return history[history['to_stage'].notna()].rename(columns={'current_stage': 'from_stage'})
+
+
+def expected_dwell(moves, keys):
+    grouped = moves.groupby(keys)['dwell_hours']
+    expected = grouped.agg(transitions='size', mean_hours='mean')
+    for name, q in DWELL_QUANTILES.items():
+        expected[name] = grouped.quantile(q)
+    return expected.reset_index()
+
+
+def sorted_frame(frame, keys):
+    return frame.sort_values(keys, ignore_index=True)
+
+
+def test_transitions_match_groupby():
+    history = random_history()
+    result = funnel_analytics(history)['transitions']
+    expected = (with_next_stage(history).astype({'to_stage': int})
+                .groupby(['employee_name', 'from_stage', 'to_stage']).size().rename('transitions').reset_index())
+    keys = ['employee_name', 'from_stage', 'to_stage']
+    pd.testing.assert_frame_equal(sorted_frame(result, keys), sorted_frame(expected, keys), check_dtype=False)
+
+
+def test_reached_match_groupby():
+    history = random_history()
+    result = funnel_analytics(history)['reached']
+    expected = history.groupby(['employee_name', 'current_stage'])['client_id'].nunique().rename('clients_reached')
+    expected = expected.reset_index()
+    expected['clients_total'] = expected['employee_name'].map(history.groupby('employee_name')['client_id'].nunique())
+    keys = ['employee_name', 'current_stage']
+    pd.testing.assert_frame_equal(sorted_frame(result, keys), sorted_frame(expected, keys), check_dtype=False)
+
+
+def test_dwell_matches_groupby():
+    history = random_history()
+    analytics = funnel_analytics(history)
+    moves = with_next_stage(history)
+
+    expected = expected_dwell(moves, ['employee_name', 'from_stage']).rename(columns={'from_stage': 'current_stage'})
+    keys = ['employee_name', 'current_stage']
+    pd.testing.assert_frame_equal(sorted_frame(analytics['dwell_by_employee'], keys), sorted_frame(expected, keys),
+                                  check_dtype=False)
+
+    expected = expected_dwell(moves, ['from_stage']).rename(columns={'from_stage': 'current_stage'})
+    pd.testing.assert_frame_equal(analytics['dwell_overall'], expected, check_dtype=False)
+
+
+def test_unordered_history_gives_the_same_result():
+    history = random_history()
+    ordered = funnel_analytics(history)
+    shuffled = funnel_analytics(history.sample(frac=1, random_state=3))
+    for name, frame in ordered.items():
+        pd.testing.assert_frame_equal(shuffled[name], frame)
+
+
+def test_single_row_clients_have_no_transitions():
+    history = pd.DataFrame({
+        'client_id': [1, 2],
+        'employee_name': ['Alice', 'Bruno'],
+        'current_stage': [1, 3],
+        'time_entered_stage': pd.to_datetime(['2024-01-01', '2024-01-02']),
+    })
+    analytics = funnel_analytics(history)
+    assert analytics['transitions'].empty
+    assert analytics['dwell_overall'].empty
+    assert analytics['reached']['clients_reached'].tolist() == [1, 1]
+
+
+def test_rates():
+    analytics = funnel_analytics(random_history())
+    conversion = conversion_rates(transition_matrix(analytics['transitions']))
+    assert np.allclose(conversion.sum(axis=1), 1.0)
+    reach = reach_rates(analytics['reached'])
+    assert reach['share_of_clients'].between(0, 1).all()
+    assert reach['clients_reached'].sum() == analytics['reached']['clients_reached'].sum()
+    assert reach['share_of_clients'].max() == pytest.approx(reach['clients_reached'].max() / 300)
+
+
+def test_clients_without_an_employee_are_unassigned():
+    history = random_history()
+    history['employee_name'] = history['employee_name'].astype(object)
+    history.loc[history['client_id'] == 1, 'employee_name'] = None
+    analytics = funnel_analytics(history)
+    expected = funnel_analytics(history.fillna({'employee_name': UNASSIGNED}))
+    for name, frame in expected.items():
+        pd.testing.assert_frame_equal(analytics[name], frame)
+    assert UNASSIGNED in set(analytics['reached']['employee_name'])
+
+
+def test_unassigned_categorical_employees():
+    history = random_history()
+    history.loc[history['client_id'] == 1, 'employee_name'] = None
+    analytics = funnel_analytics(history.astype({'employee_name': 'category'}))
+    reached = analytics['reached']
+    assert reached.loc[reached['employee_name'] == UNASSIGNED, 'clients_total'].unique().tolist() == [1]
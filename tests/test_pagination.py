@@ -0,0 +1,107 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from pagination import KeysetPager, sort_codes
+
+
+def report_frame(rows=237, seed=3):
+    rng = np.random.default_rng(seed)
+    hours = rng.integers(0, 20, size=rows).astype(float)
+    hours[rng.random(rows) < 0.1] = np.nan
+    return pd.DataFrame({
+        'client_id': rng.permutation(np.arange(1000, 1000 + rows)),
+        'employee_name': pd.Categorical(rng.choice(['Carla', 'Alice', 'Bruno'], size=rows)),
+        'client_name': rng.choice(['Ann', 'Bob', 'Cid', 'Dee', None], size=rows),
+        'time_diff_hours': hours,
+    })
+
+
+def all_pages(pager, limit):
+    pages, cursor = [], None
+    while True:
+        rows, offset, cursor = pager.page(cursor, limit)
+        pages.append((rows, offset))
+        if cursor is None:
+            return pages
+
+
+def expected_order(frame, sort_by, descending):
+    # Sort column in the requested direction, nulls last, ties by client_id
+    return frame.sort_values([sort_by, 'client_id'], ascending=[not descending, True], na_position='last',
+                             kind='stable')
+
+
+@pytest.mark.parametrize('descending', [False, True])
+@pytest.mark.parametrize('sort_by', ['client_id', 'employee_name', 'client_name', 'time_diff_hours'])
+@pytest.mark.parametrize('limit', [1, 10, 100, 237, 500])
+def test_pages_cover_the_frame_in_order(sort_by, descending, limit):
+    frame = report_frame()
+    pages = all_pages(KeysetPager(frame, sort_by, descending), limit)
+    assert [len(rows) for rows, _ in pages[:-1]] == [limit] * (len(pages) - 1)
+    assert 0 < len(pages[-1][0]) <= limit
+    assert [offset for _, offset in pages] == list(range(0, len(frame), limit))
+    pd.testing.assert_frame_equal(pd.concat([rows for rows, _ in pages]), expected_order(frame, sort_by, descending))
+
+
+def test_empty_frame():
+    rows, offset, cursor = KeysetPager(report_frame().iloc[:0]).page(None, 10)
+    assert rows.empty and offset == 0 and cursor is None
+
+
+def test_cursor_survives_rows_added_and_dropped_ahead_of_it():
+    frame = report_frame()
+    _, _, cursor = KeysetPager(frame, 'time_diff_hours').page(None, 50)
+    first = frame[frame['client_id'] == cursor[1]]
+    ahead = expected_order(frame, 'time_diff_hours', False).iloc[:10]
+    added = first.assign(client_id=5000, time_diff_hours=-1.0)
+    reloaded = pd.concat([frame.drop(ahead.index), added])
+    rows, offset, _ = KeysetPager(reloaded, 'time_diff_hours').page(cursor, 50)
+    assert rows.iloc[0]['client_id'] == cursor[1]
+    assert offset == 50 - 10 + 1
+
+
+def test_cursor_of_a_dropped_row_starts_at_the_next_row():
+    frame = report_frame()
+    order = expected_order(frame, 'time_diff_hours', True)
+    _, _, cursor = KeysetPager(frame, 'time_diff_hours', descending=True).page(None, 20)
+    reloaded = frame[frame['client_id'] != cursor[1]]
+    rows, offset, _ = KeysetPager(reloaded, 'time_diff_hours', descending=True).page(cursor, 20)
+    assert rows.iloc[0]['client_id'] == order.iloc[21]['client_id']
+    assert offset == 20
+
+
+def test_cursor_of_a_vanished_value_starts_at_the_next_value():
+    frame = pd.DataFrame({'client_id': [1, 2, 3, 4], 'client_name': ['Ann', 'Bob', 'Bob', 'Dee']})
+    pager = KeysetPager(frame, 'client_name')
+    for cursor, first in [(('Bo', 1), 2), (('Bob', 3), 3), (('Cid', 1), 4), (('Zed', 1), None)]:
+        rows, _, _ = pager.page(cursor, 10)
+        assert (rows.iloc[0]['client_id'] if len(rows) else None) == first
+    rows, offset, _ = KeysetPager(frame, 'client_name', descending=True).page(('Cid', 9), 10)
+    assert rows['client_id'].tolist() == [2, 3, 1]
+    assert offset == 1
+
+
+def test_null_cursor_starts_at_the_nulls():
+    frame = report_frame()
+    nulls = expected_order(frame, 'time_diff_hours', False)
+    nulls = nulls[nulls['time_diff_hours'].isna()]
+    rows, offset, cursor = KeysetPager(frame, 'time_diff_hours').page((None, 0), 500)
+    pd.testing.assert_frame_equal(rows, nulls)
+    assert offset == len(frame) - len(nulls)
+    assert cursor is None
+
+
+def test_rows_sharing_a_key_stay_on_one_page():
+    frame = pd.DataFrame({'client_id': [1, 1, 1, 2, 3], 'current_stage': [4, 4, 4, 5, 6]})
+    rows, _, cursor = KeysetPager(frame, 'current_stage').page(None, 2)
+    assert rows['client_id'].tolist() == [1, 1, 1]
+    assert cursor == (5, 2)
+
+
+def test_categorical_codes_match_plain_values():
+    values = report_frame()['employee_name']
+    codes, uniques = sort_codes(values, descending=True)
+    plain_codes, plain_uniques = sort_codes(values.astype(str), descending=True)
+    assert np.array_equal(codes, plain_codes)
+    assert list(uniques) == list(plain_uniques)
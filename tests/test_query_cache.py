@@ -0,0 +1,98 @@
+import threading
+import time
+
+import pandas as pd
+
+from query_cache import QueryCache
+
+
+def frame(rows=3):
+    return pd.DataFrame({'client_id': range(rows)})
+
+
+def test_equivalent_queries_share_an_entry():
+    cache = QueryCache()
+    calls = []
+    loader = lambda: calls.append(1) or frame()
+    cache.get_or_load("SELECT 1\n  FROM t", {'ids': [1, 2], 'a': 1}, loader)
+    cache.get_or_load("SELECT 1 FROM t", {'a': 1, 'ids': (1, 2)}, loader)
+    assert len(calls) == 1
+    assert cache.stats()['hits'] == 1
+    assert cache.stats()['misses'] == 1
+
+
+def test_concurrent_misses_load_once_per_key():
+    cache = QueryCache()
+    calls = {'a': 0, 'b': 0}
+    start = threading.Barrier(20)
+
+    def loader(key):
+        def load():
+            calls[key] += 1
+            time.sleep(0.05)
+            return frame()
+        return load
+
+    def worker(number):
+        key = 'ab'[number % 2]
+        start.wait()
+        cache.get_or_load(f"SELECT {key}", None, loader(key))
+
+    threads = [threading.Thread(target=worker, args=(number,)) for number in range(20)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert calls == {'a': 1, 'b': 1}
+    assert cache._key_locks == {}
+
+
+def test_failed_load_releases_its_lock():
+    cache = QueryCache()
+
+    def fail():
+        raise RuntimeError("connection lost")
+
+    try:
+        cache.get_or_load("SELECT 1", None, fail)
+    except RuntimeError:
+        pass
+    assert cache._key_locks == {}
+    assert cache.get_or_load("SELECT 1", None, frame).shape == (3, 1)
+
+
+def test_entries_expire_after_ttl():
+    cache = QueryCache(ttl=0.05)
+    calls = []
+    loader = lambda: calls.append(1) or frame()
+    cache.get_or_load("SELECT 1", None, loader)
+    cache.get_or_load("SELECT 1", None, loader)
+    time.sleep(0.1)
+    cache.get_or_load("SELECT 1", None, loader)
+    assert len(calls) == 2
+
+
+def test_probe_change_invalidates_entries():
+    version = [1]
+    cache = QueryCache(probe=lambda: version[0], probe_interval=0)
+    calls = []
+    loader = lambda: calls.append(1) or frame()
+    cache.get_or_load("SELECT 1", None, loader)
+    cache.get_or_load("SELECT 1", None, loader)
+    version[0] = 2
+    cache.get_or_load("SELECT 1", None, loader)
+    assert len(calls) == 2
+
+
+def test_least_recently_used_entries_are_evicted_over_budget():
+    size = int(frame(1000).memory_usage(deep=True).sum())
+    cache = QueryCache(max_bytes=2 * size)
+    for query in ("SELECT a", "SELECT b"):
+        cache.get_or_load(query, None, lambda: frame(1000))
+    cache.get_or_load("SELECT a", None, lambda: frame(1000))
+    cache.get_or_load("SELECT c", None, lambda: frame(1000))
+    assert cache.stats()['entries'] == 2
+    assert cache.stats()['bytes'] <= 2 * size
+    calls = []
+    cache.get_or_load("SELECT a", None, lambda: calls.append(1) or frame(1000))
+    assert calls == []
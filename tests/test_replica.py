@@ -0,0 +1,41 @@
+import sqlite3
+from contextlib import closing
+
+from replica import SCHEMA_VERSION, LocalReplica
+
+
+def stage_rows(path):
+    with closing(sqlite3.connect(path)) as local:
+        return local.execute("SELECT COUNT(*) FROM client_stage_progression").fetchone()[0]
+
+
+def insert(path, rows):
+    with closing(sqlite3.connect(path)) as local:
+        local.executemany("INSERT OR IGNORE INTO client_stage_progression VALUES (?, ?, ?, ?)", rows)
+        local.commit()
+
+
+def test_rows_with_a_null_stage_are_not_copied_twice(tmp_path):
+    path = str(tmp_path / "replica.sqlite3")
+    LocalReplica(path)
+    rows = [(1, None, None, 5), (1, 2, None, 5), (1, None, 'Stage 2', 5), (1, 2, 'Stage 2', 5)]
+    for _ in range(3):
+        insert(path, rows)
+    assert stage_rows(path) == 4
+
+
+def test_older_replica_is_copied_again(tmp_path):
+    path = str(tmp_path / "replica.sqlite3")
+    with closing(sqlite3.connect(path)) as local:
+        local.executescript("""
+            CREATE TABLE client_stage_progression (
+                client_id INTEGER NOT NULL, current_stage INTEGER, stage_name TEXT, created_on INTEGER NOT NULL,
+                UNIQUE (client_id, created_on, current_stage, stage_name)
+            );
+            INSERT INTO client_stage_progression VALUES (1, NULL, NULL, 5), (1, NULL, NULL, 5);
+            PRAGMA user_version = 2;
+        """)
+    LocalReplica(path)
+    assert stage_rows(path) == 0
+    with closing(sqlite3.connect(path)) as local:
+        assert local.execute("PRAGMA user_version").fetchone()[0] == SCHEMA_VERSION
@@ -0,0 +1,27 @@
+import numpy as np
+import pandas as pd
+
+from schema import ingest, ingest_chunks
+
+
+def raw_result(rows=1000, seed=2):
+    rng = np.random.default_rng(seed)
+    return pd.DataFrame({
+        'client_id': np.arange(rows, dtype=np.int64),
+        'employee_name': rng.choice(['Alice', 'Bruno', 'Carla', 'Dmitri'], size=rows).astype(object),
+        'stage_name': rng.choice(['Stage 1: Not Interested', 'Stage 8: Commission Collection', None], size=rows),
+        'current_stage': rng.integers(1, 10, size=rows),
+        'time_diff_hours': rng.random(rows),
+    })
+
+
+def test_chunked_ingest_matches_whole_ingest():
+    frame = raw_result()
+    # Chunks small enough that some lack categories others have
+    chunks = [frame.iloc[start:start + 7].reset_index(drop=True) for start in range(0, len(frame), 7)]
+    pd.testing.assert_frame_equal(ingest_chunks(iter(chunks)), ingest(frame))
+
+
+def test_single_chunk():
+    frame = raw_result(rows=5)
+    pd.testing.assert_frame_equal(ingest_chunks(iter([frame])), ingest(frame))
@@ -0,0 +1,107 @@
+import os
+import time
+
+import pandas as pd
+import pytest
+
+import snapshot_store
+from snapshot_store import CURRENT, MANIFEST, SnapshotStore, report_fingerprint
+from snapshots import ReportSnapshot
+
+
+def datasets():
+    return {
+        'sales_leads': {
+            'leads': pd.DataFrame({
+                'client_id': [1, 2, 3],
+                'client_name': ['Ann', 'Bob', None],
+                'employee_name': pd.Categorical(['Alice', 'Bruno', 'Alice']),
+                'current_stage': [1, 4, 8],
+                'time_entered_stage': pd.to_datetime(['2024-03-09 23:30', '2024-03-10 03:00', '2024-03-10 07:15'])
+                                        .tz_localize('UTC').tz_convert('America/New_York'),
+                'time_diff_hours': [1.5, None, 30.0],
+            }),
+            'sales_reps': None,
+        },
+        'stage_funnel': {},
+    }
+
+
+def snapshot(built_at=None):
+    return ReportSnapshot(datasets(), {'stage_funnel': ['connection refused']}, built_at or time.time(), 2.5)
+
+
+def test_round_trip(tmp_path):
+    saved = snapshot()
+    SnapshotStore(str(tmp_path), 'abc').save(saved)
+    loaded, errors, built_at, build_seconds = SnapshotStore(str(tmp_path), 'abc').load()
+    assert errors == saved.errors
+    assert (built_at, build_seconds) == (saved.built_at, saved.build_seconds)
+    assert loaded.keys() == saved.datasets.keys()
+    assert loaded['sales_leads']['sales_reps'] is None
+    assert loaded['stage_funnel'] == {}
+    pd.testing.assert_frame_equal(loaded['sales_leads']['leads'], saved.datasets['sales_leads']['leads'])
+
+
+def test_nothing_saved(tmp_path):
+    assert SnapshotStore(str(tmp_path), 'abc').load() is None
+
+
+def test_other_fingerprint_is_rejected(tmp_path):
+    SnapshotStore(str(tmp_path), 'abc').save(snapshot())
+    assert SnapshotStore(str(tmp_path), 'def').load() is None
+
+
+def test_old_snapshot_is_rejected(tmp_path):
+    SnapshotStore(str(tmp_path), 'abc').save(snapshot(time.time() - 7200))
+    assert SnapshotStore(str(tmp_path), 'abc', max_age=3600).load() is None
+    assert SnapshotStore(str(tmp_path), 'abc', max_age=10800).load() is not None
+
+
+def test_new_save_replaces_the_old_one(tmp_path):
+    store = SnapshotStore(str(tmp_path), 'abc')
+    store.save(snapshot(time.time() - 60))
+    latest = snapshot()
+    store.save(latest)
+    assert store.load()[2] == latest.built_at
+    assert sorted(os.listdir(tmp_path)) == sorted([CURRENT, str(int(latest.built_at * 1000))])
+
+
+def test_failed_save_keeps_the_previous_snapshot(tmp_path, monkeypatch):
+    store = SnapshotStore(str(tmp_path), 'abc')
+    previous = snapshot(time.time() - 60)
+    store.save(previous)
+
+    def fail(frame, path):
+        raise OSError("disk full")
+
+    monkeypatch.setattr(snapshot_store, 'write_frame', fail)
+    with pytest.raises(OSError):
+        store.save(snapshot())
+    assert store.load()[2] == previous.built_at
+
+
+def test_unreadable_snapshot_is_ignored(tmp_path):
+    store = SnapshotStore(str(tmp_path), 'abc')
+    saved = snapshot()
+    store.save(saved)
+    with open(os.path.join(tmp_path, str(int(saved.built_at * 1000)), MANIFEST), 'w') as f:
+        f.write("{")
+    assert store.load() is None
+
+
+@pytest.mark.parametrize('setting, value', [
+    ('CLASSIFICATION_THRESHOLD', 'median'),
+    ('LARGE_RESULT_TRANSPORT', 'copy'),
+    ('STREAM_MAX_ROWS', 1000),
+])
+def test_fingerprint_follows_report_settings(monkeypatch, setting, value):
+    fingerprint = report_fingerprint()
+    assert report_fingerprint() == fingerprint
+    monkeypatch.setattr(snapshot_store, 'get_setting',
+                        lambda name, default=None: value if name == setting else default)
+    assert report_fingerprint() != fingerprint
+
+
+def test_fingerprint_covers_the_fetch_code():
+    assert 'db.py' in snapshot_store.REPORT_SOURCES
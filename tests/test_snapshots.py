@@ -0,0 +1,62 @@
+import threading
+import time
+
+import pandas as pd
+
+from snapshots import SnapshotScheduler
+
+
+def test_cold_start_waits_for_one_build():
+    calls = []
+
+    def load():
+        calls.append(1)
+        time.sleep(0.2)
+        return {'leads': pd.DataFrame({'client_id': [1, 2]})}
+
+    scheduler = SnapshotScheduler({'sales_leads': load})
+    scheduler.start()
+    try:
+        snapshots = []
+        sessions = [threading.Thread(target=lambda: snapshots.append(scheduler.wait(5))) for _ in range(10)]
+        for session in sessions:
+            session.start()
+        for session in sessions:
+            session.join()
+    finally:
+        scheduler.stop()
+    assert calls == [1]
+    assert len(snapshots) == 10
+    assert all(snapshot is snapshots[0] for snapshot in snapshots)
+    assert snapshots[0].datasets['sales_leads']['leads']['client_id'].tolist() == [1, 2]
+
+
+def test_wait_gives_up_after_timeout():
+    started = threading.Event()
+    release = threading.Event()
+
+    def load():
+        started.set()
+        release.wait(5)
+        return {}
+
+    scheduler = SnapshotScheduler({'sales_leads': load})
+    scheduler.start()
+    try:
+        started.wait(5)
+        assert scheduler.wait(0.05) is None
+    finally:
+        release.set()
+        scheduler.stop()
+    assert scheduler.wait(5) is not None
+
+
+def test_report_errors_are_kept_in_the_snapshot():
+    def fail():
+        raise RuntimeError("connection refused")
+
+    scheduler = SnapshotScheduler({'stage_funnel': fail})
+    snapshot = scheduler.build()
+    assert snapshot.datasets == {'stage_funnel': {}}
+    assert snapshot.errors == {'stage_funnel': ['connection refused']}
+    assert scheduler.wait(0) is snapshot